@@ -0,0 +1,191 @@
+# Finds the throughput-optimal batch size of a model on this machine. One
+# training step function is compiled and timed at increasing batch sizes
+# until the estimated memory would exceed the limit, the allocation fails
+# or the throughput keeps dropping. The best batch size is recorded per
+# model, input shape and layer backend in '../data/batch_sizes.json',
+# where the training scripts look it up ('tuned_batch_size').
+
+# Usage (from the code folder): $python autotune.py MODULE [MEMORY_LIMIT_MB]
+# e.g. $python autotune.py 3d_cnn_lasagne 3500
+
+from __future__ import division
+
+import os
+import sys
+import json
+import timeit
+import importlib
+import numpy as np
+import lasagne
+import theano
+import theano.tensor as T
+
+from backend import BACKEND
+from benchmark_backend import MODELS
+
+BATCH_SIZES_PATH = '../data/batch_sizes.json'
+
+def _key(model, sample_shape):
+    return '{} {} {}'.format(model, 'x'.join(str(int(d)) for d in sample_shape), BACKEND)
+
+def load_batch_sizes(path=BATCH_SIZES_PATH):
+    """
+    Returns the recorded settings by key (an empty dict w/o a file)
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def tuned_batch_size(model, sample_shape, default=16, path=BATCH_SIZES_PATH):
+    """
+    Overview:
+        The recorded best batch size of 'model' for this input shape and
+        layer backend, or 'default' if it hasn't been tuned.
+    ----------
+    model: string
+        The module name, e.g. '3d_cnn_lasagne'
+
+    sample_shape: tuple
+        Shape of one input sample, e.g. X_train.shape[1:]
+
+    default: int
+        Defaults to 16
+
+    path: string
+        The JSON file written by 'record_batch_size'
+
+    Returns
+    -------
+    batchsize: int
+    """
+    setting = load_batch_sizes(path).get(_key(model, sample_shape))
+    return setting['batch_size'] if setting else default
+
+def record_batch_size(model, sample_shape, setting, path=BATCH_SIZES_PATH):
+    """
+    Stores 'setting' (a dict w/ 'batch_size') for 'model' in 'path'
+    """
+    settings = load_batch_sizes(path)
+    settings[_key(model, sample_shape)] = setting
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(settings, f, indent=2, sort_keys=True)
+    os.rename(tmp_path, path)
+
+def estimate_memory_mb(network, batchsize):
+    """
+    Overview:
+        Rough memory of a training step: every layer output and its
+        gradient per sample, plus the parameters w/ their gradients and
+        the two adam moments.
+    ----------
+    network: Lasagne object
+        The output layer
+
+    batchsize: int
+
+    Returns
+    -------
+    megabytes: float
+    """
+    layers = lasagne.layers.get_all_layers(network)
+    activations = sum(int(np.prod(layer.output_shape[1:])) for layer in layers)
+    params = sum(int(np.prod(p.get_value(borrow=True).shape))
+                 for p in lasagne.layers.get_all_params(network))
+    return 4 * (2 * batchsize * activations + 4 * params) / 2**20
+
+def _out_of_memory(error):
+    """
+    Whether a failed step ran out of memory: a MemoryError on the CPU (and
+    the old CUDA backend), a RuntimeError or pygpu's GpuArrayException
+    mentioning memory on the gpuarray backend
+    """
+    if isinstance(error, MemoryError):
+        return True
+    gpu_errors = (RuntimeError,)
+    try:
+        from pygpu.gpuarray import GpuArrayException
+        gpu_errors += (GpuArrayException,)
+    except ImportError:
+        pass
+    return isinstance(error, gpu_errors) and 'memory' in str(error).lower()
+
+def probe_batch_sizes(net, memory_limit_mb=None, batch_sizes=(8, 16, 32, 64, 128, 256),
+                      repeats=5, tolerance=.05):
+    """
+    Overview:
+        Times one training step (squared error, adam - as costly as the
+        hinge loss) of 'net' at each batch size.
+    ----------
+    net: dict
+        Layers by name as returned by 'build_cnn'
+
+    memory_limit_mb: float
+        Batch sizes whose estimate (see 'estimate_memory_mb') exceeds
+        this aren't tried. Defaults to no limit (allocation failures
+        still end the probe).
+
+    batch_sizes: tuple
+        Increasing batch sizes to try
+
+    repeats: int
+        Timed steps per batch size (after one warm-up step)
+
+    tolerance: float
+        The smallest batch size within this fraction of the best
+        throughput is chosen (smaller batches generalize better)
+
+    Returns
+    -------
+    setting: dict
+        'batch_size', 'samples_per_sec' and 'probed' (samples / sec by
+        batch size)
+    """
+    input_var = net['input'].input_var
+    target_var = T.fvector('targets')
+    prediction = lasagne.layers.get_output(net['output']).flatten()
+    loss = lasagne.objectives.squared_error(prediction, target_var).mean()
+    params = lasagne.layers.get_all_params(net['output'], trainable=True)
+    train_fn = theano.function([input_var, target_var], loss,
+                               updates=lasagne.updates.adam(loss, params))
+
+    probed = {}
+    for batchsize in batch_sizes:
+        if memory_limit_mb is not None and estimate_memory_mb(net['output'], batchsize) > memory_limit_mb:
+            break
+        inputs = np.random.rand(*((batchsize,) + tuple(net['input'].shape[1:]))).astype(np.float32)
+        targets = np.random.randn(batchsize).astype(np.float32)
+        try:
+            train_fn(inputs, targets)
+            start = timeit.default_timer()
+            for _ in range(repeats):
+                train_fn(inputs, targets)
+        except Exception as error:
+            if not _out_of_memory(error):
+                raise
+            break # Out of (GPU) memory
+        probed[batchsize] = batchsize * repeats / (timeit.default_timer() - start)
+        print('{:>6}{:>12.1f} samples / sec'.format(batchsize, probed[batchsize]))
+        speeds = [probed[b] for b in sorted(probed)]
+        if len(speeds) >= 3 and speeds[-1] < speeds[-2] < speeds[-3]:
+            break # Past the optimum
+    if not probed:
+        raise MemoryError('not even a batch of {} fits'.format(batch_sizes[0]))
+
+    best = max(probed.values())
+    batchsize = min(b for b in probed if probed[b] >= (1 - tolerance) * best)
+    return {'batch_size': batchsize, 'samples_per_sec': probed[batchsize],
+            'probed': dict((str(b), s) for b, s in probed.items())}
+
+if __name__ == '__main__':
+
+    model = sys.argv[1]
+    memory_limit_mb = float(sys.argv[2]) if len(sys.argv) > 2 else None
+    net = importlib.import_module(model).build_cnn(None, **dict(MODELS).get(model, {}))
+    sample_shape = net['input'].shape[1:]
+    setting = probe_batch_sizes(net, memory_limit_mb)
+    record_batch_size(model, sample_shape, setting)
+    print('{}: batch size {} ({:.1f} samples / sec), recorded in {}'.format(
+        model, setting['batch_size'], setting['samples_per_sec'], BATCH_SIZES_PATH))
@@ -0,0 +1,64 @@
+# Convolution, pooling and batch norm layers for the 'build_cnn' functions
+# that work w/ and w/o a GPU. W/ cuDNN these are the lasagne.layers.dnn
+# layers. Otherwise they are Lasagne's generic layers, which Theano compiles
+# to its fastest CPU ops (CorrMM / Corr3dMM - im2col + BLAS gemm - for the
+# convolutions). Set LAYER_BACKEND=cpu to force the CPU layers on a GPU host.
+
+# The parameters (shapes, order and filter orientation) are the same for
+# both backends, so weights saved on one load on the other. The CPU
+# convolutions default to flip_filters=False like the cuDNN ones for that.
+
+# 3D layers on CPU need Lasagne >= 0.2.dev1 (Conv3DLayer, MaxPool3DLayer).
+
+from __future__ import division
+
+import os
+import lasagne
+
+def _cudnn_available():
+    if os.environ.get('LAYER_BACKEND', '').lower() == 'cpu':
+        return False
+    try:
+        import lasagne.layers.dnn # Raises ImportError w/o a GPU and cuDNN
+    except ImportError:
+        return False
+    return True
+
+BACKEND = 'cudnn' if _cudnn_available() else 'cpu'
+
+def _missing(name):
+    def layer(*args, **kwargs):
+        raise ImportError('lasagne.layers.{} is needed to build this model on CPU '
+                          '(Lasagne >= 0.2.dev1)'.format(name))
+    return layer
+
+if BACKEND == 'cudnn':
+    from lasagne.layers.dnn import Conv2DDNNLayer as Conv2DLayer
+    from lasagne.layers.dnn import Conv3DDNNLayer as Conv3DLayer
+    from lasagne.layers.dnn import MaxPool2DDNNLayer as MaxPool2DLayer
+    from lasagne.layers.dnn import MaxPool3DDNNLayer as MaxPool3DLayer
+    from lasagne.layers.dnn import BatchNormDNNLayer as BatchNormLayer
+else:
+    from lasagne.layers import MaxPool2DLayer, BatchNormLayer
+
+    class Conv2DLayer(lasagne.layers.Conv2DLayer):
+        """
+        lasagne.layers.Conv2DLayer w/ the cuDNN default of flip_filters=False
+        """
+        def __init__(self, incoming, num_filters, filter_size, flip_filters=False, **kwargs):
+            super(Conv2DLayer, self).__init__(incoming, num_filters, filter_size,
+                                              flip_filters=flip_filters, **kwargs)
+
+    if hasattr(lasagne.layers, 'Conv3DLayer'):
+        from lasagne.layers import MaxPool3DLayer
+
+        class Conv3DLayer(lasagne.layers.Conv3DLayer):
+            """
+            lasagne.layers.Conv3DLayer w/ the cuDNN default of flip_filters=False
+            """
+            def __init__(self, incoming, num_filters, filter_size, flip_filters=False, **kwargs):
+                super(Conv3DLayer, self).__init__(incoming, num_filters, filter_size,
+                                                  flip_filters=flip_filters, **kwargs)
+    else:
+        Conv3DLayer = _missing('Conv3DLayer')
+        MaxPool3DLayer = _missing('MaxPool3DLayer')
@@ -0,0 +1,81 @@
+# Forward (inference) and forward/backward (training) throughput of each
+# model on the layer backend in use (see 'backend.py'). Run w/
+# LAYER_BACKEND=cpu on a GPU host to measure the CPU layers.
+
+# Usage (from the code folder): $python benchmark_backend.py [MODULE ...]
+# MODELS lists this code folder's models (each folder has its own copy).
+
+from __future__ import division
+
+import sys
+import timeit
+import importlib
+import numpy as np
+import lasagne
+import theano
+import theano.tensor as T
+
+from lasagne.objectives import squared_error
+from backend import BACKEND
+
+# Module -> extra 'build_cnn' arguments, for the models in this folder
+MODELS = [('sdc_3dcnn', {}), ('sdc_2dcnn', {'dim1': 160, 'dim2': 320})]
+
+def throughput(net, batchsize=16, repeats=5):
+    """
+    Overview:
+        Compiles the forward pass and a training step (loss, gradients
+        and adam updates) of 'net' and times them on random inputs (after
+        one warm-up call).
+    ----------
+    net: dict
+        Layers by name as returned by 'build_cnn'
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    repeats: int
+        The number of timed calls
+
+    Returns
+    -------
+    forward: float
+        Samples / sec of the deterministic forward pass
+
+    train: float
+        Samples / sec of training steps
+    """
+    input_var = net['input'].input_var
+    target_var = T.fvector('targets')
+    prediction = lasagne.layers.get_output(net['output']).flatten()
+    loss = squared_error(prediction, target_var).mean()
+    params = lasagne.layers.get_all_params(net['output'], trainable=True)
+    train_fn = theano.function([input_var, target_var], loss,
+                               updates=lasagne.updates.adam(loss, params))
+    forward_fn = theano.function([input_var], lasagne.layers.get_output(net['output'], deterministic=True))
+
+    inputs = np.random.rand(*((batchsize,) + tuple(net['input'].shape[1:]))).astype(np.float32)
+    targets = np.random.randn(batchsize).astype(np.float32)
+    speeds = []
+    for fn, args in [(forward_fn, [inputs]), (train_fn, [inputs, targets])]:
+        fn(*args)
+        start = timeit.default_timer()
+        for _ in range(repeats):
+            fn(*args)
+        speeds.append(batchsize * repeats / (timeit.default_timer() - start))
+    return speeds[0], speeds[1]
+
+if __name__ == '__main__':
+
+    names = sys.argv[1:] or [name for name, _ in MODELS]
+    kwargs = dict(MODELS)
+    print('backend: ' + BACKEND)
+    for name in names:
+        try:
+            module = importlib.import_module(name) # Module names can start w/ a digit
+        except ImportError as e:
+            print('{:<16}skipped ({})'.format(name, e))
+            continue
+        net = module.build_cnn(None, **kwargs.get(name, {})) # The input layer makes its own variable
+        forward, train = throughput(net)
+        print('{:<16}forward {:8.1f} samples / sec\ttrain {:8.1f} samples / sec'.format(name, forward, train))
@@ -0,0 +1,157 @@
+# Shrinks the comma drives before training: frames where the car (nearly)
+# stands still are dropped except for the first one of each stop, and
+# moving frames that look the same as the last kept frame (average hash
+# w/in a few bits) are collapsed. The kept frame numbers of every drive
+# go to an index file that sdc_2dcnn.py reads, so each epoch only trains
+# on frames that carry new information.
+
+# Usage (from the code folder):
+#   $python frame_filter.py ../data/camera/filtered_index.npz ../data/camera/*.h5
+
+from __future__ import division
+
+import os
+import sys
+import numpy as np
+
+from load_comma_data import concatenate
+
+def drive_name(camera_path):
+    """
+    The drive's key in the index, e.g. '2016-01-30--11-24-51'
+    """
+    return os.path.splitext(os.path.basename(camera_path))[0]
+
+def average_hash(frames, hash_size=8):
+    """
+    Overview:
+        A cheap perceptual hash: each frame is turned gray, averaged down
+        to hash_size x hash_size blocks and every block becomes one bit
+        (brighter than the frame's mean or not).
+    ----------
+    frames: numpy array
+        Frames of shape (num_frames, num_channels, length, width)
+
+    hash_size: int
+        Defaults to 8 (64 bit hashes)
+
+    Returns
+    -------
+    hashes: numpy array
+        (num_frames, hash_size * hash_size) booleans
+    """
+    gray = np.asarray(frames, dtype=np.float32).mean(axis=1)
+    num_frames, length, width = gray.shape
+    rows, cols = length // hash_size, width // hash_size
+    blocks = gray[:, :rows * hash_size, :cols * hash_size]
+    blocks = blocks.reshape(num_frames, hash_size, rows, hash_size, cols).mean(axis=(2, 4))
+    blocks = blocks.reshape(num_frames, -1)
+    return blocks > blocks.mean(axis=1, keepdims=True)
+
+def select_frames(hashes, speed, min_speed=1., max_distance=3):
+    """
+    Overview:
+        Picks the frames to keep in one drive.
+    ----------
+    hashes: numpy array
+        Per-frame hashes (see 'average_hash')
+
+    speed: numpy array
+        Per-frame speed (m/s) from the drive's log
+
+    min_speed: float
+        Defaults to 1. Slower frames count as standing still - only the
+        first frame of each stop is kept
+
+    max_distance: int
+        Defaults to 3. Moving frames w/in this many differing hash bits
+        of the last kept frame are dropped as near-duplicates
+
+    Returns
+    -------
+    frames: numpy array
+        Kept frame numbers, increasing
+    """
+    moving = speed >= min_speed
+    kept = []
+    last_hash = None
+    for i in range(len(speed)):
+        if not moving[i]:
+            if i > 0 and not moving[i - 1]:
+                continue # Still standing
+        elif last_hash is not None and np.count_nonzero(hashes[i] != last_hash) <= max_distance:
+            continue
+        kept.append(i)
+        last_hash = hashes[i]
+    return np.asarray(kept, dtype=np.int64)
+
+def filter_drive(camera_path, chunk=200, **kwargs):
+    """
+    Overview:
+        Hashes a drive's frames chunk by chunk (the drive is never fully
+        in memory) and selects the frames to keep.
+    ----------
+    camera_path: string
+        The drive's camera .h5 file (the log is found like in 'concatenate')
+
+    chunk: int
+        Frames read at a time
+
+    kwargs:
+        Passed on to 'select_frames'
+
+    Returns
+    -------
+    frames: numpy array
+        Kept frame numbers
+
+    num_frames: int
+        All frames of the drive
+    """
+    c5x, angle, speed, filters, hdf5_camera = concatenate([camera_path], 1)
+    frames = c5x[0][2]
+    try:
+        hashes = np.concatenate([average_hash(frames[i:(i + chunk)])
+                                 for i in range(0, frames.shape[0], chunk)])
+    finally:
+        hdf5_camera[0].close()
+    return select_frames(hashes, speed, **kwargs), len(speed)
+
+def write_filtered_index(index_path, camera_paths, **kwargs):
+    """
+    Overview:
+        Filters every drive and saves the kept frame numbers by drive
+        name (see 'drive_name') to 'index_path'.
+    ----------
+    index_path: string
+        E.g. '../data/camera/filtered_index.npz'
+
+    camera_paths: list
+        Camera .h5 files
+
+    kwargs:
+        Passed on to 'select_frames'
+    """
+    index = {}
+    for camera_path in camera_paths:
+        index[drive_name(camera_path)], num_frames = filter_drive(camera_path, **kwargs)
+        print('{}: kept {} of {} frames'.format(drive_name(camera_path),
+                                                len(index[drive_name(camera_path)]), num_frames))
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f: # A file object stops savez from appending '.npz'
+        np.savez(f, **index)
+    os.rename(tmp_path, index_path)
+
+def load_filtered_index(index_path):
+    """
+    Returns the kept frame numbers by drive name (empty w/o an index, so
+    every frame is used)
+    """
+    if not os.path.exists(index_path):
+        return {}
+    with np.load(index_path) as index:
+        return dict((name, index[name]) for name in index.files)
+
+if __name__ == '__main__':
+
+    write_filtered_index(sys.argv[1], sys.argv[2:])
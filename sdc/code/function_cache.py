@@ -0,0 +1,133 @@
+# Persists compiled Theano functions so that a second launch of the same
+# model skips graph optimization and compilation (minutes for the 3D nets).
+
+# The functions are pickled together w/ the network so that the shared
+# variables they update (weights, adam moments) stay the network's own
+# parameters after loading. The pickle is written right after compiling, so
+# it holds that run's initial weights - on a hit the caller's current
+# weights (e.g. pretrained or resumed ones) are copied into the unpickled
+# network. Entries are keyed by the architecture, the input dtypes, the
+# loss/update graph and the Theano flags.
+
+from __future__ import division
+
+import os
+import sys
+import json
+import timeit
+import hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import lasagne
+import theano
+
+def graph_key(network, inputs, outputs, flags=''):
+    """
+    Overview:
+        Hashes everything that changes the compiled functions.
+    ----------
+    network: Lasagne object
+        The output layer
+
+    inputs: list
+        Input variables of the functions (their types hold the dtypes)
+
+    outputs: list
+        Expressions the functions compute, e.g. [loss] + val_outputs +
+        updates.values()
+
+    flags: string
+        Anything else that should invalidate the cache
+
+    Returns
+    -------
+    key: string
+        A short hex digest
+    """
+    signature = []
+    for layer in lasagne.layers.get_all_layers(network):
+        param_shapes = [p.get_value(borrow=True).shape for p in layer.get_params()]
+        signature.append(type(layer).__name__ + str(layer.output_shape) + str(param_shapes))
+    signature += [str(var.type) for var in inputs]
+    signature.append(theano.printing.debugprint(list(outputs), file='str', print_type=True))
+    signature += [theano.__version__, theano.config.device, theano.config.floatX,
+                  str(theano.config.mode), str(theano.config.optimizer), str(flags)]
+    return hashlib.sha1('\n'.join(signature).encode('utf-8')).hexdigest()[:16]
+
+def cached_compile(name, network, inputs, outputs, compile_fns, cache_dir='../data/fn_cache', flags=''):
+    """
+    Overview:
+        Returns the compiled functions for 'network' from the cache or
+        compiles them w/ 'compile_fns' and stores them. Prints the compile
+        time on a miss and the load time (vs. the original compile time)
+        on a hit.
+    ----------
+    name: string
+        Prefix of the cache file, e.g. '3d_cnn'
+
+    network: Lasagne object
+        The output layer the functions were built from
+
+    inputs: list
+        Input variables of the functions, e.g. [input_var, target_var]
+
+    outputs: list
+        Expressions the functions compute (used for the cache key)
+
+    compile_fns: function
+        compile_fns() -> tuple of compiled functions
+
+    cache_dir: string
+        Where the cache files live
+
+    flags: string
+        Extra key material
+
+    Returns
+    -------
+    network: Lasagne object
+        The network the returned functions update. On a cache hit this is
+        the unpickled network w/ the parameter values of the one passed in
+        - use it instead of that one.
+
+    fns: tuple
+        The compiled functions
+    """
+    key = graph_key(network, inputs, outputs, flags)
+    path = os.path.join(cache_dir, name + '_' + key + '.pkl')
+    info_path = path[:-4] + '.json'
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000)) # Deep graphs
+
+    if os.path.exists(path):
+        start = timeit.default_timer()
+        with open(path, 'rb') as f:
+            cached, fns = pickle.load(f)
+        lasagne.layers.set_all_param_values(cached, lasagne.layers.get_all_param_values(network))
+        network = cached
+        load_time = timeit.default_timer() - start
+        compile_time = None
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                compile_time = json.load(f).get('compile_time')
+        print('Loaded compiled functions from cache in {:.1f}s (compiling took {}s)'.format(
+            load_time, 'unknown' if compile_time is None else '{:.1f}'.format(compile_time)))
+        return network, fns
+
+    start = timeit.default_timer()
+    fns = tuple(compile_fns())
+    compile_time = timeit.default_timer() - start
+    print('Compiled functions in {:.1f}s'.format(compile_time))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((network, fns), f, -1)
+    os.rename(tmp_path, path) # Never leave a half written entry behind
+    with open(info_path, 'w') as f:
+        json.dump({'compile_time': compile_time}, f)
+    return network, fns
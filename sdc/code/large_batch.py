@@ -0,0 +1,150 @@
+# Large effective batches w/o a larger memory ceiling: one Theano call
+# takes 'accum_steps' micro-batches stacked into one batch, sums their
+# gradients in a scan (one micro-batch in memory at a time) and applies the
+# optimizer step once. Fewer optimizer steps and a single call per
+# effective batch means less Python and launch overhead.
+
+# The learning rate follows the linear scaling rule (lr grows w/ the
+# effective batch size) w/ a linear warmup over the first updates. It is
+# scaled by 'accum_steps' only: 'learning_rate' is the rate for a single
+# micro-batch, whatever size that is (e.g. autotuned).
+
+from __future__ import division
+
+import numpy as np
+import lasagne
+import theano
+import theano.tensor as T
+
+from lasagne.updates import adam
+
+def _split(var, accum_steps):
+    # (accum_steps * micro_batchsize, ...) -> (accum_steps, micro_batchsize, ...)
+    shape = T.concatenate([[accum_steps, var.shape[0] // accum_steps], var.shape[1:]])
+    return var.reshape(shape, ndim=var.ndim + 1)
+
+class AccumulatingTrainFn(object):
+    """
+    Overview:
+        A drop-in replacement for 'train_fn': called as
+        train_fn(inputs, targets) on an effective batch of
+        accum_steps * micro_batchsize samples, it returns the mean loss
+        and updates the parameters once w/ the mean gradient of the
+        micro-batches - all in one compiled function.
+    ----------
+    network: Lasagne object
+        The output layer
+
+    input_var: Theano Tensor
+        The network's input variable
+
+    target_var: Theano Tensor
+        The labels variable
+
+    loss: Theano expression
+        Mean training loss of a micro-batch
+
+    accum_steps: int
+        The number of micro-batches per parameter update
+
+    micro_batchsize: int
+        Defaults to 16. The size of each micro-batch
+
+    learning_rate: float or Theano shared variable
+        Defaults to .001 (adam's default). The rate for one micro-batch
+        (accum_steps=1). Pass a shared variable to change it during
+        training.
+
+    warmup_updates: int
+        Defaults to 100. The learning rate ramps up linearly over this
+        many parameter updates
+
+    update: function
+        Defaults to adam. Any lasagne.updates function
+    """
+    def __init__(self, network, input_var, target_var, loss, accum_steps, micro_batchsize=16,
+                 learning_rate=.001, warmup_updates=100, update=adam):
+        self.accum_steps = accum_steps
+        self.micro_batchsize = micro_batchsize
+        floatX = theano.config.floatX
+        params = lasagne.layers.get_all_params(network, trainable=True)
+
+        def step(inputs, targets, *sums):
+            # Random streams (dropout) advance every micro-batch through their
+            # default updates, which scan returns in 'scan_updates'
+            micro_loss = theano.clone(loss, replace={input_var: inputs, target_var: targets})
+            grads = theano.grad(micro_loss, params)
+            return [micro_loss] + [s + g for s, g in zip(sums, grads)]
+
+        zeros = [T.zeros_like(p) for p in params]
+        outputs, scan_updates = theano.scan(step, sequences=[_split(input_var, accum_steps),
+                                                             _split(target_var, accum_steps)],
+                                            outputs_info=[None] + zeros)
+        mean_grads = [sums[-1] / accum_steps for sums in outputs[1:]]
+
+        # Rate for one micro-batch - schedules set this variable
+        if isinstance(learning_rate, theano.compile.SharedVariable):
+            self.learning_rate = learning_rate
+        else:
+            self.learning_rate = theano.shared(np.asarray(learning_rate, dtype=floatX), name='learning_rate')
+        self.num_updates = theano.shared(np.asarray(0, dtype=floatX), name='num_updates')
+        scale = accum_steps
+        warmup = T.minimum(1, (self.num_updates + 1) / max(warmup_updates, 1))
+        lr = T.cast(self.learning_rate * scale * warmup, floatX)
+
+        updates = update(mean_grads, params, learning_rate=lr)
+        updates.update(scan_updates)
+        updates[self.num_updates] = self.num_updates + 1
+        self.fn = theano.function([input_var, target_var], outputs[0].mean(), updates=updates)
+
+    @property
+    def effective_batchsize(self):
+        return self.micro_batchsize * self.accum_steps
+
+    @property
+    def functions(self):
+        return [self.fn]
+
+    def __call__(self, inputs, targets):
+        return self.fn(inputs, targets)
+
+def compile_accumulating_fns(network, input_var, target_var, loss, val_outputs, accum_steps,
+                             micro_batchsize=16, **kwargs):
+    """
+    Overview:
+        Like 'compile_fns' but 'train_fn' is an 'AccumulatingTrainFn'.
+        Extra keyword arguments are passed on to it.
+    ----------
+    network: Lasagne object
+        The output layer
+
+    input_var: Theano Tensor
+        The network's input variable
+
+    target_var: Theano Tensor
+        The labels variable
+
+    loss: Theano expression
+        Mean training loss of a micro-batch
+
+    val_outputs: list
+        Validation expressions, e.g. [test_loss, test_acc]
+
+    accum_steps: int
+        The number of micro-batches per parameter update
+
+    micro_batchsize: int
+        Defaults to 16. The size of each micro-batch
+
+    Returns
+    -------
+    train_fn: AccumulatingTrainFn
+        train_fn(inputs, targets) -> mean loss of an effective batch
+
+    val_fn: Theano function
+        val_fn(inputs, targets) -> 'val_outputs'
+    """
+    train_fn = AccumulatingTrainFn(network, input_var, target_var, loss, accum_steps,
+                                   micro_batchsize, **kwargs)
+    val_fn = theano.function([input_var, target_var], val_outputs)
+    return train_fn, val_fn
@@ -0,0 +1,214 @@
+# Per-layer profile of a 'build_cnn' network: time, FLOPs and activation
+# memory of each named layer in the 'net' dict. Every layer is compiled on
+# its own (forward, and backward given an upstream gradient) w/ Theano's
+# profiler and fed the real activations of the layer below, so op timings
+# map to exactly one layer. The whole train/val graphs are profiled too -
+# their time can be lower than the sum of the layers b/c of fusion across
+# layer boundaries.
+
+# On a GPU, run w/ CUDA_LAUNCH_BLOCKING=1 so op timings are synchronous.
+
+# Usage (from the code folder): $python layer_profile.py MODULE [BATCHSIZE]
+# e.g. $python layer_profile.py 3d_cnn_lasagne
+
+from __future__ import division
+
+import sys
+import importlib
+import numpy as np
+import lasagne
+import theano
+import theano.tensor as T
+
+from collections import OrderedDict
+from benchmark_backend import MODELS
+
+def _node(key):
+    # ProfileStats keys are apply nodes or (fgraph, node) pairs, depending
+    # on the Theano version
+    return key[-1] if isinstance(key, tuple) else key
+
+class _ProfiledFn(object):
+    """
+    A function compiled w/ Theano's profiler that reports the op time per
+    call after a warm-up call
+    """
+    def __init__(self, inputs, outputs, name):
+        self.profile = theano.compile.ProfileStats(atexit_print=False, message=name)
+        self.fn = theano.function(inputs, outputs, profile=self.profile)
+
+    def run(self, args, repeats):
+        outputs = self.fn(*args) # Warm-up (compilation of thunks, cuDNN algorithm choice)
+        before = dict(self.profile.apply_time)
+        for _ in range(repeats):
+            self.fn(*args)
+        op_times = {}
+        for key, seconds in self.profile.apply_time.items():
+            op = str(_node(key).op)
+            op_times[op] = op_times.get(op, 0) + seconds - before.get(key, 0)
+        top_op = max(op_times, key=op_times.get) if op_times else ''
+        return outputs, sum(op_times.values()) / repeats, top_op
+
+def layer_flops(layer, input_shape, output_shape):
+    """
+    Overview:
+        Forward pass FLOPs of 'layer' (multiply-adds count as 2).
+        Convolutions and dense layers are exact, pooling counts one op
+        per window element and everything else one op per output.
+    ----------
+    layer: Lasagne layer
+
+    input_shape: tuple
+        Shape of the layer's input incl. the batch size
+
+    output_shape: tuple
+        Shape of the layer's output incl. the batch size
+
+    Returns
+    -------
+    flops: int
+    """
+    if hasattr(layer, 'filter_size'):
+        return 2 * int(np.prod(output_shape)) * int(np.prod(layer.filter_size)) * input_shape[1]
+    if hasattr(layer, 'num_units'):
+        return 2 * input_shape[0] * int(np.prod(input_shape[1:])) * layer.num_units
+    if hasattr(layer, 'pool_size'):
+        return int(np.prod(output_shape)) * int(np.prod(layer.pool_size))
+    return int(np.prod(output_shape))
+
+def profile_layers(net, inputs, repeats=10, train=True):
+    """
+    Overview:
+        Profiles every layer of 'net' on the batch 'inputs'.
+    ----------
+    net: dict
+        Layers by name as returned by 'build_cnn', w/ 'input' and 'output'
+
+    inputs: numpy array
+        A batch for the input layer
+
+    repeats: int
+        Defaults to 10. Timed calls per function
+
+    train: boolean
+        Defaults to true. If true, dropout is active and the backward pass
+        is profiled too
+
+    Returns
+    -------
+    rows: list
+        One OrderedDict per layer (in forward order) w/ 'layer', 'type',
+        'output_shape', 'forward_ms', 'backward_ms', 'top_op', 'gflops'
+        (forward), 'activation_mb' and 'params'
+    """
+    names = dict((layer, name) for name, layer in net.items())
+    floatX = theano.config.floatX
+    activations = {}
+    rows = []
+    for layer in lasagne.layers.get_all_layers(net['output']):
+        if isinstance(layer, lasagne.layers.InputLayer):
+            activations[layer] = np.asarray(inputs, dtype=floatX)
+            continue
+        incoming = layer.input_layers if hasattr(layer, 'input_layers') else [layer.input_layer]
+        values = [activations[l] for l in incoming]
+        input_vars = [T.TensorType(floatX, (False,) * v.ndim)('x') for v in values]
+        output = layer.get_output_for(input_vars if len(input_vars) > 1 else input_vars[0],
+                                      deterministic=not train)
+        forward = _ProfiledFn(input_vars, output, names.get(layer, layer.name))
+        activations[layer], forward_time, top_op = forward.run(values, repeats)
+
+        backward_time = 0
+        if train:
+            params = layer.get_params(trainable=True)
+            upstream = output.type('g')
+            grads = theano.grad(None, wrt=input_vars + params, known_grads={output: upstream},
+                                disconnected_inputs='ignore')
+            backward = _ProfiledFn(input_vars + [upstream], grads, names.get(layer, layer.name))
+            g = np.ones_like(activations[layer]) / activations[layer].size
+            _, backward_time, _ = backward.run(values + [g], repeats)
+
+        out = activations[layer]
+        rows.append(OrderedDict([('layer', names.get(layer, layer.name)),
+                                 ('type', type(layer).__name__),
+                                 ('output_shape', out.shape[1:]),
+                                 ('forward_ms', forward_time * 1000),
+                                 ('backward_ms', backward_time * 1000),
+                                 ('top_op', top_op),
+                                 ('gflops', layer_flops(layer, values[0].shape, out.shape) / 1e9),
+                                 ('activation_mb', out.nbytes / 2**20),
+                                 ('params', sum(int(np.prod(p.get_value(borrow=True).shape))
+                                                for p in layer.get_params()))]))
+    return rows
+
+def profile_network(net, inputs, targets, objective, repeats=10):
+    """
+    Overview:
+        Profiles the whole graphs of one training step (loss and all
+        gradients, no updates) and of one validation pass.
+    ----------
+    net: dict
+        Layers by name w/ 'input' and 'output'
+
+    inputs: numpy array
+        A batch for the input layer
+
+    targets: numpy array
+        Labels for the batch
+
+    objective: function
+        Elementwise loss, e.g. lasagne.objectives.squared_error
+
+    repeats: int
+        Defaults to 10. Timed calls per function
+
+    Returns
+    -------
+    train_ms: float
+        Op time per training step
+
+    val_ms: float
+        Op time per validation batch
+    """
+    input_var = net['input'].input_var
+    target_var = T.TensorType(theano.config.floatX if targets.dtype.kind == 'f' else targets.dtype,
+                              (False,) * targets.ndim)('targets')
+    params = lasagne.layers.get_all_params(net['output'], trainable=True)
+    prediction = lasagne.layers.get_output(net['output']).flatten()
+    val_prediction = lasagne.layers.get_output(net['output'], deterministic=True).flatten()
+    loss = objective(prediction, target_var).mean()
+    val_loss = objective(val_prediction, target_var).mean()
+    train_fn = _ProfiledFn([input_var, target_var], [loss] + theano.grad(loss, params), 'train_fn')
+    val_fn = _ProfiledFn([input_var, target_var], val_loss, 'val_fn')
+    args = [np.asarray(inputs, dtype=theano.config.floatX), targets]
+    return train_fn.run(args, repeats)[1] * 1000, val_fn.run(args, repeats)[1] * 1000
+
+def print_profile(rows, train_ms=None, val_ms=None):
+    """
+    Prints the per-layer table of 'profile_layers' w/ each layer's share
+    of the summed time
+    """
+    total_ms = max(sum(r['forward_ms'] + r['backward_ms'] for r in rows), 1e-12)
+    print('{:<10}{:<20}{:<22}{:>9}{:>9}{:>7}{:>9}{:>9}{:>11}  {}'.format(
+        'layer', 'type', 'output', 'fwd ms', 'bwd ms', '%', 'GFLOPs', 'act MB', 'params', 'top op'))
+    for r in rows:
+        print('{:<10}{:<20}{:<22}{:>9.2f}{:>9.2f}{:>7.1f}{:>9.3f}{:>9.1f}{:>11}  {}'.format(
+            r['layer'], r['type'], str(r['output_shape']), r['forward_ms'], r['backward_ms'],
+            100 * (r['forward_ms'] + r['backward_ms']) / total_ms, r['gflops'],
+            r['activation_mb'], r['params'], r['top_op']))
+    print('sum of layers: {:.2f} ms, {:.3f} GFLOPs (fwd), {:.1f} MB of activations'.format(
+        total_ms, sum(r['gflops'] for r in rows), sum(r['activation_mb'] for r in rows)))
+    if train_ms is not None:
+        print('whole graph:   train step {:.2f} ms, validation batch {:.2f} ms'.format(train_ms, val_ms))
+
+if __name__ == '__main__':
+
+    # Module names can start w/ a digit, so import by name
+    model = sys.argv[1]
+    module = importlib.import_module(model)
+    batchsize = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    net = module.build_cnn(None, **dict(MODELS).get(model, {})) # The input layer makes its own variable
+    input_shape = (batchsize,) + tuple(net['input'].shape[1:])
+    inputs = np.random.rand(*input_shape).astype(np.float32)
+    targets = np.random.randn(batchsize).astype(np.float32) # Squared error is as costly as the hinge loss
+    print_profile(profile_layers(net, inputs),
+                  *profile_network(net, inputs, targets, lasagne.objectives.squared_error))
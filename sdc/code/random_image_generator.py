@@ -0,0 +1,138 @@
+# Author: Raj Agrawal
+
+# Helper functions to randomly rotate multiple frames (or just 2d images)
+# in the minibatch samples
+
+# References: Taken mostly from https://jessesw.com/Deep-Learning/
+
+# Note: Works for greyscale and color, single images and clips. The shift and
+# rotation of every sample are folded into one affine map of its (length,
+# width) plane, and all planes of all samples are resampled by a single
+# 'map_coordinates' call (cubic spline, zeros outside).
+
+from __future__ import division
+
+from scipy.ndimage import map_coordinates
+import numpy as np
+
+# Direction -> offset of the input pixel (rows, cols), see 'shift_image'
+SHIFTS = [('up', (1, 0)), ('left', (0, 1)), ('right', (0, -1)), ('down', (-1, 0))]
+
+def shift_image(image_stack, direction):
+    """
+    Overview:
+        Moves every image in 'image_stack' one pixel in 'direction',
+        filling the uncovered border w/ zeros (same as convolving w/
+        the old move_up/move_left/... kernels in 'constant' mode).
+    ----------
+    image_stack: numpy array
+        A numpy array whose last two axes are (length, width)
+
+    direction: string
+        One of 'up', 'left', 'right' or 'down'
+
+    Returns
+    -------
+    shifted: numpy array
+        A numpy array of the same shape and dtype as 'image_stack'
+    """
+    shifted = np.zeros_like(image_stack)
+    if direction == 'up':
+        shifted[..., :-1, :] = image_stack[..., 1:, :]
+    elif direction == 'down':
+        shifted[..., 1:, :] = image_stack[..., :-1, :]
+    elif direction == 'left':
+        shifted[..., :, :-1] = image_stack[..., :, 1:]
+    elif direction == 'right':
+        shifted[..., :, 1:] = image_stack[..., :, :-1]
+    else:
+        raise ValueError('Unknown direction ' + str(direction))
+    return shifted
+
+def random_clip_generator(image_stack, batched=False, max_angle=30):
+    """
+    Overview:
+        This function randomly translates and rotates all image frames
+        (and color channels) of a sample in the same direction, producing
+        a new, altered version as output.
+    ----------
+    image_stack: numpy array
+        A sample of shape (..., length, width), e.g. (C, T, length, width)
+        or (C, length, width). If 'batched' is true the first axis indexes
+        samples, e.g. (batchsize, C, T, length, width).
+
+    batched: boolean
+        Defaults to false. If true each sample along the first axis gets
+        its own random shift and rotation (all samples are still
+        resampled in one call).
+
+    max_angle: int
+        Rotations are drawn uniformly from [-max_angle, max_angle] degrees
+
+    Returns
+    -------
+    new_image: numpy array
+        A numpy array of the same shape as 'image_stack' that is the
+        randomly rotated version of 'image_stack'
+    """
+    stack = image_stack if batched else image_stack[np.newaxis]
+    num_samps, length, width = stack.shape[0], stack.shape[-2], stack.shape[-1]
+    planes = stack.reshape(num_samps, -1, length, width)
+    num_planes = planes.shape[1]
+
+    # Pick a random direction to move for each sample.
+    offsets = np.array([offset for _, offset in SHIFTS])[np.random.randint(0, 4, num_samps)]
+
+    # Pick a random angle to rotate (30 degrees clockwise to 30 degrees counter-clockwise).
+    angles = np.deg2rad(np.random.randint(-max_angle, max_angle + 1, num_samps))
+
+    # Input position of every output pixel: rotated about the plane's center 
+    # (like scipy.ndimage.rotate) and then shifted by one pixel
+    cos, sin = np.cos(angles)[:, None, None], np.sin(angles)[:, None, None]
+    center_row, center_col = (length - 1) / 2, (width - 1) / 2
+    rows, cols = np.mgrid[0:length, 0:width]
+    rows, cols = rows - center_row, cols - center_col
+    coords = np.empty((4, num_samps, num_planes, length, width))
+    coords[0] = np.arange(num_samps)[:, None, None, None]
+    coords[1] = np.arange(num_planes)[None, :, None, None]
+    coords[2] = (cos * rows + sin * cols + center_row + offsets[:, 0, None, None])[:, None]
+    coords[3] = (-sin * rows + cos * cols + center_col + offsets[:, 1, None, None])[:, None]
+
+    # Sample and plane coordinates are whole numbers, where the spline 
+    # reproduces the data exactly - nothing is mixed across planes or samples
+    new_image = map_coordinates(planes, coords, order=3, mode='constant', cval=0.)
+    return new_image.reshape(image_stack.shape)
+
+def random_image_generator(image_stack):
+    """
+    Overview:
+        This function randomly translates and rotates multiple
+        image frames (all in same direction), producing a new,
+        altered version as output.
+    ----------
+    image_stack: numpy array
+        A numpy array of shape (num_channels, num_frames, length, width)
+
+    Returns
+    -------
+    new_image: numpy array
+        A numpy array of shape (num_channels, num_frames, length, width)
+        that is the randomly rotated version of 'image_stack'
+    """
+    return random_clip_generator(image_stack)
+
+def random_2D_image_generator(image):
+    """
+    Overview:
+        This function randomly rotates an image
+    ----------
+    image: numpy array
+        A numpy array of shape (num_channels, length, width)
+
+    Returns
+    -------
+    new_image: numpy array
+        A numpy array of shape (num_channels, length, width)
+        that is the randomly rotated version of 'image'
+    """
+    return random_clip_generator(image)
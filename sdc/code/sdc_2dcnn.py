@@ -29,13 +29,24 @@ from theano.tensor import *
 
 from lasagne.nonlinearities import rectify
 from lasagne.layers import InputLayer, DenseLayer, DropoutLayer
-from lasagne.layers.dnn import Conv2DDNNLayer, BatchNormLayer
+from lasagne.layers import BatchNormLayer
+from backend import Conv2DLayer
+from lasagne.objectives import squared_error
 from lasagne.updates import adam, nesterov_momentum
 from lasagne import layers
 
 from random_image_generator import * 
 from load_comma_data import *
 from training_helper_fns import * 
+from shared_data import SharedDataset, compile_indexed_fns, iterate_shared_batches
+from trainer import Trainer, EarlyStopping, SaveWeights, build_objectives, stratified_subsample, compile_fns, mean_squared_error
+from telemetry import timed
+from function_cache import cached_compile
+from autotune import tuned_batch_size
+from frame_filter import load_filtered_index, drive_name
+from large_batch import compile_accumulating_fns
+from varying_learning_rates import shared_learning_rate, find_shared_var, ReduceOnPlateau, TimeToTarget
+from varying_learning_rates import LearningRateScheduler, named_schedule
 
 def build_cnn(input_var, dim1, dim2):
     """
@@ -57,15 +68,15 @@ def build_cnn(input_var, dim1, dim2):
     net['norm'] = BatchNormLayer(net['input'])
 
     # ----------- Conv layer group ---------------
-    net['conv1a'] = Conv2DDNNLayer(net['norm'], 24, (5,5), stride=(2, 2), nonlinearity=rectify,flip_filters=False)
+    net['conv1a'] = Conv2DLayer(net['norm'], 24, (5,5), stride=(2, 2), nonlinearity=rectify,flip_filters=False)
     
-    net['conv2a'] = Conv2DDNNLayer(net['conv1a'], 36, (5,5), stride=(2, 2), nonlinearity=rectify)
+    net['conv2a'] = Conv2DLayer(net['conv1a'], 36, (5,5), stride=(2, 2), nonlinearity=rectify)
 
-    net['conv3a'] = Conv2DDNNLayer(net['conv2a'], 48, (3,3), stride=(2, 2), nonlinearity=rectify)
+    net['conv3a'] = Conv2DLayer(net['conv2a'], 48, (3,3), stride=(2, 2), nonlinearity=rectify)
 
-    net['conv4a'] = Conv2DDNNLayer(net['conv3a'], 64, (3,3), stride=(2, 2), nonlinearity=rectify)
+    net['conv4a'] = Conv2DLayer(net['conv3a'], 64, (3,3), stride=(2, 2), nonlinearity=rectify)
 
-    net['conv5a'] = Conv2DDNNLayer(net['conv4a'], 64, (3,3), nonlinearity=rectify)
+    net['conv5a'] = Conv2DLayer(net['conv4a'], 64, (3,3), nonlinearity=rectify)
     
     # ----------------- Dense Layers -----------------
     net['fc1']  = DenseLayer(net['conv5a'], num_units=500, nonlinearity=rectify)
@@ -94,8 +105,7 @@ if __name__ == '__main__':
     # sys.setrecursionlimit(10000)
 
     X_val, y_val, speed_val = load_data_label(paths_val)
-    # X_val = X_val /= 255
-    # X_val = X_val.astype(np.float32) #runs out of memory 
+    # Keep X_val as uint8 - 'iterate_minibatches2d' converts one batch at a time 
     y_val = y_val.astype(np.float32)
 
     # Fit model 
@@ -104,78 +114,114 @@ if __name__ == '__main__':
     target_var = T.fvector('targets')
     network = build_cnn(input_var, 160, 320)['output']
 
-        # Create loss function
-    prediction = lasagne.layers.get_output(network)
-    loss = lasagne.objectives.squared_error(prediction, target_var)
-    loss = loss.mean()
-
-        # Create parameter update expressions (later I will make rates adaptive)
-    params = lasagne.layers.get_all_params(network, trainable=True)
-    # updates = nesterov_momentum(loss, params, learning_rate=0.01,
-    #                                         momentum=0.9)
-    updates = adam(loss, params)
-    test_prediction = lasagne.layers.get_output(network, deterministic=True)
-    test_loss = lasagne.objectives.squared_error(test_prediction, target_var)
-    test_loss = test_loss.mean()
-    #Delete this - same 
-    test_acc = T.mean(lasagne.objectives.squared_error(test_prediction, target_var),
-                  dtype=theano.config.floatX)
+        # Create loss function and parameter update expressions
+    learning_rate = shared_learning_rate(.001) # Shared so schedules can change it 
+    loss, updates, val_outputs = build_objectives(network, target_var, squared_error, mean_squared_error, learning_rate=learning_rate)
+
+    # If true, each drive lives in theano.shared storage (as uint8) and the 
+    # functions take a batch index. Note: no augmentation in this mode 
+    use_shared_data = False 
+
+    # Cheap validation on a fixed, label-stratified quarter of the validation 
+    # set in between full passes (only w/o shared data)
+    val_subsample = stratified_subsample(y_val, .25)
+    subsample_val_batches = None 
+
+    # Throughput-optimal batch size on this machine if 'autotune.py' has been run 
+    # for this model, 16 otherwise 
+    batchsize = tuned_batch_size('sdc_2dcnn', X_val.shape[1:])
+
+    # Frames kept by 'frame_filter.py' (no stops or near-duplicates), w/ and w/o 
+    # shared data. Drives w/o an entry use all of their frames 
+    kept_frames = load_filtered_index('../data/camera/filtered_index.npz')
+
+    # Most frames are driven straight: each epoch draws epoch_fraction of every drive 
+    # w/ a probability ~ 1 / (frames in its 5 degree angle bin) ** angle_balance 
+    # (0 keeps the natural distribution, 1 draws every bin equally often). Only 
+    # used w/o shared data, validation always sees the natural distribution. 0 and 
+    # 1. train on every (kept) frame once per epoch, in random order 
+    angle_balance = 0 
+    epoch_fraction = 1. 
+
+    # Effective batch size is batchsize * accum_steps: the gradients of 'accum_steps' 
+    # micro-batches in each training batch are summed in one Theano call before its 
+    # adam step (learning rate scaled w/ the batch size and warmed up). Only used w/o shared data 
+    accum_steps = 1 
+    train_batchsize = batchsize * accum_steps 
 
     # Compile training function that updates parameters and returns training loss
-    train_fn = theano.function([input_var, target_var], loss, updates=updates)
-    val_fn = theano.function([input_var, target_var], [test_loss, test_acc])
-
-    num_epochs = 8000 # Will probably not do this many b/c of early stopping 
-    best_network_weights_epoch = 0 
-    epoch_accuracies = [] 
-    # Train network 
-    # In each epoch, we do a full pass over the training data:
-    for epoch in range(num_epochs):
-    	for train_data_path in all_paths_train:
-    		X_train, y_train, speed = load_data_label(train_data_path) #Y is angle 
-    		y_train = y_train.astype(np.float32)
-
-	        train_err = 0
-	        train_batches = 0
-	        for batch in iterate_minibatches2d(X_train, y_train, 16, shuffle=True):
-	            inputs, targets = batch
-	            train_err += train_fn(inputs, targets)
-	            train_batches += 1
-
-        # And a full pass over the validation data:
-        val_err = 0
-        val_acc = 0
-        val_batches = 0
-        for batch in iterate_minibatches2d(X_val, y_val, 16, shuffle=False):#TODO FIX - ROTATIING VAL SET 
-            inputs, targets = batch
-            err, acc = val_fn(inputs, targets)
-            val_err += err
-            val_acc += acc
-            val_batches += 1
-
-        # Print the results for this epoch:
-        print("  training loss:\t\t{:.6f}".format(train_err / train_batches))
-        print("  validation loss:\t\t{:.6f}".format(val_err / val_batches))
-        print("  validation accuracy:\t\t{:.2f}".format(
-            val_acc / val_batches * 100))
-        print("Current Epoch = " + str(epoch))
-        
-        # Check if we are starting to overfit  
-        if stop_early(val_acc, epoch_accuracies): 
-            # Save best weights in models directory
-            best_weight_path = '../data/weights/train/' + '2dcnn' + str(best_network_weights_epoch) + '.npz'
-            os.rename(best_weight_path, '../data/weights/best' + '2dcnn' + str(best_network_weights_epoch) + '.npz')
-            break   
-
-        epoch_accuracies.append(val_acc)
-
-        # Save weights every 100 epochs or if best weights.  
-        save_weights(network, epoch, val_acc, epoch_accuracies) 
-
-        # Update best weights  
-        if val_acc >= np.max(epoch_accuracies):
-            best_network_weights_epoch = epoch # This epoch is best so far  
+    if use_shared_data:
+        X_train, y_train, speed = load_data_label(all_paths_train[0])
+        train_data = SharedDataset(X_train, y_train.astype(np.float32), batchsize, scale=255)
+        val_data = SharedDataset(X_val, y_val, batchsize, scale=255)
+        train_fn, val_fn = compile_indexed_fns(input_var, target_var, loss, updates, 
+                                               val_outputs, train_data, val_data)
+    else:
+        # Reuse the compiled functions of an earlier run of the same model if possible
+        network, (train_fn, val_fn) = cached_compile('sdc_2dcnn', network, [input_var, target_var], 
+                                                     [loss] + val_outputs + list(updates.values()), 
+                                                     lambda: compile_fns(input_var, target_var, loss, updates, val_outputs) 
+                                                             if accum_steps == 1 else 
+                                                             compile_accumulating_fns(network, input_var, target_var, loss, val_outputs, accum_steps, batchsize, 
+                                                                                      learning_rate=learning_rate), 
+                                                     flags='accum{}x{}'.format(accum_steps, batchsize))
+
+    # In each epoch, we do a full pass over the training data (one drive at a time). 
+    # The next drive is loaded in the background while training on the current one 
+    def train_batches(epoch):
+        for train_data_path in all_paths_train:
+            with timed('load_data'):
+                X_train, y_train, speed = load_data_label(train_data_path) #Y is angle 
+            y_train = y_train.astype(np.float32)
+            frames = kept_frames.get(drive_name(train_data_path), np.arange(len(y_train)))
+            if use_shared_data:
+                train_data.set_data(X_train[frames], y_train[frames])
+                batch_iter = iterate_shared_batches(train_data, shuffle=True)
+            else:
+                if angle_balance or epoch_fraction != 1:
+                    weights = angle_sample_weights(y_train[frames], balance=angle_balance)
+                    order = frames[balanced_angle_order(weights, epoch_fraction)]
+                else:
+                    order = np.random.permutation(frames)
+                batch_iter = iterate_minibatches2d(X_train, y_train, train_batchsize, indcs=order)
+            for batch in batch_iter:
+                yield batch
+
+    def val_batches(epoch):
+        if use_shared_data:
+            return iterate_shared_batches(val_data)
+        return iterate_minibatches2d(X_val, y_val, batchsize, shuffle=False, augment=False)
+
+    if not use_shared_data:
+        X_val_sub, y_val_sub = X_val[val_subsample], y_val[val_subsample]
+        def subsample_val_batches(epoch):
+            return iterate_minibatches2d(X_val_sub, y_val_sub, batchsize, shuffle=False, augment=False)
+
+    # Halve the learning rate when validation loss plateaus (lr_schedule = None) or 
+    # follow a fixed 'step', 'cosine' or 'one_cycle' schedule over 'schedule_epochs' 
+    # epochs, and log how long it takes to reach the target loss (the cached 
+    # functions hold their own copy of the learning rate variable) 
+    lr_schedule = None 
+    schedule_epochs = 500 
+    learning_rate = find_shared_var(train_fn, 'learning_rate')
+    if lr_schedule is None:
+        scheduler = ReduceOnPlateau(learning_rate, patience=20)
+    else:
+        scheduler = LearningRateScheduler(learning_rate, named_schedule(lr_schedule, float(learning_rate.get_value()), 
+                                                                        schedule_epochs))
+    timer = TimeToTarget(monitor='valid_loss', target=.05)
+
+    # Train network. Weights are saved every 100 epochs or if best weights and 
+    # the best ones end up in the best weights directory 
+    saver = SaveWeights(network, '../data/weights/train', '../data/weights/best', '2dcnn')
+    trainer = Trainer(train_fn, val_fn, 
+                      on_epoch_finished=[saver, scheduler, timer, EarlyStopping(patience=200)], 
+                      on_training_finished=[saver.finish], 
+                      prefetch=0 if use_shared_data else 2, 
+                      telemetry_path='../data/weights/2dcnn_telemetry.jsonl') # Summarize w/ 'telemetry.py' 
+    trainer.fit(train_batches, val_batches, num_epochs=8000, 
+                subsample_val_batches=subsample_val_batches, full_val_every=10) # Will probably not do this many b/c of early stopping 
 
     # Save Model (Not doing anymore - just use 'load_3dcnn_model' instead)
     # with open('../model/network.pickle', 'wb') as f:
-    #     pickle.dump(network, f, -1)
\ No newline at end of file
+    #     pickle.dump(network, f, -1)
@@ -28,13 +28,24 @@ from theano.tensor import *
 
 from lasagne.nonlinearities import rectify
 from lasagne.layers import InputLayer, DenseLayer, DropoutLayer
-from lasagne.layers.dnn import Conv3DDNNLayer, MaxPool3DDNNLayer
+from backend import Conv3DLayer, MaxPool3DLayer, BatchNormLayer
+from lasagne.objectives import squared_error
 from lasagne.updates import adam, nesterov_momentum
 from lasagne import layers
 
 from random_image_generator import * 
-
-def build_cnn(input_var, dim1, dim2):
+from shared_data import SharedDataset, compile_indexed_fns, iterate_shared_batches
+from trainer import Trainer, EarlyStopping, SaveWeights, build_objectives, stratified_subsample, compile_fns, mean_squared_error
+from telemetry import timed
+from function_cache import cached_compile
+from autotune import tuned_batch_size
+from large_batch import compile_accumulating_fns
+from data_parallel import DataParallelTrainFn, make_replica_fn
+from varying_learning_rates import shared_learning_rate, find_shared_var, ReduceOnPlateau, TimeToTarget
+from varying_learning_rates import LearningRateScheduler, named_schedule
+from weight_format import load_param_values, set_param_values
+
+def build_cnn(input_var, dim1=81, dim2=144):
     """
     Overview:
         Builds 3D spatio-temporal CNN model
@@ -55,19 +66,19 @@ def build_cnn(input_var, dim1, dim2):
     """
     net = {}
     net['input'] = InputLayer((None, 3, 10, dim1, dim2), input_var=input_var)
-    net['norm'] = lasagne.layers.dnn.BatchNormDNNLayer(net['input'])
+    net['norm'] = BatchNormLayer(net['input'])
 
     # ----------- 1st Conv layer group ---------------
-    net['conv1a'] = Conv3DDNNLayer(net['norm'], 16, (3,5,5), stride=(2, 2, 2), nonlinearity=rectify,flip_filters=False)
+    net['conv1a'] = Conv3DLayer(net['norm'], 16, (3,5,5), stride=(2, 2, 2), nonlinearity=rectify,flip_filters=False)
     
     # ------------- 2nd Conv layer group --------------
-    net['conv2a'] = Conv3DDNNLayer(net['conv1a'], 24, (1,5,5), stride=(2, 2, 2), nonlinearity=rectify)
+    net['conv2a'] = Conv3DLayer(net['conv1a'], 24, (1,5,5), stride=(2, 2, 2), nonlinearity=rectify)
 
-    net['conv3a'] = Conv3DDNNLayer(net['conv2a'], 32, (1,3,3), stride=(1, 2, 2), nonlinearity=rectify)
+    net['conv3a'] = Conv3DLayer(net['conv2a'], 32, (1,3,3), stride=(1, 2, 2), nonlinearity=rectify)
 
-    net['conv4a'] = Conv3DDNNLayer(net['conv3a'], 64, (1,3,3), stride=(1, 2, 2), nonlinearity=rectify)
+    net['conv4a'] = Conv3DLayer(net['conv3a'], 64, (1,3,3), stride=(1, 2, 2), nonlinearity=rectify)
 
-    net['conv5a'] = Conv3DDNNLayer(net['conv4a'], 64, (1,3,3), nonlinearity=rectify)
+    net['conv5a'] = Conv3DLayer(net['conv4a'], 64, (1,3,3), nonlinearity=rectify)
     
 
     # ----------------- Dense Layers -----------------
@@ -79,7 +90,7 @@ def build_cnn(input_var, dim1, dim2):
     net['output']  = DenseLayer(net['fc3'], num_units=1, nonlinearity=None)
     return net
 
-def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
+def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=True):
     """
     Overview: 
         An iterator that randomly rotates or flips 3/4 of the 
@@ -101,6 +112,9 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
     shuffle: 
         Defaults to false. If true, the training data is
         shuffled.
+    augment: 
+        Defaults to true. If false, no samples are flipped or rotated 
+        (use this for validation).
     Returns
     -------
     batch_sample_input: numpy array
@@ -115,20 +129,25 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
     if shuffle:
         np.random.shuffle(indcs)
     for i in range(0, num_samps - batchsize + 1, batchsize): 
-        batch_indcs = indcs[i:(i + batchsize)]
-        batch_sample_input = inputs[batch_indcs]
-        batch_sample_target = targets[batch_indcs]
-
-        # This handles random orientation logic
-        num_changes = int(batchsize * .75) # Prop of samples we distort
-        distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
-
-        swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
-        flip_indcs = swap_indcs[0:distorts_per_cat]
-        rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
-        batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, :, ::-1] 
-        for i in rotate_indcs:
-            batch_sample_input[i, :, :, :, :] = random_image_generator(batch_sample_input[i, :, :, :, :])
+        with timed('index'):
+            batch_indcs = indcs[i:(i + batchsize)]
+            batch_sample_input = inputs[batch_indcs]
+            batch_sample_target = targets[batch_indcs]
+
+        if not augment:
+            yield batch_sample_input, batch_sample_target
+            continue
+
+        with timed('augment'):
+            # This handles random orientation logic
+            num_changes = int(batchsize * .75) # Prop of samples we distort
+            distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
+
+            swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
+            flip_indcs = swap_indcs[0:distorts_per_cat]
+            rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
+            batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, :, ::-1] 
+            batch_sample_input[rotate_indcs] = random_clip_generator(batch_sample_input[rotate_indcs], batched=True)
         yield batch_sample_input, batch_sample_target
 
 # This function was taken from:
@@ -142,8 +161,9 @@ def load_3dcnn_model(path_to_weights):
     path_to_weights: string   
         This should be the path where the weights are located. 
         This should be a .npz file consisting of weights for each
-        layer. See the function 'save_network_weights' below for 
-        more details of this format. 
+        layer (as saved by 'SaveWeights' in 'trainer.py') or a 
+        memory-mapped weight file (see 'weight_format.py'), which 
+        loads near-instantly. 
     Returns
     -------
     network: Lasagne object 
@@ -152,87 +172,9 @@ def load_3dcnn_model(path_to_weights):
     dtensor5 = TensorType('float32', (False,)*5)
     input_var = dtensor5('inputs')
     network = build_cnn(input_var)['output']
-    with np.load(path_to_weights) as f:
-        param_values = [f['arr_%d' % i] for i in range(len(f.files))]
-    lasagne.layers.set_all_param_values(network, param_values)
+    set_param_values(network, load_param_values(path_to_weights))
     return network
 
-def stop_early(curr_val_acc, val_acc_list, patience=200):
-    """
-    Overview: 
-        This implements the early stopping logic for training.  
-    ----------
-    curr_val_acc: float    
-        The accuracy for the current epoch 
-    val_acc_list: array    
-        List of accuracies for past epochs
-    patience: int   
-        How many epochs to look back in order to compare 
-        'curr_val_acc'  
-    Returns
-    -------
-    boolean: True or False 
-        If true this means that the network should halt. Otherwise, 
-        the network should continue training.   
-    """
-    num_epochs = len(val_acc_list)
-    if num_epochs < patience:
-        return False 
-    else:
-        prev_acc = val_acc_list[num_epochs - patience]
-        if prev_acc > curr_val_acc:
-            print('Early Stopping')
-            return True 
-        else:
-            return False 
-
-def save_network_weights(path, network):
-    """
-    Overview: 
-        This saves the weights for each layer in the network
-        in a .npz file  
-    ----------
-    path: string   
-        Location of where to store the weights 
-    network: Lasagne object
-        The network from which the weights will be extracted from   
-    Returns
-    -------
-    None  
-    """
-    np.savez(path, *lasagne.layers.get_all_param_values(network))
-
-def save_weights(network, epoch, curr_val_acc, val_acc_list, multiple=100):
-    """
-    Overview: 
-        This saves the weights for each layer in the network
-        in a .npz file at multiples of 'multiple' or if the 
-        curr_val_acc is the best accuracy so far. The weights are saved 
-        in '../data/train/weights/cnnEPOCH.npz' 
-    ----------
-    network: string   
-        The network from which the weights will be extracted from 
-    epoch: int
-        The current epoch of training 
-    curr_val_acc: 
-        The accuracy for the current epoch
-    
-    val_acc_list:
-        List of accuracies for past epochs
-    multiple:
-        Defaults at 100. Specifies the cycle time for 
-        saving wieghts. 
-    Returns
-    -------
-    None:
-        Prints if it saves weights and specifies the epoch  
-    """
-    # Save weights every 20 epochs to server (transport to s3 eventually)
-    if epoch % multiple == 0 or curr_val_acc > np.max(val_acc_list):
-        weight_path = './cnn_weights/' + str(epoch)
-        save_network_weights(weight_path, network)
-        print('Saved Weights for ' + str(epoch))
-
 if __name__ == '__main__':
 
     # Might need to increase Python's recursion limit (I didn't need to)
@@ -268,72 +210,95 @@ if __name__ == '__main__':
     target_var = T.fvector('targets')
     network = build_cnn(input_var)['output']
 
-    # Create loss function
-    prediction = lasagne.layers.get_output(network)
-    loss = lasagne.objectives.squared_error(prediction, target_var)
-    loss = loss.mean()
-
-    # Create parameter update expressions (later I will make rates adaptive)
-    params = lasagne.layers.get_all_params(network, trainable=True)
-    # updates = nesterov_momentum(loss, params, learning_rate=0.01,
-    #                                         momentum=0.9)
-    updates = adam(loss, params)
-    test_prediction = lasagne.layers.get_output(network, deterministic=True)
-    test_loss = lasagne.objectives.squared_error(test_prediction, target_var)
-    test_loss = test_loss.mean()
-    test_acc = T.mean(lasagne.objectives.squared_error(test_prediction, target_var),
-                  dtype=theano.config.floatX)
+    # Create loss function and parameter update expressions
+    learning_rate = shared_learning_rate(.001) # Shared so schedules can change it 
+    loss, updates, val_outputs = build_objectives(network, target_var, squared_error, mean_squared_error, learning_rate=learning_rate)
+
+    # If true, the data lives in theano.shared storage and the functions take a 
+    # batch index. Note: no augmentation in this mode 
+    use_shared_data = False 
+
+    # Cheap validation on a fixed, label-stratified quarter of the validation 
+    # set in between full passes (only w/o shared data)
+    val_subsample = stratified_subsample(y_val, .25)
+    subsample_val_batches = None 
+
+    # Throughput-optimal batch size on this machine if 'autotune.py' has been run 
+    # for this model, 16 otherwise 
+    batchsize = tuned_batch_size('sdc_3dcnn', X_train.shape[1:])
+
+    # Effective batch size is batchsize * accum_steps: the gradients of 'accum_steps' 
+    # micro-batches in each training batch are summed in one Theano call before its 
+    # adam step (learning rate scaled w/ the batch size and warmed up). Only used w/o shared data 
+    accum_steps = 1 
+    train_batchsize = batchsize * accum_steps 
+
+    # >1 trains w/ this many CPU worker processes that share each minibatch 
+    # (see 'data_parallel.py' - start w/ OMP_NUM_THREADS=1). Only used w/o shared data 
+    num_workers = 1 
 
     # Compile training function that updates parameters and returns training loss
-    train_fn = theano.function([input_var, target_var], loss, updates=updates)
-    val_fn = theano.function([input_var, target_var], [test_loss, test_acc])
-
-    num_epochs = 8000 # Will probably not do this many b/c of early stopping 
-    best_network_weights_epoch = 0 
-    epoch_accuracies = [] 
-    # Train network 
-    for epoch in range(num_epochs):
-        # In each epoch, we do a full pass over the training data:
-        train_err = 0
-        train_batches = 0
-        for batch in iterate_minibatches(X_train, y_train, 16, shuffle=True):
-            inputs, targets = batch
-            train_err += train_fn(inputs, targets)
-            train_batches += 1
-
-        # And a full pass over the validation data:
-        val_err = 0
-        val_acc = 0
-        val_batches = 0
-        for batch in iterate_minibatches(X_val, y_val, 16, shuffle=False):#TODO FIX - ROTATIING VAL SET 
-            inputs, targets = batch
-            err, acc = val_fn(inputs, targets)
-            val_err += err
-            val_acc += acc
-            val_batches += 1
-
-        # Print the results for this epoch:
-        print("  training loss:\t\t{:.6f}".format(train_err / train_batches))
-        print("  validation loss:\t\t{:.6f}".format(val_err / val_batches))
-        print("  validation accuracy:\t\t{:.2f}".format(
-            val_acc / val_batches * 100))
-        print("Current Epoch = " + str(epoch))
-        
-        # Check if we are starting to overfit  
-        if stop_early(val_acc, epoch_accuracies): 
-            # Save best weights in models directory
-            best_weight_path = './cnn_weights/' + str(best_network_weights_epoch) + '.npz'
-            os.rename(best_weight_path, './models/cnn' + str(best_network_weights_epoch) + '.npz')
-            break   
-
-        epoch_accuracies.append(val_acc)
-
-        # Save weights every 100 epochs or if best weights.  
-        save_weights(network, epoch, val_acc, epoch_accuracies) 
-
-        # Update best weights  
-        if val_acc >= np.max(epoch_accuracies):
-            best_network_weights_epoch = epoch # This epoch is best so far  
+    if use_shared_data:
+        train_data = SharedDataset(X_train, y_train, batchsize)
+        val_data = SharedDataset(X_val, y_val, batchsize)
+        train_fn, val_fn = compile_indexed_fns(input_var, target_var, loss, updates, 
+                                               val_outputs, train_data, val_data)
+
+        def train_batches(epoch):
+            return iterate_shared_batches(train_data, shuffle=True)
+
+        def val_batches(epoch):
+            return iterate_shared_batches(val_data)
+    else:
+        if num_workers > 1:
+            replica_fn = make_replica_fn(build_cnn, dtensor5, T.fvector, squared_error)
+            train_fn = DataParallelTrainFn(replica_fn, network, X_train.shape[1:], np.float32, num_workers, 
+                                           max_batchsize=train_batchsize, learning_rate=learning_rate)
+            val_fn = theano.function([input_var, target_var], val_outputs)
+        else:
+            # Reuse the compiled functions of an earlier run of the same model if possible
+            network, (train_fn, val_fn) = cached_compile('sdc_3dcnn', network, [input_var, target_var], 
+                                                         [loss] + val_outputs + list(updates.values()), 
+                                                         lambda: compile_fns(input_var, target_var, loss, updates, val_outputs) 
+                                                                 if accum_steps == 1 else 
+                                                                 compile_accumulating_fns(network, input_var, target_var, loss, val_outputs, accum_steps, batchsize, 
+                                                                                          learning_rate=learning_rate), 
+                                                         flags='accum{}x{}'.format(accum_steps, batchsize))
+
+        def train_batches(epoch):
+            return iterate_minibatches(X_train, y_train, train_batchsize, shuffle=True)
+
+        def val_batches(epoch):
+            return iterate_minibatches(X_val, y_val, batchsize, shuffle=False, augment=False)
+
+        X_val_sub, y_val_sub = X_val[val_subsample], y_val[val_subsample]
+        def subsample_val_batches(epoch):
+            return iterate_minibatches(X_val_sub, y_val_sub, batchsize, shuffle=False, augment=False)
+
+    # Halve the learning rate when validation loss plateaus (lr_schedule = None) or 
+    # follow a fixed 'step', 'cosine' or 'one_cycle' schedule over 'schedule_epochs' 
+    # epochs, and log how long it takes to reach the target loss (the cached 
+    # functions hold their own copy of the learning rate variable) 
+    lr_schedule = None 
+    schedule_epochs = 500 
+    learning_rate = find_shared_var(train_fn, 'learning_rate')
+    if lr_schedule is None:
+        scheduler = ReduceOnPlateau(learning_rate, patience=20)
+    else:
+        scheduler = LearningRateScheduler(learning_rate, named_schedule(lr_schedule, float(learning_rate.get_value()), 
+                                                                        schedule_epochs))
+    timer = TimeToTarget(monitor='valid_loss', target=.05)
+
+    # Train network. Weights are saved every 100 epochs or if best weights and 
+    # the best ones end up in the best weights directory 
+    saver = SaveWeights(network, '../data/weights/train', '../data/weights/best', '3dcnn')
+    trainer = Trainer(train_fn, val_fn, 
+                      on_epoch_finished=[saver, scheduler, timer, EarlyStopping(patience=200)], 
+                      on_training_finished=[saver.finish] + ([train_fn.close] if num_workers > 1 else []), 
+                      prefetch=0 if use_shared_data else 2, 
+                      telemetry_path='../data/weights/3dcnn_telemetry.jsonl') # Summarize w/ 'telemetry.py' 
+    trainer.fit(train_batches, val_batches, num_epochs=8000, 
+                subsample_val_batches=subsample_val_batches, full_val_every=10) # Will probably not do this many b/c of early stopping 
 
     # Save Model (Not doing anymore - just use 'load_3dcnn_model' instead)
     # with open('../model/network.pickle', 'wb') as f:
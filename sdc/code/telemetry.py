@@ -0,0 +1,153 @@
+# Per-phase timing of the training loops. The batch iterators wrap their
+# hot spots (loading, indexing, augmentation) in timed('phase') and the
+# Trainer (see trainer.py) adds the time spent in train_fn/val_fn, waiting
+# for data and in callbacks. With a telemetry path, the Trainer appends
+# one JSON record per epoch.
+
+# The batch iterators run on the prefetch thread, so their phases overlap
+# w/ train_fn. Only 'data_wait' (train_fn idle, waiting for a batch) is
+# lost time - it is reported as the data-stall percentage.
+
+# Usage: $python telemetry.py RUN.jsonl summarizes where the wall time went
+
+from __future__ import division
+
+import sys
+import json
+import time
+import timeit
+import threading
+
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+class PhaseTimer(object):
+    """
+    Sums the wall time and the number of calls of each named phase
+    (thread-safe)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += 1
+
+    @contextmanager
+    def phase(self, name):
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add(name, timeit.default_timer() - start)
+
+    def pop(self):
+        """
+        Returns {phase: {'seconds': ..., 'calls': ...}} since the last
+        pop and starts over
+        """
+        with self.lock:
+            phases = dict((name, {'seconds': self.seconds[name], 'calls': self.calls[name]})
+                          for name in self.seconds)
+            self.seconds = defaultdict(float)
+            self.calls = defaultdict(int)
+        return phases
+
+# The process-wide timer that the batch iterators report to
+phase_timer = PhaseTimer()
+
+def timed(name):
+    """
+    Times a block as phase 'name', e.g. w/ timed('augment'): ...
+    """
+    return phase_timer.phase(name)
+
+class TelemetryLog(object):
+    """
+    Overview:
+        Appends records to a JSONL file, each tagged w/ the run (its
+        start time unless given).
+    ----------
+    path: string
+        E.g. '../data/train/3d_cnn_telemetry.jsonl'
+
+    run: string
+        Groups the records of one training run
+    """
+    def __init__(self, path, run=None):
+        self.path = path
+        self.run = run or time.strftime('%Y-%m-%d %H:%M:%S')
+
+    def write(self, record):
+        record = dict(record, run=self.run)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+def summarize(records):
+    """
+    Overview:
+        Splits the wall time of epoch records (see 'Trainer.fit') into
+        its phases.
+    ----------
+    records: list
+        Epoch records of one run
+
+    Returns
+    -------
+    summary: OrderedDict
+        'wall_time', 'epochs', 'samples_per_sec' (mean), 'data_stall_pct'
+        (of the training time), 'phases' (seconds of train_fn, data stall,
+        loop overhead, validation, callbacks and the rest - these add up to
+        the wall time) and 'background' (seconds of the iterator phases)
+    """
+    def total(key):
+        return sum(r.get(key, 0) for r in records)
+    train_time = total('train_time')
+    phases = OrderedDict([('train_fn', total('train_fn_time')),
+                          ('data stall', total('data_wait')),
+                          ('loop overhead', train_time - total('train_fn_time') - total('data_wait')),
+                          ('validation', total('val_time')),
+                          ('callbacks', total('callback_time')),
+                          ('other', total('epoch_time') - train_time - total('val_time'))])
+    background = defaultdict(float)
+    for record in records:
+        for name, phase in record.get('phases', {}).items():
+            background[name] += phase['seconds']
+    speeds = [r['samples_per_sec'] for r in records if 'samples_per_sec' in r]
+    return OrderedDict([('wall_time', total('epoch_time') + total('callback_time')),
+                        ('epochs', len(records)),
+                        ('samples_per_sec', sum(speeds) / len(speeds) if speeds else None),
+                        ('data_stall_pct', 100 * total('data_wait') / max(train_time, 1e-12)),
+                        ('phases', phases),
+                        ('background', OrderedDict(sorted(background.items(), key=lambda p: -p[1])))])
+
+def report(path):
+    """
+    Prints a summary of every run in the JSONL file at 'path'
+    """
+    runs = OrderedDict()
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                runs.setdefault(record.get('run'), []).append(record)
+    for run, records in runs.items():
+        summary = summarize(records)
+        wall = max(summary['wall_time'], 1e-12)
+        print('Run {}: {} epochs, {:.1f}s'.format(run, summary['epochs'], summary['wall_time']))
+        if summary['samples_per_sec'] is not None:
+            print('  training speed:\t{:.1f} samples / sec'.format(summary['samples_per_sec']))
+        print('  data stall:\t\t{:.1f} % of training time'.format(summary['data_stall_pct']))
+        for name, seconds in summary['phases'].items():
+            print('  {:<16}{:10.1f}s{:8.1f} %'.format(name, seconds, 100 * seconds / wall))
+        if summary['background']:
+            print('  batch iterators (overlap w/ train_fn when prefetching):')
+            for name, seconds in summary['background'].items():
+                print('    {:<14}{:10.1f}s{:8.1f} %'.format(name, seconds, 100 * seconds / wall))
+
+if __name__ == '__main__':
+
+    report(sys.argv[1])
@@ -0,0 +1,37 @@
+# Checks that the angle-balanced epochs actually change the mix of steering
+# angles (not just the number of frames drawn).
+
+# Usage (from the code folder): $python -m pytest test_training_helper_fns.py
+
+from __future__ import division
+
+import numpy as np
+
+from training_helper_fns import angle_sample_weights, balanced_angle_order
+
+def _turning_share(balance, epoch_fraction=1.):
+    # 900 straight frames, 100 frames in a 20 degree turn
+    angles = np.concatenate([np.zeros(900), np.full(100, 20.)])
+    np.random.seed(0)
+    order = balanced_angle_order(angle_sample_weights(angles, balance=balance), epoch_fraction)
+    return np.mean(angles[order] != 0), len(order)
+
+def test_natural_distribution_wo_balance():
+    share, num_draws = _turning_share(0)
+    assert num_draws == 1000
+    assert abs(share - .1) < .03
+
+def test_partial_balance():
+    # Weights ~ 1 / sqrt(bin count): 100 / sqrt(100) vs 900 / sqrt(900) -> 1 in 4 turning
+    share, num_draws = _turning_share(.5)
+    assert num_draws == 1000
+    assert abs(share - .25) < .04
+
+def test_full_balance_draws_every_bin_equally():
+    share, _ = _turning_share(1)
+    assert abs(share - .5) < .04
+
+def test_epoch_fraction():
+    share, num_draws = _turning_share(1, epoch_fraction=.5)
+    assert num_draws == 500
+    assert abs(share - .5) < .06
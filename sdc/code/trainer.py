@@ -0,0 +1,547 @@
+# Shared training engine for the Lasagne models. Every training script used
+# to copy-paste the same epoch loop, early stopping and weight saving - they
+# now build their network/data and hand them to 'Trainer' instead.
+
+# The loop prefetches minibatches on a background thread so that loading and
+# augmenting the next batch overlaps w/ 'train_fn'. Callbacks follow the
+# nolearn convention (see 3d_cnn.py): they are called as
+# callback(trainer, history) after every epoch and raise StopIteration to halt.
+
+from __future__ import division
+
+import os
+import shutil
+import threading
+import timeit
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import lasagne
+import theano
+import theano.tensor as T
+
+from lasagne.updates import adam
+
+from checkpoint import CheckpointManager
+from weight_format import write_weight_file, load_param_values, param_names
+from telemetry import TelemetryLog, phase_timer
+
+def binary_accuracy(prediction, target_var):
+    """
+    Accuracy for +/-1 labels w/ a hinge loss
+    """
+    return T.mean(T.eq(T.sgn(prediction), target_var), dtype=theano.config.floatX)
+
+def mean_squared_error(prediction, target_var):
+    """
+    Mean squared error (the 'accuracy' we report for steering angles)
+    """
+    return T.mean(lasagne.objectives.squared_error(prediction, target_var),
+                  dtype=theano.config.floatX)
+
+def build_objectives(network, target_var, objective, accuracy, update=adam, learning_rate=None,
+                     sample_losses=False):
+    """
+    Overview:
+        Creates the training loss, the parameter updates and the
+        validation outputs for 'network'.
+    ----------
+    network: Lasagne object
+        The output layer, e.g. build_cnn(input_var)['output']
+
+    target_var: Theano Tensor
+        The labels variable
+
+    objective: function
+        Elementwise loss, e.g. lasagne.objectives.binary_hinge_loss
+
+    accuracy: function
+        accuracy(test_prediction, target_var) -> scalar expression,
+        e.g. 'binary_accuracy' or 'mean_squared_error'
+
+    update: function
+        Defaults to adam. Any lasagne.updates function
+
+    learning_rate: Theano shared variable
+        Defaults to None ('update's default rate). Pass a shared variable
+        (see 'shared_learning_rate') to change the rate during training
+
+    sample_losses: boolean
+        Defaults to false. If true, the per-sample training losses (from
+        the same forward pass as 'loss') are returned too
+
+    Returns
+    -------
+    loss: Theano expression
+        Mean training loss
+
+    updates: OrderedDict
+        Parameter update expressions
+
+    val_outputs: list
+        [test_loss, test_acc] computed deterministically (no dropout)
+
+    sample_losses: Theano expression
+        Only if 'sample_losses' is true. A vector w/ one loss per sample
+    """
+    prediction = lasagne.layers.get_output(network)
+    loss = objective(prediction, target_var).mean()
+    params = lasagne.layers.get_all_params(network, trainable=True)
+    if learning_rate is None:
+        updates = update(loss, params)
+    else:
+        updates = update(loss, params, learning_rate=learning_rate)
+    test_prediction = lasagne.layers.get_output(network, deterministic=True)
+    test_loss = objective(test_prediction, target_var).mean()
+    test_acc = accuracy(test_prediction, target_var)
+    if sample_losses:
+        return loss, updates, [test_loss, test_acc], objective(prediction.flatten(), target_var)
+    return loss, updates, [test_loss, test_acc]
+
+def compile_fns(input_var, target_var, loss, updates, val_outputs):
+    """
+    Compiles train_fn(inputs, targets) -> loss and
+    val_fn(inputs, targets) -> val_outputs
+    """
+    train_fn = theano.function([input_var, target_var], loss, updates=updates)
+    val_fn = theano.function([input_var, target_var], val_outputs)
+    return train_fn, val_fn
+
+class _Failure(object):
+    """
+    Carries an exception from the prefetch thread to the training thread
+    """
+    def __init__(self, exception):
+        self.exception = exception
+
+def prefetch(iterable, num_batches=2):
+    """
+    Overview:
+        Runs 'iterable' on a background thread and keeps up to
+        'num_batches' items ready, so that producing the next minibatch
+        overlaps w/ the caller's work on the current one.
+    ----------
+    iterable: iterable
+        E.g. iterate_minibatches(X_train, y_train, 16, shuffle=True)
+
+    num_batches: int
+        Queue size. 0 disables prefetching.
+
+    Returns
+    -------
+    generator
+        Yields the items of 'iterable' in order
+    """
+    if num_batches <= 0:
+        for item in iterable:
+            yield item
+        return
+
+    items = queue.Queue(maxsize=num_batches)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(_Failure(e))
+            return
+        put(done)
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
+
+class Trainer(object):
+    """
+    Overview:
+        Runs the train/validate loop shared by all training scripts.
+    ----------
+    train_fn: Theano function
+        Called as train_fn(*batch) for every training batch, returns the loss.
+        If it has a 'finish_epoch' method, that is called after each pass
+        (before validation and the callbacks)
+
+    val_fn: Theano function
+        Called as val_fn(*batch) for every validation batch, returns
+        [loss, accuracy]
+
+    on_epoch_finished: list
+        Callbacks called as callback(trainer, history) after each epoch.
+        Raise StopIteration to stop training.
+
+    on_training_finished: list
+        Callbacks called as callback(trainer, history) once at the end
+
+    prefetch: int
+        Defaults to 2. Number of batches prepared ahead of 'train_fn' on
+        a background thread (use 0 w/ 'SharedDataset' batches)
+
+    verbose: boolean
+        If true, prints the results for each epoch
+
+    telemetry_path: string
+        If given, one JSON record per epoch (timings, phases of the batch
+        iterators, see 'telemetry.py') is appended to this file
+    """
+    def __init__(self, train_fn, val_fn, on_epoch_finished=None, on_training_finished=None,
+                 prefetch=2, verbose=True, telemetry_path=None):
+        self.train_fn = train_fn
+        self.val_fn = val_fn
+        self.on_epoch_finished = list(on_epoch_finished or [])
+        self.on_training_finished = list(on_training_finished or [])
+        self.prefetch = prefetch
+        self.verbose = verbose
+        self.telemetry = TelemetryLog(telemetry_path) if telemetry_path else None
+        self.history = []
+
+    def _run(self, fn, batches):
+        """
+        Calls 'fn' on every batch. Returns the summed outputs, the number of
+        batches, the number of samples (0 for index batches), the time spent
+        waiting for data, the time spent in 'fn' and the total time.
+        """
+        total = None
+        num_batches = 0
+        num_samples = 0
+        wait_time = 0
+        fn_time = 0
+        start = timeit.default_timer()
+        batch_iter = iter(prefetch(batches, self.prefetch))
+        while True:
+            wait_start = timeit.default_timer()
+            try:
+                batch = next(batch_iter)
+            except StopIteration:
+                break
+            fn_start = timeit.default_timer()
+            wait_time += fn_start - wait_start
+            outputs = np.asarray(fn(*batch), dtype=np.float64)
+            fn_time += timeit.default_timer() - fn_start
+            total = outputs if total is None else total + outputs
+            num_batches += 1
+            if np.ndim(batch[0]) > 0:
+                num_samples += len(batch[0])
+        return total, num_batches, num_samples, wait_time, fn_time, timeit.default_timer() - start
+
+    def train_epoch(self, epoch, train_batches):
+        """
+        Runs one pass of 'train_fn' and returns (mean loss, timing dict)
+        """
+        train_err, num_batches, num_samples, wait, fn_time, seconds = self._run(self.train_fn, train_batches(epoch))
+        if hasattr(self.train_fn, 'finish_epoch'):
+            self.train_fn.finish_epoch() # E.g. bring the network up to date before validation
+        timing = {'train_time': seconds, 'data_wait': wait, 'train_fn_time': fn_time,
+                  'data_stall_pct': 100 * wait / max(seconds, 1e-12), 'train_batches': num_batches}
+        if num_samples:
+            timing['samples_per_sec'] = num_samples / seconds
+        if num_batches == 0:
+            return np.nan, timing
+        return float(train_err) / num_batches, timing
+
+    def validate(self, epoch, val_batches):
+        """
+        Runs one pass of 'val_fn' and returns (mean loss, mean accuracy, seconds)
+        """
+        val_out, num_batches, num_samples, wait, fn_time, seconds = self._run(self.val_fn, val_batches(epoch))
+        if num_batches == 0:
+            return np.nan, np.nan, seconds
+        val_err, val_acc = val_out / num_batches
+        return float(val_err), float(val_acc), seconds
+
+    def validation_kind(self, epoch, num_epochs, val_every=1, full_val_every=1,
+                        subsample_val_batches=None):
+        """
+        Returns 'full', 'subsample' or None (no validation) for 'epoch'
+        """
+        if epoch % val_every != 0 and epoch != num_epochs - 1:
+            return None
+        if subsample_val_batches is None or epoch % full_val_every == 0:
+            return 'full'
+        return 'subsample'
+
+    def fit(self, train_batches, val_batches, num_epochs=8000, val_every=1,
+            subsample_val_batches=None, full_val_every=1):
+        """
+        Overview:
+            Trains for up to 'num_epochs' epochs.
+        ----------
+        train_batches: function
+            train_batches(epoch) -> iterable of argument tuples for
+            'train_fn', e.g.
+            lambda epoch: iterate_minibatches(X_train, y_train, 16, shuffle=True)
+
+        val_batches: function
+            val_batches(epoch) -> iterable of argument tuples for 'val_fn'
+
+        num_epochs: int
+            Defaults to 8000. Will probably not do this many b/c of
+            early stopping
+
+        val_every: int
+            Defaults to 1. Only validate every 'val_every' epochs (and
+            on the last one)
+
+        subsample_val_batches: function
+            Like 'val_batches' but over a fixed subsample of the validation
+            set (see 'stratified_subsample'). If given, it is used for the
+            validation points in between full passes.
+
+        full_val_every: int
+            Defaults to 1. Epochs that are a multiple of this get a full
+            validation pass when 'subsample_val_batches' is given
+
+        Returns
+        -------
+        history: list
+            One dict per epoch w/ 'epoch', 'train_loss' and timings (in
+            seconds, see 'telemetry.summarize'). Epochs that were validated
+            also have 'valid_loss', 'valid_accuracy' and 'valid_full'
+            (false for subsampled passes).
+        """
+        for epoch in range(len(self.history), num_epochs):
+            epoch_start = timeit.default_timer()
+            train_loss, record = self.train_epoch(epoch, train_batches)
+            record.update({'epoch': epoch, 'train_loss': train_loss, 'val_time': 0})
+
+            kind = self.validation_kind(epoch, num_epochs, val_every, full_val_every,
+                                        subsample_val_batches)
+            if kind is not None:
+                batches = val_batches if kind == 'full' else subsample_val_batches
+                valid_loss, valid_accuracy, val_time = self.validate(epoch, batches)
+                record.update({'valid_loss': valid_loss, 'valid_accuracy': valid_accuracy,
+                               'valid_full': kind == 'full', 'val_time': val_time})
+            record['epoch_time'] = timeit.default_timer() - epoch_start
+            self.history.append(record)
+
+            if self.verbose:
+                print("  training loss:\t\t{:.6f}".format(train_loss))
+                if kind is not None:
+                    print("  validation loss ({}):\t{:.6f}".format(kind, record['valid_loss']))
+                    print("  validation accuracy:\t\t{:.2f} %".format(record['valid_accuracy'] * 100))
+                print("  epoch time:\t\t{:.1f}s (data wait {:.1f}s = {:.0f} % stall, validation {:.1f}s)".format(
+                    record['epoch_time'], record['data_wait'], record['data_stall_pct'], record['val_time']))
+                if 'samples_per_sec' in record:
+                    print("  training speed:\t{:.1f} samples / sec".format(record['samples_per_sec']))
+                print("Current Epoch = " + str(epoch))
+
+            stop = False
+            callback_start = timeit.default_timer()
+            try:
+                for callback in self.on_epoch_finished:
+                    callback(self, self.history)
+            except StopIteration:
+                stop = True
+            record['callback_time'] = timeit.default_timer() - callback_start
+            record['phases'] = phase_timer.pop()
+            if self.telemetry is not None:
+                self.telemetry.write(record)
+            if stop:
+                break
+
+        if self.verbose and self.history:
+            total = sum(r['epoch_time'] for r in self.history)
+            val_total = sum(r['val_time'] for r in self.history)
+            print("Total time {:.1f}s, of which validation {:.1f}s ({:.1f} %)".format(
+                total, val_total, 100 * val_total / max(total, 1e-12)))
+
+        for callback in self.on_training_finished:
+            callback(self, self.history)
+        return self.history
+
+def stratified_subsample(targets, fraction, num_bins=10, seed=0):
+    """
+    Overview:
+        Picks a fixed subsample of the validation set that keeps the label
+        distribution. Discrete labels (e.g. +/-1) are stratified by value,
+        continuous ones (e.g. steering angles) by 'num_bins' quantile bins.
+    ----------
+    targets: numpy array
+        Validation labels of shape (num_val, )
+
+    fraction: float
+        Proportion of each stratum to keep
+
+    num_bins: int
+        Number of quantile bins for continuous labels
+
+    seed: int
+        The subsample is the same for every call w/ the same seed
+
+    Returns
+    -------
+    indcs: numpy array
+        Sorted indices into the validation set
+    """
+    targets = np.asarray(targets)
+    if np.issubdtype(targets.dtype, np.integer):
+        strata = targets
+    else:
+        edges = np.percentile(targets, np.linspace(0, 100, num_bins + 1)[1:-1])
+        strata = np.searchsorted(edges, targets)
+    rng = np.random.RandomState(seed)
+    indcs = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        num_keep = max(1, int(round(len(members) * fraction)))
+        indcs.append(rng.choice(members, num_keep, replace=False))
+    return np.sort(np.concatenate(indcs))
+
+def _is_better(current, best, maximize):
+    if best is None:
+        return True
+    return current > best if maximize else current < best
+
+class EarlyStopping(object):
+    """
+    Overview:
+        Stops training once 'monitor' has not improved for 'patience'
+        epochs. Epochs w/o a full validation pass are skipped, so this
+        also works when validating only every few epochs (subsampled
+        scores are not comparable).
+    ----------
+    patience: int
+        Defaults to 200
+
+    monitor: string
+        History key to watch, defaults to 'valid_loss'
+
+    maximize: boolean
+        Defaults to false. Set to true for accuracies
+    """
+    def __init__(self, patience=200, monitor='valid_loss', maximize=False):
+        self.patience = patience
+        self.monitor = monitor
+        self.maximize = maximize
+        self.best_value = None
+        self.best_epoch = 0
+
+    def __call__(self, trainer, history):
+        if self.monitor not in history[-1] or not history[-1].get('valid_full', True):
+            return # Not (fully) validated this epoch
+        current = history[-1][self.monitor]
+        epoch = history[-1]['epoch'] # Patience is in epochs, not validation points
+        if _is_better(current, self.best_value, self.maximize):
+            self.best_value = current
+            self.best_epoch = epoch
+        elif self.best_epoch + self.patience < epoch:
+            print('Early Stopping')
+            print("Best {} was {:.6f} at epoch {}.".format(self.monitor, self.best_value, self.best_epoch))
+            raise StopIteration()
+
+    def get_state(self):
+        return {'best_value': self.best_value, 'best_epoch': self.best_epoch}
+
+    def set_state(self, state):
+        self.best_value = state['best_value']
+        self.best_epoch = state['best_epoch']
+
+class SaveWeights(object):
+    """
+    Overview:
+        Saves the weights for each layer in 'weight_dir/NameEPOCH.npz'
+        every 'multiple' epochs or if 'monitor' is the best so far. The
+        files are written by a 'CheckpointManager' thread, so training
+        does not wait for the disk, and only the last 'keep_last' and
+        best 'keep_best' checkpoints are kept. Use 'finish' as an
+        on_training_finished callback to copy the best weights to
+        'best_dir' (as .npz and as a memory-mapped .lw file for fast
+        loading, see 'weight_format.py'). Only full validation passes can mark the best
+        weights (subsampled scores are not comparable).
+    ----------
+    network: Lasagne object
+        The network from which the weights will be extracted from
+
+    weight_dir: string
+        Folder for the periodic checkpoints
+
+    best_dir: string
+        Folder for the final best weights
+
+    name: string
+        File name prefix, e.g. '3d_cnn_'
+
+    multiple: int
+        Defaults at 100. Specifies the cycle time for saving weights.
+
+    monitor: string
+        History key that decides the best weights
+
+    maximize: boolean
+        Defaults to false. Set to true for accuracies
+
+    keep_last: int
+        Defaults to 5. The most recent checkpoints to keep
+
+    keep_best: int
+        Defaults to 3. The best checkpoints to keep
+    """
+    def __init__(self, network, weight_dir, best_dir, name, multiple=100,
+                 monitor='valid_loss', maximize=False, keep_last=5, keep_best=3):
+        self.network = network
+        self.best_dir = best_dir
+        self.multiple = multiple
+        self.monitor = monitor
+        self.maximize = maximize
+        self.best_value = None
+        self.checkpoints = CheckpointManager(weight_dir, name, keep_last, keep_best, maximize)
+
+    def __call__(self, trainer, history):
+        epoch = history[-1]['epoch']
+        current = history[-1].get(self.monitor)
+        if not history[-1].get('valid_full', True):
+            current = None
+        is_best = current is not None and _is_better(current, self.best_value, self.maximize)
+        if epoch % self.multiple == 0 or is_best:
+            # get_all_param_values returns copies, so training can go on while they are written
+            self.checkpoints.save(epoch, lasagne.layers.get_all_param_values(self.network), current)
+            print('Saving Weights for ' + str(epoch))
+            if is_best:
+                self.best_value = current
+
+    def get_state(self):
+        return {'best_value': self.best_value, 'written': self.checkpoints.get_state()}
+
+    def set_state(self, state):
+        self.best_value = state['best_value']
+        self.checkpoints.set_state(state['written'])
+
+    def finish(self, trainer, history):
+        self.checkpoints.close()
+        best_path = self.checkpoints.best_path
+        if best_path is None:
+            return
+        if not os.path.exists(self.best_dir):
+            os.makedirs(self.best_dir)
+        dest = os.path.join(self.best_dir, os.path.basename(best_path))
+        shutil.copy(best_path, dest + '.tmp')
+        os.rename(dest + '.tmp', dest)
+        write_weight_file(dest[:-len('.npz')] + '.lw', load_param_values(dest),
+                          param_names(self.network))
+        print('Best weights copied to ' + self.best_dir)
@@ -2,9 +2,12 @@
 from __future__ import division 
 import numpy as np 
 
+from random_image_generator import random_clip_generator
+from telemetry import timed
+
 # Utility functions to help train neural networks 
 
-def iterate_minibatches2d(inputs, targets, batchsize, shuffle=False):
+def iterate_minibatches2d(inputs, targets, batchsize, shuffle=False, augment=True, indcs=None):
     """
     Overview: 
         An iterator that randomly rotates or flips 3/4 of the 
@@ -12,9 +15,11 @@ def iterate_minibatches2d(inputs, targets, batchsize, shuffle=False):
         are left the same. This is used for (minibatch) stochastic gradient 
         decent updating.
     ----------
-    inputs: numpy array  
-        This should be the training data of shape 
-        (num_train, num_channels, length, width)
+    inputs: numpy array or h5py dataset 
+        This should be the (uint8) training data of shape 
+        (num_train, num_channels, length, width). Only the current 
+        minibatch is converted to float32 and scaled to [0, 1] so the 
+        full drive never gets copied
     
     targets: numpy array 
         This should be the corresponding labels of shape
@@ -26,6 +31,13 @@ def iterate_minibatches2d(inputs, targets, batchsize, shuffle=False):
     shuffle: 
         Defaults to false. If true, the training data is
         shuffled.
+    augment: 
+        Defaults to true. If false, no samples are flipped or rotated 
+        (use this for validation).
+    indcs: numpy array 
+        Defaults to None. If given, the samples are taken in this order 
+        (e.g. from 'balanced_angle_order', may repeat samples) instead of 
+        all of them once 
     Returns
     -------
     batch_sample_input: numpy array
@@ -35,102 +47,86 @@ def iterate_minibatches2d(inputs, targets, batchsize, shuffle=False):
     batch_sample_target: numpy array
         The corresponding labels for the batch_sample_input
     """
-    inputs = inputs.astype(np.float32) #Do conversion in batches - o/w runs out of memory 
-    inputs /= 255
-    inputs = inputs.astype(np.float32)
-    num_samps = inputs.shape[0]
-    indcs = np.arange(num_samps)
-    if shuffle:
-        np.random.shuffle(indcs)
+    if indcs is None:
+        indcs = np.arange(inputs.shape[0])
+        if shuffle:
+            np.random.shuffle(indcs)
+    num_samps = len(indcs)
     for i in range(0, num_samps - batchsize + 1, batchsize): 
-        batch_indcs = indcs[i:(i + batchsize)]
-        batch_sample_input = inputs[batch_indcs]
-        batch_sample_target = targets[batch_indcs]
+        with timed('index'):
+            # h5py only supports strictly increasing indices - read each frame once 
+            # and repeat the ones drawn more than once (sampling w/ replacement) 
+            batch_indcs = indcs[i:(i + batchsize)]
+            unique_indcs, inverse = np.unique(batch_indcs, return_inverse=True)
+            batch_sample_input = np.asarray(inputs[unique_indcs], dtype=np.float32)[inverse] 
+            batch_sample_input /= 255 # Convert batch only - o/w runs out of memory 
+            batch_sample_target = targets[batch_indcs]
+
+        if not augment:
+            yield batch_sample_input, batch_sample_target
+            continue
 
-        # This handles random orientation logic
-        num_changes = int(batchsize * .75) # Prop of samples we distort
-        distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
+        with timed('augment'):
+            # This handles random orientation logic
+            num_changes = int(batchsize * .75) # Prop of samples we distort
+            distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
 
-        swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
-        flip_indcs = swap_indcs[0:distorts_per_cat]
-        rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
-        batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, ::-1] 
-        for i in rotate_indcs:
-            batch_sample_input[i, :, :, :] = random_2D_image_generator(batch_sample_input[i, :, :, :]) # !
+            swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
+            flip_indcs = swap_indcs[0:distorts_per_cat]
+            rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
+            batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, ::-1] 
+            batch_sample_input[rotate_indcs] = random_clip_generator(batch_sample_input[rotate_indcs], batched=True)
         yield batch_sample_input, batch_sample_target
 
-def stop_early(curr_val_acc, val_acc_list, patience=200):
+def angle_sample_weights(angles, bin_width=5, balance=.5, dominant_weight=None):
     """
     Overview: 
-        This implements the early stopping logic for training.  
+        Sampling probabilities that counter the excess of near-zero 
+        steering angles. The angles are binned and every frame is 
+        weighted by 1 / (frames in its bin) ** balance. Alternatively, 
+        only the most populated (straight road) bin is down-weighted. 
     ----------
-    curr_val_acc: float    
-        The accuracy for the current epoch 
-    val_acc_list: array    
-        List of accuracies for past epochs
-    patience: int   
-        How many epochs to look back in order to compare 
-        'curr_val_acc'  
+    angles: numpy array 
+        Per-frame steering angles (the 'angle' array of 'concatenate')
+    bin_width: float 
+        Defaults to 5 (degrees) 
+    balance: float 
+        Defaults to .5. 0 keeps the natural distribution, 1 makes every 
+        bin equally likely 
+    dominant_weight: float 
+        Defaults to None. If given, the frames of the most populated bin 
+        get this weight and all others 1 ('balance' is ignored) 
     Returns
     -------
-    boolean: True or False 
-        If true this means that the network should halt. Otherwise, 
-        the network should continue training.   
+    weights: numpy array
+        Per-frame probabilities that sum to 1 
     """
-    num_epochs = len(val_acc_list)
-    if num_epochs < patience:
-        return False 
+    bins = np.floor(np.asarray(angles, dtype=np.float64) / bin_width).astype(np.int64)
+    _, bin_of_frame, counts = np.unique(bins, return_inverse=True, return_counts=True)
+    if dominant_weight is None:
+        weights = counts[bin_of_frame] ** -float(balance)
     else:
-        prev_acc = val_acc_list[num_epochs - patience]
-        if prev_acc > curr_val_acc:
-            print('Early Stopping')
-            return True 
-        else:
-            return False
+        weights = np.where(bin_of_frame == np.argmax(counts), float(dominant_weight), 1.)
+    return weights / weights.sum()
 
-def save_network_weights(path, network):
+def balanced_angle_order(weights, epoch_fraction=1.):
     """
     Overview: 
-        This saves the weights for each layer in the network
-        in a .npz file  
+        Draws the frames of one epoch according to 'weights' (see 
+        'angle_sample_weights'), to pass as 'indcs' to 
+        'iterate_minibatches2d'. 
     ----------
-    path: string   
-        Location of where to store the weights 
-    network: Lasagne object
-        The network from which the weights will be extracted from   
+    weights: numpy array 
+        Per-frame probabilities 
+    epoch_fraction: float 
+        Defaults to 1. Frames drawn per epoch as a fraction of all frames 
+        (the effective epoch size). Frames are drawn w/ replacement - w/o 
+        it a full epoch would be every frame once, whatever the weights 
     Returns
     -------
-    None  
+    indcs: numpy array
+        The drawn frames
     """
-    np.savez(path, *lasagne.layers.get_all_param_values(network))
+    num_draws = max(int(epoch_fraction * len(weights)), 1)
+    return np.random.choice(len(weights), num_draws, replace=True, p=weights)
 
-def save_weights(network, epoch, curr_val_acc, val_acc_list, name='2dcnn', multiple=100):
-    """
-    Overview: 
-        This saves the weights for each layer in the network
-        in a .npz file at multiples of 'multiple' or if the 
-        curr_val_acc is the best accuracy so far. The weights are saved 
-        in '../data/weights/train/NameEPOCH.npz' 
-    ----------
-    network: string   
-        The network from which the weights will be extracted from 
-    epoch: int
-        The current epoch of training 
-    curr_val_acc: 
-        The accuracy for the current epoch
-    
-    val_acc_list:
-        List of accuracies for past epochs
-    multiple:
-        Defaults at 100. Specifies the cycle time for 
-        saving wieghts. 
-    Returns
-    -------
-    None:
-        Prints if it saves weights and specifies the epoch  
-    """
-    # Save weights every 20 epochs to server (transport to s3 eventually)
-    if epoch % multiple == 0 or curr_val_acc > np.max(val_acc_list):
-        weight_path = '../data/weights/train/' + name + str(epoch)
-        save_network_weights(weight_path, network)
-        print('Saved Weights for ' + str(epoch))
@@ -0,0 +1,340 @@
+# Author: Raj Agrawal
+
+# In this script, I have different functions that will allow you to:
+# - Vary learning rates layer by layer
+# - Making a custom learning rate decay function
+
+# The schedules change a theano.shared learning rate between epochs, so the
+# compiled functions never have to be rebuilt. 'LearningRateScheduler' and
+# 'ReduceOnPlateau' are Trainer callbacks (see trainer.py) and
+# 'TimeToTarget' logs how long a run took to reach a validation target.
+
+from __future__ import division
+
+import math
+import numpy as np
+import theano
+
+from collections import OrderedDict
+from lasagne.updates import adam, get_or_compute_grads
+
+def learning_rates_by_layer(loss, layer_learn_dic, loss_update=adam):
+    """
+    Overview:
+        Builds the parameter updates w/ a separate learning rate for
+        each layer.
+    ----------
+    loss: Theano expression
+        Training loss
+
+    layer_learn_dic: dict
+        Maps a Lasagne layer to its learning rate (a float or a shared
+        variable)
+
+    loss_update: function
+        Defaults to adam. Any lasagne.updates function
+
+    Returns
+    -------
+    updates: OrderedDict
+        Parameter update expressions
+    """
+    updates = OrderedDict()
+    for layer, learning_rate in layer_learn_dic.items():
+        updates.update(loss_update(loss, layer.get_params(trainable=True), learning_rate))
+    return updates
+
+def freeze_layers(layers):
+    """
+    Overview:
+        Removes the 'trainable' tag from the parameters of 'layers'. They
+        drop out of get_all_params(trainable=True), so no gradients or
+        updates are built for them - and no backward pass at all below
+        the lowest trainable layer.
+    ----------
+    layers: list
+        Lasagne layers, e.g. [net['conv1'], net['conv2']]
+    """
+    for layer in layers:
+        for tags in layer.params.values():
+            tags.discard('trainable')
+
+def unfreeze_layers(layers):
+    """
+    Tags the parameters of 'layers' as trainable again
+    """
+    for layer in layers:
+        for tags in layer.params.values():
+            tags.add('trainable')
+
+def with_layer_multipliers(update, layer_multipliers):
+    """
+    Overview:
+        Wraps a lasagne.updates function so that the parameters of each
+        layer in 'layer_multipliers' use learning_rate * multiplier (all
+        other parameters use learning_rate). The gradients are computed
+        once for all groups.
+    ----------
+    update: function
+        E.g. adam
+
+    layer_multipliers: dict
+        Maps a Lasagne layer to its multiplier, e.g. {net['conv1']: .1}.
+        Use 'freeze_layers' instead of a multiplier of 0.
+
+    Returns
+    -------
+    scaled_update: function
+        scaled_update(loss_or_grads, params, learning_rate=.001, **kwargs)
+        -> OrderedDict of updates, usable as build_objectives(update=...)
+    """
+    param_multipliers = {}
+    for layer, multiplier in layer_multipliers.items():
+        for param in layer.get_params():
+            param_multipliers[param] = multiplier
+
+    def scaled_update(loss_or_grads, params, learning_rate=.001, **kwargs):
+        grads = get_or_compute_grads(loss_or_grads, params)
+        groups = OrderedDict()
+        for param, grad in zip(params, grads):
+            group = groups.setdefault(param_multipliers.get(param, 1), ([], []))
+            group[0].append(param)
+            group[1].append(grad)
+        updates = OrderedDict()
+        for multiplier, (group_params, group_grads) in groups.items():
+            updates.update(update(group_grads, group_params,
+                                  learning_rate=learning_rate * multiplier, **kwargs))
+        return updates
+    return scaled_update
+
+def shared_learning_rate(value=.001):
+    """
+    Returns a float shared variable named 'learning_rate' to pass
+    to 'build_objectives'
+    """
+    return theano.shared(np.asarray(value, dtype=theano.config.floatX), name='learning_rate')
+
+def find_shared_var(train_fn, name='learning_rate'):
+    """
+    Overview:
+        Finds the shared variable called 'name' among the inputs of a
+        compiled function. Functions loaded by 'cached_compile' hold
+        their own copy of the learning rate, so look it up after
+        compiling instead of keeping the one passed to the graph.
+    ----------
+    train_fn: Theano function
+        The compiled training function (or an object w/ a 'functions'
+        list, e.g. 'AccumulatingTrainFn')
+
+    name: string
+        The variable's name
+
+    Returns
+    -------
+    var: Theano shared variable
+    """
+    for fn in getattr(train_fn, 'functions', [train_fn]):
+        for i in fn.maker.inputs:
+            if i.variable.name == name:
+                return i.variable
+    raise ValueError('train_fn has no shared variable called ' + name)
+
+def step_schedule(base_lr, drop=.5, every=100):
+    """
+    Multiplies 'base_lr' by 'drop' every 'every' epochs
+    """
+    def schedule(epoch):
+        return base_lr * drop ** (epoch // every)
+    return schedule
+
+def cosine_schedule(base_lr, num_epochs, min_lr=0):
+    """
+    Anneals from 'base_lr' to 'min_lr' along half a cosine over 'num_epochs'
+    """
+    def schedule(epoch):
+        progress = min(epoch / max(num_epochs - 1, 1), 1)
+        return min_lr + (base_lr - min_lr) * (1 + math.cos(math.pi * progress)) / 2
+    return schedule
+
+def one_cycle_schedule(max_lr, num_epochs, pct_start=.3, div=25, final_div=1e4):
+    """
+    Overview:
+        The one-cycle policy: a cosine ramp from max_lr / div up to
+        'max_lr' over the first 'pct_start' of the epochs, then a cosine
+        decay down to max_lr / final_div.
+    ----------
+    max_lr: float
+        The peak learning rate
+
+    num_epochs: int
+        Length of the cycle
+
+    pct_start: float
+        Proportion of the cycle spent increasing the rate
+
+    div: float
+        Initial rate is max_lr / div
+
+    final_div: float
+        Final rate is max_lr / final_div
+
+    Returns
+    -------
+    schedule: function
+        schedule(epoch) -> learning rate
+    """
+    warm_epochs = max(int(num_epochs * pct_start), 1)
+    def anneal(start, stop, progress):
+        return stop + (start - stop) * (1 + math.cos(math.pi * min(progress, 1))) / 2
+    def schedule(epoch):
+        if epoch < warm_epochs:
+            return anneal(max_lr / div, max_lr, epoch / warm_epochs)
+        return anneal(max_lr, max_lr / final_div,
+                      (epoch - warm_epochs) / max(num_epochs - warm_epochs - 1, 1))
+    return schedule
+
+def named_schedule(name, base_lr, num_epochs):
+    """
+    Returns the schedule 'name' ('step', 'cosine' or 'one_cycle') for a run
+    of 'num_epochs' epochs starting from (or peaking at) 'base_lr'. The
+    step schedule halves the rate four times over the run.
+    """
+    if name == 'step':
+        return step_schedule(base_lr, every=max(num_epochs // 5, 1))
+    if name == 'cosine':
+        return cosine_schedule(base_lr, num_epochs)
+    if name == 'one_cycle':
+        return one_cycle_schedule(base_lr, num_epochs)
+    raise ValueError("schedule must be 'step', 'cosine' or 'one_cycle', not " + repr(name))
+
+class LearningRateScheduler(object):
+    """
+    Overview:
+        Sets 'learning_rate' to schedule(epoch) before every epoch.
+        Called after epoch 'e', it sets the rate for epoch 'e + 1'.
+    ----------
+    learning_rate: Theano shared variable
+        See 'find_shared_var'
+
+    schedule: function
+        schedule(epoch) -> learning rate, e.g. cosine_schedule(.001, 500)
+    """
+    def __init__(self, learning_rate, schedule):
+        self.learning_rate = learning_rate
+        self.schedule = schedule
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.learning_rate.set_value(np.asarray(self.schedule(epoch), dtype=theano.config.floatX))
+
+    def __call__(self, trainer, history):
+        self.set_epoch(history[-1]['epoch'] + 1)
+
+    def get_state(self):
+        return {'value': float(self.learning_rate.get_value())}
+
+    def set_state(self, state):
+        self.learning_rate.set_value(np.asarray(state['value'], dtype=theano.config.floatX))
+
+class ReduceOnPlateau(object):
+    """
+    Overview:
+        Multiplies 'learning_rate' by 'factor' once 'monitor' has not
+        improved for 'patience' epochs. Epochs w/o a full validation
+        pass are skipped (subsampled scores are not comparable).
+    ----------
+    learning_rate: Theano shared variable
+        See 'find_shared_var'
+
+    monitor: string
+        History key to watch, defaults to 'valid_loss'
+
+    maximize: boolean
+        Defaults to false. Set to true for accuracies
+
+    factor: float
+        Defaults to .5
+
+    patience: int
+        Defaults to 20 epochs (keep it well below the early stopping
+        patience)
+
+    min_lr: float
+        The rate is never reduced below this
+    """
+    def __init__(self, learning_rate, monitor='valid_loss', maximize=False, factor=.5,
+                 patience=20, min_lr=1e-6):
+        self.learning_rate = learning_rate
+        self.monitor = monitor
+        self.maximize = maximize
+        self.factor = factor
+        self.patience = patience
+        self.min_lr = min_lr
+        self.best_value = None
+        self.wait_start = 0 # Epoch of the best value or of the last reduction
+
+    def __call__(self, trainer, history):
+        if self.monitor not in history[-1] or not history[-1].get('valid_full', True):
+            return
+        current = history[-1][self.monitor]
+        epoch = history[-1]['epoch']
+        if (self.best_value is None or
+                (current > self.best_value if self.maximize else current < self.best_value)):
+            self.best_value = current
+            self.wait_start = epoch
+        elif epoch - self.wait_start >= self.patience:
+            old_lr = float(self.learning_rate.get_value())
+            new_lr = max(old_lr * self.factor, self.min_lr)
+            if new_lr < old_lr:
+                self.learning_rate.set_value(np.asarray(new_lr, dtype=theano.config.floatX))
+                print('Reduced learning rate to {:.2e}'.format(new_lr))
+            self.wait_start = epoch
+
+    def get_state(self):
+        return {'value': float(self.learning_rate.get_value()),
+                'best_value': self.best_value, 'wait_start': self.wait_start}
+
+    def set_state(self, state):
+        self.learning_rate.set_value(np.asarray(state['value'], dtype=theano.config.floatX))
+        self.best_value = state['best_value']
+        self.wait_start = state['wait_start']
+
+class TimeToTarget(object):
+    """
+    Overview:
+        Logs the epoch and the wall-clock training time (summed
+        'epoch_time' of the history) at which 'monitor' first reaches
+        'target'. Stored in trainer.time_to_target as (epoch, seconds).
+    ----------
+    monitor: string
+        History key to watch, defaults to 'valid_loss'
+
+    target: float
+        The value to reach
+
+    maximize: boolean
+        Defaults to false. If true, reaching means >= target
+    """
+    def __init__(self, monitor='valid_loss', target=0., maximize=False):
+        self.monitor = monitor
+        self.target = target
+        self.maximize = maximize
+        self.reached = None
+
+    def __call__(self, trainer, history):
+        if (self.reached is not None or self.monitor not in history[-1]
+                or not history[-1].get('valid_full', True)):
+            return
+        current = history[-1][self.monitor]
+        if current >= self.target if self.maximize else current <= self.target:
+            seconds = sum(record['epoch_time'] for record in history)
+            self.reached = (history[-1]['epoch'], seconds)
+            trainer.time_to_target = self.reached
+            print('Reached {} {} at epoch {} after {:.1f}s of training'.format(
+                self.monitor, self.target, self.reached[0], seconds))
+
+    def get_state(self):
+        return {'reached': self.reached}
+
+    def set_state(self, state):
+        self.reached = state['reached']
@@ -0,0 +1,189 @@
+# A compact weight file that can be memory-mapped, so loading a model for
+# inference is near-instant and several processes share one copy of the
+# weights through the page cache (.npz archives are unzipped and copied
+# array by array instead).
+
+# Layout: 8 byte magic, uint32 header length, a JSON header (one entry per
+# parameter w/ its name, shape, dtype and byte offset) and then the raw
+# C-order arrays, each aligned to 64 bytes.
+
+# Usage (from the code folder):
+#   $python weight_format.py weights.npz weights.lw [--float16]
+# converts the .npz checkpoints of 'SaveWeights' (see 'trainer.py')
+
+from __future__ import division
+
+import os
+import sys
+import json
+import struct
+import numpy as np
+import lasagne
+
+MAGIC = b'LASWGT01'
+ALIGNMENT = 64
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def param_names(network):
+    """
+    Returns 'LAYER.PARAM' names in the order of
+    lasagne.layers.get_all_param_values(network). Unnamed layers are
+    called by their type and position, e.g. 'DenseLayer7.W'.
+    """
+    names, seen = [], set()
+    for i, layer in enumerate(lasagne.layers.get_all_layers(network)):
+        layer_name = layer.name or type(layer).__name__ + str(i)
+        for param in layer.get_params():
+            if param in seen: # Shared between layers, stored once
+                continue
+            seen.add(param)
+            names.append(layer_name + '.' + str(param.name))
+    return names
+
+def write_weight_file(path, arrays, names=None, float16=False):
+    """
+    Overview:
+        Writes 'arrays' in the memory-mappable format.
+    ----------
+    path: string
+        Destination, e.g. '../models/3d_cnn_.lw'
+
+    arrays: list
+        Numpy arrays (e.g. lasagne.layers.get_all_param_values)
+
+    names: list
+        Defaults to 'arr_0', 'arr_1', ... (see 'param_names')
+
+    float16: boolean
+        Defaults to false. If true, float32 arrays are stored as float16
+        (half the size, converted back to float32 when loaded)
+    """
+    if names is None:
+        names = ['arr_%d' % i for i in range(len(arrays))]
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    if float16:
+        arrays = [a.astype(np.float16) if a.dtype == np.float32 else a for a in arrays]
+
+    entries, offset = [], 0
+    for name, a in zip(names, arrays):
+        offset = _aligned(offset)
+        entries.append({'name': name, 'shape': list(a.shape), 'dtype': a.dtype.str,
+                        'offset': offset})
+        offset += a.nbytes
+    header = json.dumps({'arrays': entries}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 4 + len(header))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        for entry, a in zip(entries, arrays):
+            f.seek(data_start + entry['offset'])
+            f.write(a.tobytes())
+        f.truncate(data_start + offset)
+    os.rename(tmp_path, path)
+
+def read_header(path):
+    """
+    Returns the header entries of the file and the byte offset of
+    the data section
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + ' is not a weight file')
+        header_len = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_len).decode('utf-8'))
+    return header['arrays'], _aligned(len(MAGIC) + 4 + header_len)
+
+def map_weight_file(path, dtype=np.float32, names=None):
+    """
+    Overview:
+        Memory-maps the arrays of a weight file (read-only). Nothing is
+        read from disk until the values are used.
+    ----------
+    path: string
+        A file written by 'write_weight_file'
+
+    dtype: numpy dtype
+        Defaults to float32. float16 arrays are converted to this (which
+        makes a copy); set to None to keep the stored dtype.
+
+    names: list
+        Defaults to None (all arrays). If given, only these arrays are
+        returned, in the file's order
+
+    Returns
+    -------
+    arrays: list
+        The arrays in the order they were saved
+
+    names: list
+        Their names
+    """
+    entries, data_start = read_header(path)
+    if names is not None:
+        missing = set(names) - set(entry['name'] for entry in entries)
+        if missing:
+            raise KeyError('not in ' + path + ': ' + ', '.join(sorted(missing)))
+        entries = [entry for entry in entries if entry['name'] in names]
+    arrays, names = [], []
+    if not entries:
+        return arrays, names
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    for entry in entries:
+        stored = np.dtype(entry['dtype'])
+        start = data_start + entry['offset']
+        count = int(np.prod(entry['shape']))
+        a = buf[start:start + count * stored.itemsize].view(stored).reshape(entry['shape'])
+        if dtype is not None and stored == np.float16:
+            a = a.astype(dtype)
+        arrays.append(a)
+        names.append(entry['name'])
+    return arrays, names
+
+def load_param_values(path):
+    """
+    Returns the parameter values stored at 'path', a .npz file from
+    'SaveWeights' or a file from 'write_weight_file'
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return [f['arr_%d' % i] for i in range(len(f.files))]
+    return map_weight_file(path)[0]
+
+def set_param_values(network, values, borrow=True):
+    """
+    Overview:
+        Like lasagne.layers.set_all_param_values but can hand the
+        (memory-mapped) arrays to Theano w/o copying them.
+    ----------
+    network: Lasagne object
+        The output layer
+
+    values: list
+        Arrays in the order of lasagne.layers.get_all_params(network)
+
+    borrow: boolean
+        Defaults to true. Only use for inference - the arrays are
+        read-only, so training would have to copy them anyway.
+    """
+    params = lasagne.layers.get_all_params(network)
+    if len(params) != len(values):
+        raise ValueError('mismatch: got {} values to set {} parameters'.format(len(values), len(params)))
+    for param, value in zip(params, values):
+        if param.get_value(borrow=True).shape != value.shape:
+            raise ValueError('mismatch: parameter has shape {} but value to set has shape {}'.format(
+                param.get_value(borrow=True).shape, value.shape))
+        param.set_value(value, borrow=borrow)
+
+if __name__ == '__main__':
+
+    float16 = '--float16' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--float16']
+    with np.load(args[0]) as f:
+        arrays = [f['arr_%d' % i] for i in range(len(f.files))]
+    write_weight_file(args[1], arrays, float16=float16)
+    print('Wrote {} arrays ({:.1f} MB)'.format(len(arrays), os.path.getsize(args[1]) / 2**20))
@@ -4,25 +4,45 @@
 
 # We will use the pretrained weights and strip the first two layers 
 
-# Things to extend: TODO The learning weights in the first two layers should be
-# smaller than the next convolutional and dense layers: See 
+# The pretrained convolutions are either frozen (no gradients are computed for 
+# them) or fine-tuned w/ a smaller learning rate than the new dense layers: See 
 # https://github.com/Lasagne/Lasagne/issues/648 
 
 # Since this takes 3 color channels, we need to modify the input data 
 # to include 3 channels 
 
+import os
+import numpy as np
 import cPickle as pickle
 
+import lasagne
+import theano
+import theano.tensor as T
+from theano.tensor import *
+
 from lasagne.layers import InputLayer
 from lasagne.layers import DenseLayer
 from lasagne.layers import NonlinearityLayer
 from lasagne.layers import DropoutLayer
 from lasagne.layers import Pool2DLayer as PoolLayer
-from lasagne.layers.dnn import Conv2DDNNLayer as ConvLayer
-from lasagne.nonlinearities import softmax
-from 2d_cnn_lasagne import iterate_minibatches, stop_early, # TEST FOR COLOR IMAGES
-from 2d_cnn_lasagne import save_network_weights, save_weights # TEST FOR COLOR IMAGES 
+from backend import Conv2DLayer as ConvLayer
+from backend import MaxPool2DLayer
+from lasagne.nonlinearities import softmax, rectify
+from lasagne.objectives import binary_hinge_loss
 from lasagne.layers import set_all_param_values
+from random_image_generator import * 
+from trainer import Trainer, EarlyStopping, SaveWeights, build_objectives, stratified_subsample, compile_fns, binary_accuracy
+from telemetry import timed
+from function_cache import cached_compile
+from autotune import tuned_batch_size
+from large_batch import compile_accumulating_fns
+from varying_learning_rates import shared_learning_rate, find_shared_var, ReduceOnPlateau, TimeToTarget
+from varying_learning_rates import LearningRateScheduler, named_schedule
+from varying_learning_rates import freeze_layers, with_layer_multipliers
+from lasagne.updates import adam
+from feature_cache import build_feature_cache, load_feature_cache, iterate_cached_features
+from preaugment_epochs import distort_batch
+from vgg16_store import load_vgg16_layers
 
 # The actual architecture of the model 
 from vgg16 import build_model
@@ -51,38 +71,72 @@ def strip_first_two_layers(output_layer):
         output_layer = output_layer.input_layer
     return (layer_one, layer_two, layer_three)
 
+def _value(param):
+    # Shared variables from 'load_vgg16' or arrays from 'load_vgg16_layers'
+    return param.get_value() if hasattr(param, 'get_value') else np.array(param)
+
 def init_cnn_model(layer_one_params, layer_two_params, layer_three_params, input_var):
     net = {}
-    W_one = layer_one_params[0]
-    W_two = layer_two_params[0]
-    W_three = layer_three_params[0]
-    b_one = layer_one_params[1]
-    b_two = layer_two_params[1]
-    b_three = layer_three_params[1]
+    W_one = _value(layer_one_params[0])
+    W_two = _value(layer_two_params[0])
+    W_three = _value(layer_three_params[0])
+    b_one = _value(layer_one_params[1])
+    b_two = _value(layer_two_params[1])
+    b_three = _value(layer_three_params[1])
     net['input'] = InputLayer((None, 3, 81, 144), input_var=input_var)
 
     # ----------- 1st Conv layer group ---------------
-    net['conv1'] = ConvLayer(net['input'], 64, 3, pad=1, flip_filters=False, W=W_one.get_value(), b=b_one.get_value())
-    net['conv2'] = ConvLayer(net['conv1'], 64, 3, pad=1, flip_filters=False, W=W_two.get_value(), b=b_two.get_value())
-    net['pool1']  = MaxPool2DDNNLayer(net['conv2'], 2)
+    net['conv1'] = ConvLayer(net['input'], 64, 3, pad=1, flip_filters=False, W=W_one, b=b_one)
+    net['conv2'] = ConvLayer(net['conv1'], 64, 3, pad=1, flip_filters=False, W=W_two, b=b_two)
+    net['pool1']  = MaxPool2DLayer(net['conv2'], 2)
 
     # ------------- 2nd Conv layer group --------------
-    net['conv3'] = ConvLayer(net['pool1'], 128, 3, pad=1, flip_filters=False, W=W_three.get_value(), b=b_three.get_value())
-    net['pool1']  = MaxPool2DDNNLayer(net['conv2'],2)
-    net['pool2']  = MaxPool2DDNNLayer(net['conv3'],pool_size=(2,2))
-    net['dropout1'] = DropoutLayer(net['pool2'], p=.5)
+    net['conv3'] = ConvLayer(net['pool1'], 128, 3, pad=1, flip_filters=False, W=W_three, b=b_three)
+    net['pool1']  = MaxPool2DLayer(net['conv2'],2)
+    net['pool2']  = MaxPool2DLayer(net['conv3'],pool_size=(2,2))
+    net.update(build_head(net['pool2']))
+
+    return net
+
+def build_head(incoming, shared_from=None):
+    """
+    Overview: 
+        Builds the trainable head (dropout1 -> fc4 -> fc5 -> output) on 
+        top of 'incoming'. 
+    ----------
+    incoming: Lasagne object 
+        The layer the head is stacked on, e.g. the pool2 layer or an 
+        InputLayer for cached features 
+
+    shared_from: dict 
+        Defaults to None. If given (a net from 'init_cnn_model'), the head 
+        reuses its fc4/fc5/output weights, so training this head trains 
+        that net 
+
+    Returns
+    -------
+    net: dict 
+        The head's layers by name 
+    """
+    def params(name):
+        if shared_from is None:
+            return {}
+        return {'W': shared_from[name].W, 'b': shared_from[name].b}
+
+    net = {}
+    net['dropout1'] = DropoutLayer(incoming, p=.5)
 
     # ----------------- Dense Layers -----------------
-    net['fc4']  = DenseLayer(net['dropout1'], num_units=256, nonlinearity=rectify)
+    net['fc4']  = DenseLayer(net['dropout1'], num_units=256, nonlinearity=rectify, **params('fc4'))
     net['dropout4'] = DropoutLayer(net['fc4'], p=.5)
-    net['fc5']  = DenseLayer(net['dropout4'], num_units=256, nonlinearity=rectify)
+    net['fc5']  = DenseLayer(net['dropout4'], num_units=256, nonlinearity=rectify, **params('fc5'))
 
     # ----------------- Output Layer -----------------
-    net['output']  = DenseLayer(net['fc5'], num_units=1, nonlinearity=None)
+    net['output']  = DenseLayer(net['fc5'], num_units=1, nonlinearity=None, **params('output'))
 
     return net
 
-def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
+def iterate_minibatches(inputs, targets, batchsize, shuffle=False, augment=True):
     """
     Overview: 
         An iterator that randomly rotates or flips 3/4 of the 
@@ -105,6 +159,10 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
         Defaults to false. If true, the training data is
         shuffled.
 
+    augment: 
+        Defaults to true. If false, no samples are flipped or rotated 
+        (use this for validation).
+
     Returns
     -------
     batch_sample_input: numpy array
@@ -119,23 +177,28 @@ def iterate_minibatches(inputs, targets, batchsize, shuffle=False):
     if shuffle:
         np.random.shuffle(indcs)
     for i in range(0, num_samps - batchsize + 1, batchsize): 
-        batch_indcs = indcs[i:(i + batchsize)]
-        batch_sample_input = inputs[batch_indcs]
-        batch_sample_target = targets[batch_indcs]
-
-        # This handles random orientation logic
-        num_changes = int(batchsize * .75) # Prop of samples we distort
-        distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
-
-        swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
-        flip_indcs = swap_indcs[0:distorts_per_cat]
-        rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
-        batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, ::-1] 
-        #for i in rotate_indcs:
-            #batch_sample_input[i, :, :, :] = random_2D_image_generator(batch_sample_input[i, :, :, :]) # !
+        with timed('index'):
+            batch_indcs = indcs[i:(i + batchsize)]
+            batch_sample_input = inputs[batch_indcs]
+            batch_sample_target = targets[batch_indcs]
+
+        if not augment:
+            yield batch_sample_input, batch_sample_target
+            continue
+
+        with timed('augment'):
+            # This handles random orientation logic
+            num_changes = int(batchsize * .75) # Prop of samples we distort
+            distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
+
+            swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
+            flip_indcs = swap_indcs[0:distorts_per_cat]
+            rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
+            batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, :, :, ::-1] 
+            batch_sample_input[rotate_indcs] = random_clip_generator(batch_sample_input[rotate_indcs], batched=True)
         yield batch_sample_input, batch_sample_target
 
-if __name__ == 'main':
+if __name__ == '__main__':
     # Might need to increase Python's recursion limit (I didn't need to)
     # sys.setrecursionlimit(10000)
 
@@ -174,76 +237,132 @@ if __name__ == 'main':
     dtensor4 = TensorType('float32', (False,)*4) # !
     input_var = dtensor4('inputs') # !
     target_var = T.ivector('targets')
-    output_layer, MEAN_IMAGE = load_vgg16('vgg16.pkl')
-    layer_one, layer_two, layer_three = strip_first_two_layers(output_layer)
-    network = init_cnn_model(layer_one.get_params(), layer_two.get_params(), layer_three.get_params(), input_var)['output']
-
-    # Create loss function
-    prediction = lasagne.layers.get_output(network)
-    loss = lasagne.objectives.binary_hinge_loss(prediction, target_var)
-    loss = loss.mean()
-
-    # Create parameter update expressions (later I will make rates adaptive)
-    params = lasagne.layers.get_all_params(network, trainable=True)
+    # Only read the three reused layers from the indexed store if it exists 
+    # ('python vgg16_store.py vgg16.pkl vgg16.lw' converts the pickle once) 
+    if os.path.exists('vgg16.lw'):
+        (layer_one, layer_two, layer_three), MEAN_IMAGE = load_vgg16_layers('vgg16.lw', ['conv1_1', 'conv1_2', 'conv2_1'])
+    else:
+        output_layer, MEAN_IMAGE = load_vgg16('vgg16.pkl')
+        layer_one, layer_two, layer_three = [layer.get_params() for layer in strip_first_two_layers(output_layer)]
+    net = init_cnn_model(layer_one, layer_two, layer_three, input_var)
+    network = net['output']
+
+    # If true, the pretrained conv layers are frozen: they get no updates and no 
+    # gradients are computed for them (no backward pass through them at all). 
+    # Otherwise they are fine-tuned at 'pretrained_lr_mult' times the learning rate 
+    # (1 fine-tunes every layer at the same rate) 
+    freeze_pretrained = False 
+    pretrained_lr_mult = 1. 
+    pretrained_layers = [net['conv1'], net['conv2'], net['conv3']]
+    if freeze_pretrained:
+        freeze_layers(pretrained_layers)
+        update = adam
+    elif pretrained_lr_mult != 1:
+        update = with_layer_multipliers(adam, dict((layer, pretrained_lr_mult) for layer in pretrained_layers))
+    else:
+        update = adam
+
+    # If true (needs 'freeze_pretrained'), the frozen layers are run once over all 
+    # images (plus 'num_feature_copies' - 1 augmented copies) and only the dense head 
+    # is trained on the cached features. Delete the cache after changing the frozen layers 
+    use_feature_cache = False 
+    if use_feature_cache and not freeze_pretrained:
+        raise ValueError('the feature cache needs freeze_pretrained')
+    feature_cache_path = '../data/train/vgg16_features.npy'
+    num_feature_copies = 4 
+
+    # Cheap validation on a fixed, label-stratified quarter of the validation 
+    # set in between full passes 
+    val_subsample = stratified_subsample(y_val, .25)
+
+    # Throughput-optimal batch size on this machine if 'autotune.py' has been run 
+    # for this model, 16 otherwise 
+    batchsize = tuned_batch_size('2d_transfer_learning', X_train.shape[1:])
+
+    # Effective batch size is batchsize * accum_steps: the gradients of 'accum_steps' 
+    # micro-batches in each training batch are summed in one Theano call before its 
+    # adam step (learning rate scaled w/ the batch size and warmed up). Not used w/ the feature cache 
+    accum_steps = 1 
+    train_batchsize = batchsize * accum_steps 
+
+    # Create loss function and parameter update expressions
     # updates = nesterov_momentum(loss, params, learning_rate=0.003,
     #                                         momentum=0.99)
-    updates = adam(loss, params)
-    test_prediction = lasagne.layers.get_output(network, deterministic=True)
-    test_loss = binary_hinge_loss(test_prediction, target_var)
-    test_loss = test_loss.mean()
-    test_acc = T.mean(T.eq(T.sgn(test_prediction), target_var),
-                  dtype=theano.config.floatX)
-
-    # Compile training function that updates parameters and returns training loss
-    train_fn = theano.function([input_var, target_var], loss, updates=updates)
-    val_fn = theano.function([input_var, target_var], [test_loss, test_acc])
-
-    num_epochs = 8000 # Will probably not do this many b/c of early stopping 
-    best_network_weights_epoch = 0 
-    epoch_accuracies = [] 
-    # Train network 
-    for epoch in range(num_epochs):
-        # In each epoch, we do a full pass over the training data:
-        train_err = 0
-        train_batches = 0
-        for batch in iterate_minibatches(X_train, y_train, 16, shuffle=True):
-            inputs, targets = batch
-            train_err += train_fn(inputs, targets)
-            train_batches += 1
-
-        # And a full pass over the validation data:
-        val_err = 0
-        val_acc = 0
-        val_batches = 0
-        for batch in iterate_minibatches(X_val, y_val, 16, shuffle=False):
-            inputs, targets = batch
-            err, acc = val_fn(inputs, targets)
-            val_err += err
-            val_acc += acc
-            val_batches += 1
-
-        # Print the results for this epoch:
-        print("  training loss:\t\t{:.6f}".format(train_err / train_batches))
-        print("  validation loss:\t\t{:.6f}".format(val_err / val_batches))
-        print("  validation accuracy:\t\t{:.2f} %".format(
-            val_acc / val_batches * 100))
-        print("Current Epoch = " + str(epoch))
-        
-        # Check if we are starting to overfit  
-        if stop_early(val_acc, epoch_accuracies): 
-            # Save best weights in models directory
-            best_weight_path = '../data/train/weights/2dcnn' + str(best_network_weights_epoch) + '.npz'
-            os.rename(best_weight_path, '../models/2d_cnn_' + str(best_network_weights_epoch) + '.npz')
-            break   
-
-        epoch_accuracies.append(val_acc)
-
-        # Save weights every 100 epochs or if best weights.  
-        save_weights(network, epoch, val_acc, epoch_accuracies) 
-
-        # Update best weights  
-        if val_acc >= np.max(epoch_accuracies):
-            best_network_weights_epoch = epoch # This epoch is best so far  
+    learning_rate = shared_learning_rate(.001) # Shared so schedules can change it 
+
+    if use_feature_cache:
+        if not os.path.exists(feature_cache_path):
+            feature_fn = theano.function([input_var], lasagne.layers.get_output(net['pool2'], deterministic=True))
+            images = np.load('../data/train/images_by_time_mat_color.npy', mmap_mode='r')[:, :, 5]
+            build_feature_cache(feature_fn, images, feature_cache_path, 
+                                num_copies=num_feature_copies, augment=distort_batch)
+        features = load_feature_cache(feature_cache_path)
+
+        # The head shares its weights w/ 'network', so the saved weights are those 
+        # of the full model. Compiling the head alone only takes seconds 
+        feature_var = T.tensor4('features')
+        head = build_head(InputLayer((None,) + features.shape[2:], input_var=feature_var), shared_from=net)
+        loss, updates, val_outputs = build_objectives(head['output'], target_var, binary_hinge_loss, 
+                                                      binary_accuracy, learning_rate=learning_rate)
+        train_fn, val_fn = compile_fns(feature_var, target_var, loss, updates, val_outputs)
+
+        # Training cycles through the (augmented) copies, validation uses the plain one 
+        def train_batches(epoch):
+            return iterate_cached_features(features, train_indcs, y_train, batchsize, shuffle=True, copy=epoch)
+
+        def val_batches(epoch):
+            return iterate_cached_features(features, test_indcs, y_val, batchsize)
+
+        def subsample_val_batches(epoch):
+            return iterate_cached_features(features, test_indcs[val_subsample], y_val[val_subsample], batchsize)
+    else:
+        loss, updates, val_outputs = build_objectives(network, target_var, binary_hinge_loss, binary_accuracy, 
+                                                      update=update, learning_rate=learning_rate)
+
+        # Compile training function that updates parameters and returns training loss
+        # Reuse the compiled functions of an earlier run of the same model if possible
+        network, (train_fn, val_fn) = cached_compile('2d_transfer', network, [input_var, target_var], 
+                                                     [loss] + val_outputs + list(updates.values()), 
+                                                     lambda: compile_fns(input_var, target_var, loss, updates, val_outputs) 
+                                                             if accum_steps == 1 else 
+                                                             compile_accumulating_fns(network, input_var, target_var, loss, val_outputs, accum_steps, batchsize, 
+                                                                                      learning_rate=learning_rate, update=update), 
+                                                     flags='accum{}x{}'.format(accum_steps, batchsize))
+
+        def train_batches(epoch):
+            return iterate_minibatches(X_train, y_train, train_batchsize, shuffle=True)
+
+        def val_batches(epoch):
+            return iterate_minibatches(X_val, y_val, batchsize, shuffle=False, augment=False)
+
+        X_val_sub, y_val_sub = X_val[val_subsample], y_val[val_subsample]
+        def subsample_val_batches(epoch):
+            return iterate_minibatches(X_val_sub, y_val_sub, batchsize, shuffle=False, augment=False)
+
+    # Halve the learning rate when validation accuracy plateaus (lr_schedule = None) or 
+    # follow a fixed 'step', 'cosine' or 'one_cycle' schedule over 'schedule_epochs' 
+    # epochs, and log how long it takes to reach the target accuracy (the cached 
+    # functions hold their own copy of the learning rate variable) 
+    lr_schedule = None 
+    schedule_epochs = 500 
+    learning_rate = find_shared_var(train_fn, 'learning_rate')
+    if lr_schedule is None:
+        scheduler = ReduceOnPlateau(learning_rate, monitor='valid_accuracy', maximize=True, patience=20)
+    else:
+        scheduler = LearningRateScheduler(learning_rate, named_schedule(lr_schedule, float(learning_rate.get_value()), 
+                                                                        schedule_epochs))
+    timer = TimeToTarget(monitor='valid_accuracy', target=.9, maximize=True)
+
+    # Train network. Weights are saved every 100 epochs or if best weights and 
+    # the best ones end up in the models directory 
+    saver = SaveWeights(network, '../data/train/weights', '../models', '2d_transfer_', 
+                        monitor='valid_accuracy', maximize=True)
+    trainer = Trainer(train_fn, val_fn, 
+                      on_epoch_finished=[saver, scheduler, timer, EarlyStopping(patience=200, monitor='valid_accuracy', maximize=True)], 
+                      on_training_finished=[saver.finish], 
+                      telemetry_path='../data/train/2d_transfer_telemetry.jsonl')
+    trainer.fit(train_batches, val_batches, num_epochs=8000, 
+                subsample_val_batches=subsample_val_batches, full_val_every=10) # Will probably not do this many b/c of early stopping 
 
     # Save Model (Not doing anymore - just use 'load_3dcnn_model' instead)
     # with open('../model/network.pickle', 'wb') as f:
@@ -21,7 +21,7 @@ import numpy as np
 import cPickle as pickle
 
 from lasagne.layers import InputLayer, DenseLayer, NonlinearityLayer, DropoutLayer
-from lasagne.layers.dnn import Conv3DDNNLayer, MaxPool3DDNNLayer
+from backend import Conv3DLayer, MaxPool3DLayer
 from lasagne.objectives import binary_hinge_loss
 from lasagne.updates import adam
 from lasagne import layers
@@ -45,14 +45,14 @@ def build_layers():
     """
     layers=[
         ('input', InputLayer),
-        ('conv1', Conv3DDNNLayer),
-        ('pool1', MaxPool3DDNNLayer),
+        ('conv1', Conv3DLayer),
+        ('pool1', MaxPool3DLayer),
         ('dropout1', DropoutLayer),  
-        ('conv2', Conv3DDNNLayer),
-        ('pool2', MaxPool3DDNNLayer),
+        ('conv2', Conv3DLayer),
+        ('pool2', MaxPool3DLayer),
         ('dropout2', DropoutLayer),  
-        ('conv3', Conv3DDNNLayer),
-        ('pool3', MaxPool3DDNNLayer),
+        ('conv3', Conv3DLayer),
+        ('pool3', MaxPool3DLayer),
         ('dropout3', DropoutLayer),  
         ('hidden4', DenseLayer),
         ('dropout4', DropoutLayer),  
@@ -96,8 +96,7 @@ class FlipBatchIterator(BatchIterator):
         flip_indcs = indices[0:distorts_per_cat]
         rotate_indcs = indices[distorts_per_cat:(2*distorts_per_cat)]
         Xb[flip_indcs] = Xb[flip_indcs, :, :, ::-1] #Verify good flip 
-        for i in rotate_indcs:
-            Xb[i, :, :, :, :] = random_image_generator(Xb[i, :, :, :, :])
+        Xb[rotate_indcs] = random_clip_generator(Xb[rotate_indcs], batched=True)
         return Xb, yb
 
 class EarlyStopping(object):
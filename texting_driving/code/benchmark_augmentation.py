@@ -0,0 +1,174 @@
+# Benchmarks the throughput of the minibatch augmentation (shift, flip and
+# rotate) on synthetic batches so we can tell whether it keeps up with the
+# model. Runs on a CPU-only machine - no Theano/Lasagne needed.
+
+# Usage (from the code folder):
+#   $python benchmark_augmentation.py                 prints the results
+#   $python benchmark_augmentation.py results.json    also saves them
+#   $python benchmark_augmentation.py new.json old.json
+#       saves the results and exits w/ status 1 if any path got > 20% slower
+
+from __future__ import division
+
+import sys
+import json
+import timeit
+import numpy as np
+
+from scipy.ndimage import rotate
+from random_image_generator import shift_image, random_clip_generator
+from preaugment_epochs import distort_batch
+
+try:
+    import tracemalloc # Python 3 only, numpy reports its buffers to it
+except ImportError:
+    tracemalloc = None
+
+# Sample shapes of the texting 3D clips and the comma camera frames
+SHAPES = {'texting_3d': (1, 10, 81, 144), 'sdc_2d': (3, 160, 320)}
+
+def time_op(fn, repeats=10):
+    """
+    Overview:
+        Times 'fn' after one warm-up call.
+    ----------
+    fn: function
+        Called w/o arguments
+
+    repeats: int
+        The number of timed calls
+
+    Returns
+    -------
+    seconds: float
+        Mean wall time per call
+
+    peak_bytes: int
+        Peak memory allocated during one call (None if tracemalloc
+        is not available)
+    """
+    fn()
+    start = timeit.default_timer()
+    for _ in range(repeats):
+        fn()
+    seconds = (timeit.default_timer() - start) / repeats
+
+    peak_bytes = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        fn()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak_bytes
+
+def benchmark_shape(sample_shape, batchsize=16, repeats=10):
+    """
+    Overview:
+        Benchmarks every augmentation path on a random float32 batch
+        of shape (batchsize,) + sample_shape.
+    ----------
+    sample_shape: tuple
+        Shape of one sample, e.g. (1, 10, 81, 144)
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    repeats: int
+        The number of timed calls per path
+
+    Returns
+    -------
+    results: dict
+        Maps the path name to a dict w/ 'seconds' (per call),
+        'samples_per_sec' and 'peak_bytes'
+    """
+    batch = np.random.rand(*((batchsize,) + tuple(sample_shape))).astype(np.float32)
+    sample = batch[0]
+    num_changes = int(batchsize * .75)
+    distorts_per_cat = int(num_changes / 2)
+    flip_indcs = np.arange(distorts_per_cat)
+    ndim = sample.ndim
+
+    def flip():
+        batch[flip_indcs] = batch[flip_indcs, ..., ::-1]
+
+    # (function, number of samples processed per call)
+    paths = [
+        ('shift', lambda: shift_image(sample, 'up'), 1),
+        ('flip', flip, distorts_per_cat),
+        ('rotate', lambda: rotate(sample, 17, axes=(ndim - 1, ndim - 2), reshape=False), 1),
+        ('random_clip_generator', lambda: random_clip_generator(batch[:distorts_per_cat], batched=True),
+         distorts_per_cat),
+        # Same 3/4 flip/rotate policy as 'iterate_minibatches' and 'FlipBatchIterator'
+        ('iterate_minibatches', lambda: distort_batch(batch), batchsize),
+    ]
+    results = {}
+    for name, fn, num_samples in paths:
+        seconds, peak_bytes = time_op(fn, repeats)
+        results[name] = {'seconds': seconds,
+                         'samples_per_sec': num_samples / seconds,
+                         'peak_bytes': peak_bytes}
+    return results
+
+def print_results(all_results):
+    """
+    Prints one table per sample shape
+    """
+    for shape_name in sorted(all_results):
+        print(shape_name)
+        print('  {:<24}{:>12}{:>16}{:>14}'.format('path', 'ms / call', 'samples / sec', 'peak MB'))
+        for name, result in sorted(all_results[shape_name].items()):
+            peak = result['peak_bytes']
+            peak = '-' if peak is None else '{:.1f}'.format(peak / 2**20)
+            print('  {:<24}{:>12.2f}{:>16.1f}{:>14}'.format(
+                name, result['seconds'] * 1000, result['samples_per_sec'], peak))
+
+def find_regressions(all_results, baseline, tolerance=.2):
+    """
+    Overview:
+        Compares samples/sec against a previous run.
+    ----------
+    all_results: dict
+        Output of this run
+
+    baseline: dict
+        Output of an earlier run (e.g. loaded from its .json file)
+
+    tolerance: float
+        Allowed relative slowdown
+
+    Returns
+    -------
+    regressions: list
+        (shape name, path, old samples/sec, new samples/sec) tuples
+    """
+    regressions = []
+    for shape_name, results in all_results.items():
+        for name, result in results.items():
+            old = baseline.get(shape_name, {}).get(name)
+            if old is None:
+                continue
+            if result['samples_per_sec'] < (1 - tolerance) * old['samples_per_sec']:
+                regressions.append((shape_name, name, old['samples_per_sec'],
+                                    result['samples_per_sec']))
+    return regressions
+
+if __name__ == '__main__':
+
+    np.random.seed(0)
+    all_results = {}
+    for shape_name, sample_shape in SHAPES.items():
+        all_results[shape_name] = benchmark_shape(sample_shape)
+    print_results(all_results)
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as f:
+            json.dump(all_results, f, indent=2, sort_keys=True)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(all_results, baseline)
+        for shape_name, name, old, new in regressions:
+            print('REGRESSION {} {}: {:.1f} -> {:.1f} samples / sec'.format(shape_name, name, old, new))
+        if regressions:
+            sys.exit(1)
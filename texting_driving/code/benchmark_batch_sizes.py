@@ -0,0 +1,72 @@
+# Measures training throughput of the 3D CNN at several effective batch
+# sizes (16 * accum_steps, see 'large_batch.py') on synthetic clips. The
+# micro-batch stays at 16, so the memory ceiling is the same for all runs.
+
+# Usage (from the code folder):
+#   $python benchmark_batch_sizes.py            accum_steps 1, 2, 4 and 8
+#   $python benchmark_batch_sizes.py 1 16       chosen accum_steps
+
+from __future__ import division
+
+import sys
+import timeit
+import importlib
+import numpy as np
+import theano.tensor as T
+
+from theano.tensor import TensorType
+from lasagne.objectives import binary_hinge_loss
+from trainer import build_objectives, compile_fns, binary_accuracy
+from large_batch import compile_accumulating_fns
+
+# Module names can't start w/ a digit in an import statement
+cnn = importlib.import_module('3d_cnn_lasagne')
+
+def samples_per_sec(accum_steps, micro_batchsize=16, num_updates=5, clip_shape=(1, 10, 81, 144)):
+    """
+    Overview:
+        Compiles a fresh 3D CNN and times 'num_updates' parameter
+        updates (after one warm-up update).
+    ----------
+    accum_steps: int
+        Micro-batches per update (1 uses the plain 'train_fn')
+
+    micro_batchsize: int
+        The size of each micro-batch
+
+    num_updates: int
+        The number of timed updates
+
+    clip_shape: tuple
+        Shape of one sample
+
+    Returns
+    -------
+    samples_per_sec: float
+    """
+    input_var = TensorType('float32', (False,)*5)('inputs')
+    target_var = T.ivector('targets')
+    network = cnn.build_cnn(input_var)['output']
+    loss, updates, val_outputs = build_objectives(network, target_var, binary_hinge_loss, binary_accuracy)
+    if accum_steps == 1:
+        train_fn, val_fn = compile_fns(input_var, target_var, loss, updates, val_outputs)
+    else:
+        train_fn, val_fn = compile_accumulating_fns(network, input_var, target_var, loss,
+                                                    val_outputs, accum_steps, micro_batchsize)
+
+    batchsize = accum_steps * micro_batchsize # One call per update
+    inputs = np.random.rand(*((batchsize,) + tuple(clip_shape))).astype(np.float32)
+    targets = np.sign(np.random.randn(batchsize)).astype(np.int32)
+    train_fn(inputs, targets)
+    start = timeit.default_timer()
+    for _ in range(num_updates):
+        train_fn(inputs, targets)
+    return num_updates * batchsize / (timeit.default_timer() - start)
+
+if __name__ == '__main__':
+
+    all_accum_steps = [int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8]
+    print('{:>12}{:>18}{:>16}'.format('accum_steps', 'effective batch', 'samples / sec'))
+    for accum_steps in all_accum_steps:
+        print('{:>12}{:>18}{:>16.1f}'.format(accum_steps, 16 * accum_steps,
+                                              samples_per_sec(accum_steps)))
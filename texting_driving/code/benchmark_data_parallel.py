@@ -0,0 +1,66 @@
+# Measures how training throughput scales w/ the number of data-parallel
+# worker processes (see 'data_parallel.py') for the 3D CNN on random
+# inputs. Run it w/ OMP_NUM_THREADS=1 so every worker keeps to one core.
+
+# Usage (from the code folder): $OMP_NUM_THREADS=1 python benchmark_data_parallel.py
+
+from __future__ import division
+
+import timeit
+import importlib
+import numpy as np
+import theano.tensor as T
+
+from theano.tensor import TensorType
+from lasagne.objectives import binary_hinge_loss
+from data_parallel import DataParallelTrainFn, make_replica_fn, physical_cores
+
+# Module names can't start w/ a digit in an import statement
+cnn = importlib.import_module('3d_cnn_lasagne')
+
+def samples_per_sec(num_workers, mode='allreduce', batchsize=16, repeats=10):
+    """
+    Overview:
+        Starts 'num_workers' workers and times the training steps (after
+        one warm-up step).
+    ----------
+    num_workers: int
+        The number of worker processes
+
+    mode: string
+        'allreduce' or 'average', see 'DataParallelTrainFn'
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    repeats: int
+        The number of timed steps
+
+    Returns
+    -------
+    samples_per_sec: float
+        Training throughput
+    """
+    dtensor5 = TensorType('float32', (False,)*5)
+    network = cnn.build_cnn(dtensor5('inputs'))['output']
+    replica_fn = make_replica_fn(cnn.build_cnn, dtensor5, T.ivector, binary_hinge_loss)
+    train_fn = DataParallelTrainFn(replica_fn, network, (1, 10, 81, 144), np.int32, num_workers,
+                                   max_batchsize=batchsize, mode=mode)
+    try:
+        inputs = np.random.rand(batchsize, 1, 10, 81, 144).astype(np.float32)
+        targets = np.sign(np.random.randn(batchsize)).astype(np.int32)
+        train_fn(inputs, targets)
+        start = timeit.default_timer()
+        for _ in range(repeats):
+            train_fn(inputs, targets)
+        return batchsize * repeats / (timeit.default_timer() - start)
+    finally:
+        train_fn.close()
+
+if __name__ == '__main__':
+
+    baseline = None
+    for num_workers in range(1, physical_cores() + 1):
+        speed = samples_per_sec(num_workers)
+        baseline = baseline or speed
+        print('{} workers:\t{:.1f} samples/sec\t{:.2f}x'.format(num_workers, speed, speed / baseline))
@@ -0,0 +1,79 @@
+# Compares the training step time of the transfer learning model w/ the
+# pretrained VGG16 convolutions frozen vs. fine-tuned (see
+# 'freeze_pretrained' in 2d_transfer_learning.py). Uses random weights and
+# inputs, so 'vgg16.pkl' is not needed (the Model Zoo's vgg16.py is).
+
+# Usage (from the code folder): $python benchmark_freezing.py
+
+from __future__ import division
+
+import timeit
+import importlib
+import numpy as np
+import theano
+import theano.tensor as T
+
+from theano.tensor import TensorType
+from lasagne.objectives import binary_hinge_loss
+from lasagne.updates import adam
+from trainer import build_objectives, compile_fns, binary_accuracy
+from varying_learning_rates import freeze_layers, with_layer_multipliers
+
+# Module names can't start w/ a digit in an import statement
+transfer = importlib.import_module('2d_transfer_learning')
+
+# (W, b) shapes of the three VGG16 conv layers the model reuses
+PRETRAINED_SHAPES = [((64, 3, 3, 3), (64,)), ((64, 64, 3, 3), (64,)), ((128, 64, 3, 3), (128,))]
+
+def step_time(freeze, batchsize=16, repeats=10):
+    """
+    Overview:
+        Compiles the transfer learning model and times 'train_fn'
+        (after one warm-up call).
+    ----------
+    freeze: boolean
+        If true, the pretrained convolutions are frozen. Otherwise they
+        are fine-tuned at .1 times the learning rate.
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    repeats: int
+        The number of timed steps
+
+    Returns
+    -------
+    seconds: float
+        Mean time per training step
+    """
+    floatX = theano.config.floatX
+    layer_params = [[theano.shared(np.random.randn(*shape).astype(floatX) * .01) for shape in shapes]
+                    for shapes in PRETRAINED_SHAPES]
+    input_var = TensorType('float32', (False,)*4)('inputs')
+    target_var = T.ivector('targets')
+    net = transfer.init_cnn_model(layer_params[0], layer_params[1], layer_params[2], input_var)
+    pretrained_layers = [net['conv1'], net['conv2'], net['conv3']]
+    if freeze:
+        freeze_layers(pretrained_layers)
+        update = adam
+    else:
+        update = with_layer_multipliers(adam, dict((layer, .1) for layer in pretrained_layers))
+    loss, updates, val_outputs = build_objectives(net['output'], target_var, binary_hinge_loss,
+                                                  binary_accuracy, update=update)
+    train_fn, val_fn = compile_fns(input_var, target_var, loss, updates, val_outputs)
+
+    inputs = np.random.rand(batchsize, 3, 81, 144).astype(np.float32)
+    targets = np.sign(np.random.randn(batchsize)).astype(np.int32)
+    train_fn(inputs, targets)
+    start = timeit.default_timer()
+    for _ in range(repeats):
+        train_fn(inputs, targets)
+    return (timeit.default_timer() - start) / repeats
+
+if __name__ == '__main__':
+
+    unfrozen = step_time(freeze=False)
+    frozen = step_time(freeze=True)
+    print('fine-tuned step:\t{:.1f} ms'.format(unfrozen * 1000))
+    print('frozen step:\t\t{:.1f} ms'.format(frozen * 1000))
+    print('speedup:\t\t{:.2f}x'.format(unfrozen / frozen))
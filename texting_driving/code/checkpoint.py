@@ -0,0 +1,336 @@
+# Writes weight checkpoints on a background thread so that saving never
+# stalls training, and prunes old checkpoints so they do not pile up.
+
+# A checkpoint is first written to 'PATH.tmp' and then renamed, so a crash
+# mid-write never leaves a truncated .npz where a good one is expected.
+
+# 'TrainingState' is the resume checkpoint for preemptible machines: besides
+# the weights it holds the optimizer's shared variables (adam moments and
+# step), the dropout and numpy RNG states, the history and the callbacks'
+# early stopping/best weight bookkeeping.
+
+from __future__ import division
+
+import os
+import sys
+import signal
+import threading
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import numpy as np
+
+def write_npz_atomic(path, arrays):
+    """
+    Overview:
+        Saves 'arrays' like np.savez(path, *arrays) but via a temporary
+        file and a rename.
+    ----------
+    path: string
+        Destination, e.g. '../data/weights/train/2dcnn100.npz'
+
+    arrays: list
+        Numpy arrays, stored as 'arr_0', 'arr_1', ...
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f: # A file object stops savez from appending '.npz'
+        np.savez(f, *arrays)
+    os.rename(tmp_path, path)
+
+class CheckpointManager(object):
+    """
+    Overview:
+        Queues checkpoints for a writer thread and keeps only the last
+        'keep_last' and the best 'keep_best' of them on disk. 'save'
+        returns as soon as the arrays are queued.
+    ----------
+    directory: string
+        Where the checkpoints are written ('NameEPOCH.npz')
+
+    name: string
+        File name prefix, e.g. '3d_cnn_'
+
+    keep_last: int
+        Defaults to 5. The most recent checkpoints to keep
+
+    keep_best: int
+        Defaults to 3. The best scoring checkpoints to keep
+
+    maximize: boolean
+        Defaults to false. Set to true if the scores are accuracies
+    """
+    def __init__(self, directory, name, keep_last=5, keep_best=3, maximize=False):
+        self.directory = directory
+        self.name = name
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.maximize = maximize
+        self.written = [] # (epoch, score, path) of the checkpoints on disk
+        self._queue = queue.Queue()
+        self._error = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def path(self, epoch):
+        return os.path.join(self.directory, self.name + str(epoch) + '.npz')
+
+    def save(self, epoch, arrays, score=None):
+        """
+        Overview:
+            Queues a checkpoint. The arrays must not be modified afterwards,
+            so pass copies (e.g. lasagne.layers.get_all_param_values).
+        ----------
+        epoch: int
+            The current epoch of training
+
+        arrays: list
+            Numpy arrays to store
+
+        score: float
+            Defaults to None. Validation score used for 'keep_best'.
+            Checkpoints w/o a score are only kept as recent ones.
+        """
+        self._raise_error()
+        self._queue.put((epoch, list(arrays), score))
+
+    def wait(self):
+        """
+        Blocks until every queued checkpoint is on disk
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        """
+        Writes the remaining checkpoints and stops the writer thread
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    @property
+    def best_path(self):
+        """
+        Path of the best scoring checkpoint on disk (None if no
+        checkpoint had a score)
+        """
+        with self._lock:
+            scored = [c for c in self.written if c[1] is not None]
+        if not scored:
+            return None
+        best = max(scored, key=lambda c: c[1]) if self.maximize else min(scored, key=lambda c: c[1])
+        return best[2]
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                epoch, arrays, score = item
+                if not os.path.exists(self.directory):
+                    os.makedirs(self.directory)
+                path = self.path(epoch)
+                write_npz_atomic(path, arrays)
+                with self._lock:
+                    self.written = [c for c in self.written if c[2] != path] + [(epoch, score, path)]
+                    removed = self._prune()
+                for old_path in removed:
+                    if os.path.exists(old_path):
+                        os.remove(old_path)
+            except Exception as e: # Surfaced on the training thread by the next call
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def get_state(self):
+        with self._lock:
+            return list(self.written)
+
+    def set_state(self, written):
+        """
+        Restores the bookkeeping of a resumed run. Checkpoints that never
+        made it to disk are dropped.
+        """
+        with self._lock:
+            self.written = [c for c in written if os.path.exists(c[2])]
+
+    def _prune(self):
+        """
+        Drops the checkpoints that are neither recent nor among the best
+        from 'written' and returns their paths
+        """
+        recent = sorted(self.written, key=lambda c: c[0])
+        keep = set(c[2] for c in recent[len(recent) - self.keep_last:]) if self.keep_last > 0 else set()
+        scored = sorted([c for c in self.written if c[1] is not None],
+                        key=lambda c: c[1], reverse=self.maximize)
+        keep.update(c[2] for c in scored[:self.keep_best])
+        removed = [c[2] for c in self.written if c[2] not in keep]
+        self.written = [c for c in self.written if c[2] in keep]
+        return removed
+
+def training_state_vars(train_fn):
+    """
+    Overview:
+        Returns every shared variable 'train_fn' updates: the parameters,
+        the optimizer state (e.g. adam's moments and time step) and the
+        RNG states of dropout layers. Taken from the compiled function, so
+        it also works for functions loaded by 'cached_compile'.
+    ----------
+    train_fn: Theano function
+        The compiled training function (or an object w/ a 'functions'
+        list, e.g. 'AccumulatingTrainFn'). Raises a ValueError if its
+        'resumable' attribute is false
+
+    Returns
+    -------
+    state_vars: list
+        Theano shared variables
+    """
+    if not getattr(train_fn, 'resumable', True):
+        raise ValueError('this train_fn keeps state outside the main process and can\'t '
+                         'be checkpointed (e.g. DataParallelTrainFn in \'average\' mode)')
+    state_vars = []
+    for fn in getattr(train_fn, 'functions', [train_fn]):
+        for i in fn.maker.inputs:
+            if i.update is not None and i.variable not in state_vars:
+                state_vars.append(i.variable)
+    return state_vars
+
+def load_extras(path):
+    """
+    Returns the 'extras' dict of the training state at 'path' (None if
+    there is nothing to resume), e.g. to reuse the train/val split
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)['extras']
+
+class TrainingState(object):
+    """
+    Overview:
+        An on_epoch_finished callback that snapshots the full training
+        state after every epoch and writes it to 'path' every 'every'
+        epochs on a background thread. 'restore' puts a saved state back
+        so 'Trainer.fit' continues w/ the next epoch. Put it after the
+        other callbacks so their state for the epoch is included.
+    ----------
+    path: string
+        The state file, e.g. '../data/train/3d_cnn_state.pkl'
+
+    state_vars: list
+        Shared variables to save (see 'training_state_vars')
+
+    callbacks: list
+        Objects w/ get_state()/set_state(state), e.g. 'EarlyStopping'
+        and 'SaveWeights'
+
+    every: int
+        Defaults to 1. Write the state every 'every' epochs
+
+    extras: dict
+        Anything else the script needs to resume (e.g. the train/val
+        split), read back w/ 'load_extras'
+    """
+    def __init__(self, path, state_vars, callbacks=(), every=1, extras=None):
+        self.path = path
+        self.state_vars = state_vars
+        self.callbacks = list(callbacks)
+        self.every = every
+        self.extras = extras
+        self.latest = None # Snapshot of the last finished epoch
+        self.latest_written = False
+        self._writer = None
+
+    def snapshot(self, trainer):
+        return {'values': [var.get_value() for var in self.state_vars],
+                'np_random': np.random.get_state(),
+                'history': list(trainer.history),
+                'callbacks': [callback.get_state() for callback in self.callbacks],
+                'extras': self.extras}
+
+    def __call__(self, trainer, history):
+        self.latest = self.snapshot(trainer)
+        self.latest_written = False
+        if history[-1]['epoch'] % self.every == 0:
+            self._join()
+            self._writer = threading.Thread(target=self._write, args=(self.latest,))
+            self._writer.start()
+
+    def _join(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _write(self, state):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(state, f, -1)
+        os.rename(tmp_path, self.path)
+        if state is self.latest:
+            self.latest_written = True
+
+    def flush(self):
+        """
+        Makes sure the snapshot of the last finished epoch is on disk
+        """
+        self._join()
+        if self.latest is not None and not self.latest_written:
+            self._write(self.latest)
+
+    def restore(self, trainer):
+        """
+        Overview:
+            Loads the state at 'path' (if any) into the shared variables,
+            numpy's RNG, 'trainer' and the callbacks.
+        ----------
+        trainer: Trainer
+            Its history is replaced, so 'fit' resumes after the last epoch
+
+        Returns
+        -------
+        resumed: boolean
+            False if there was no state to resume
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as f:
+            state = pickle.load(f)
+        for var, value in zip(self.state_vars, state['values']):
+            var.set_value(value)
+        np.random.set_state(state['np_random'])
+        trainer.history = state['history']
+        for callback, callback_state in zip(self.callbacks, state['callbacks']):
+            callback.set_state(callback_state)
+        print('Resuming after epoch ' + str(len(trainer.history) - 1))
+        return True
+
+    def handle_sigterm(self):
+        """
+        On SIGTERM (e.g. preemption), writes the last finished epoch's
+        state and exits. The epoch in progress is redone on resume.
+        """
+        def handler(signum, frame):
+            print('SIGTERM received - saving training state')
+            self.flush()
+            sys.exit(128 + signum)
+        signal.signal(signal.SIGTERM, handler)
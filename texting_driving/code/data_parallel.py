@@ -0,0 +1,336 @@
+# Data-parallel training on CPU-only machines: N worker processes each hold
+# a replica of the network and work on 1/N of every minibatch. Minibatches,
+# gradients and parameters are exchanged through shared memory, so only
+# short commands go through the pipes.
+
+# Two modes:
+# - 'allreduce' (synchronous): the workers compute the gradients of their
+#   shards, the main process averages them, applies the update (adam) to its
+#   own network and publishes the new parameters before the next step. This
+#   is mathematically the same as single-process training on the full batch
+#   (apart from batch normalization statistics, which each worker collects
+#   over its shard and the main process averages after every step).
+# - 'average': every worker trains its replica w/ its own optimizer on its
+#   shard and the parameters are averaged every 'sync_every' steps (cheaper
+#   synchronization, slightly different training dynamics). The replicas
+#   are also averaged at the end of every epoch, so validation and saving
+#   see the current parameters. The adam state lives in the workers, so
+#   training in this mode can't be resumed from a 'TrainingState' checkpoint.
+
+# Every parameter of the network is exchanged, not only the trainable ones,
+# so batch normalization's running mean / inv_std are averaged as well.
+
+# Start one worker per physical core and keep each single-threaded (e.g.
+# OMP_NUM_THREADS=1), otherwise the workers fight over the cores.
+
+from __future__ import division
+
+import traceback
+import multiprocessing
+import numpy as np
+import lasagne
+import theano
+
+from lasagne.updates import adam
+
+def _context():
+    # The workers inherit the replica builder, so they have to be forked
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('fork')
+    return multiprocessing
+
+def _shared_array(ctx, shape, dtype):
+    """
+    Returns a raw shared memory block and a numpy view of it
+    """
+    dtype = np.dtype(dtype)
+    raw = ctx.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return raw, np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+def physical_cores():
+    """
+    The number of physical cores (falls back to logical ones w/o psutil)
+    """
+    try:
+        import psutil
+        return psutil.cpu_count(logical=False) or multiprocessing.cpu_count()
+    except ImportError:
+        return multiprocessing.cpu_count()
+
+def make_replica_fn(build_cnn, input_type, target_type, objective):
+    """
+    Overview:
+        Returns a function that builds one replica: replica_fn() ->
+        (network, input_var, target_var, loss).
+    ----------
+    build_cnn: function
+        build_cnn(input_var) -> dict of layers w/ an 'output' layer
+
+    input_type: Theano type
+        E.g. TensorType('float32', (False,)*5)
+
+    target_type: Theano type
+        E.g. T.ivector
+
+    objective: function
+        Elementwise loss, e.g. lasagne.objectives.binary_hinge_loss
+    """
+    def replica_fn():
+        input_var = input_type('inputs')
+        target_var = target_type('targets')
+        network = build_cnn(input_var)['output']
+        loss = objective(lasagne.layers.get_output(network), target_var).mean()
+        return network, input_var, target_var, loss
+    return replica_fn
+
+class _ParamLayout(object):
+    """
+    Offsets of each parameter in a flat float32 vector (all parameters,
+    incl. non-trainable ones like batch normalization statistics)
+    """
+    def __init__(self, params):
+        self.shapes = [p.get_value(borrow=True).shape for p in params]
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        self.size = int(self.offsets[-1])
+
+    def split(self, flat):
+        return [flat[self.offsets[i]:self.offsets[i + 1]].reshape(shape)
+                for i, shape in enumerate(self.shapes)]
+
+    def read(self, params, flat):
+        for param, value in zip(params, self.split(flat)):
+            param.set_value(np.array(value, dtype=param.dtype))
+
+    def write(self, params, flat):
+        for param, view in zip(params, self.split(flat)):
+            view[...] = param.get_value(borrow=True)
+
+def _worker(conn, replica_fn, mode, learning_rate, buffers, slot, seed):
+    try:
+        # Forked workers start w/ the same RNG state - give each its own dropout masks
+        np.random.seed(seed)
+        lasagne.random.set_rng(np.random.RandomState(seed))
+        network, input_var, target_var, loss = replica_fn()
+        params = lasagne.layers.get_all_params(network)
+        trainable = lasagne.layers.get_all_params(network, trainable=True)
+        layout = _ParamLayout(params)
+        inputs, targets, shared_params, slots = [np.frombuffer(raw, dtype=dtype).reshape(shape)
+                                                 for raw, dtype, shape in buffers]
+        if mode == 'allreduce':
+            # Also runs the default updates, i.e. batch normalization statistics
+            grad_fn = theano.function([input_var, target_var], [loss] + theano.grad(loss, trainable))
+        else:
+            # Set to the main process' rate before every step
+            learning_rate = theano.shared(np.asarray(learning_rate, dtype=theano.config.floatX))
+            train_fn = theano.function([input_var, target_var], loss,
+                                       updates=adam(loss, trainable, learning_rate=learning_rate))
+        layout.read(params, shared_params)
+        conn.send(('ready', None))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+        return
+
+    my_slot = slots[slot]
+    while True:
+        command = conn.recv()
+        if command is None:
+            return
+        try:
+            name, start, stop, value = command
+            if name == 'grad':
+                layout.read(params, shared_params)
+                outputs = grad_fn(inputs[start:stop], targets[start:stop])
+                # Gradients of the trainable parameters, values of the others
+                grads = dict(zip(trainable, outputs[1:]))
+                for param, view in zip(params, layout.split(my_slot)):
+                    view[...] = grads[param] if param in grads else param.get_value(borrow=True)
+                conn.send(('ok', float(outputs[0])))
+            elif name == 'train':
+                learning_rate.set_value(np.asarray(value, dtype=learning_rate.dtype))
+                conn.send(('ok', float(train_fn(inputs[start:stop], targets[start:stop]))))
+            elif name == 'push':
+                layout.write(params, my_slot)
+                conn.send(('ok', None))
+            elif name == 'pull':
+                layout.read(params, shared_params)
+                conn.send(('ok', None))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+
+class DataParallelTrainFn(object):
+    """
+    Overview:
+        A drop-in replacement for 'train_fn': train_fn(inputs, targets)
+        splits the minibatch over 'num_workers' processes and returns the
+        mean loss. The main process' 'network' holds the current
+        parameters after every step ('allreduce') or epoch ('average',
+        see 'finish_epoch'), so the usual 'val_fn' and 'SaveWeights' work
+        on it.
+        Call 'close' (e.g. as an on_training_finished callback) to stop
+        the workers. Non-trainable parameters (batch normalization
+        statistics) are averaged over the workers.
+    ----------
+    replica_fn: function
+        Builds a replica, see 'make_replica_fn'
+
+    network: Lasagne object
+        The main process' network (same architecture)
+
+    sample_shape: tuple
+        Shape of one input sample, e.g. (1, 10, 81, 144)
+
+    target_dtype: numpy dtype
+        E.g. np.int32 for +/-1 labels or np.float32 for angles
+
+    num_workers: int
+        Defaults to the number of physical cores
+
+    max_batchsize: int
+        Defaults to 16. The largest minibatch that will be passed in
+
+    mode: string
+        'allreduce' (default) or 'average'
+
+    sync_every: int
+        Defaults to 10. Steps between parameter averaging ('average' only)
+
+    learning_rate: float or Theano shared variable
+        Defaults to .001. A shared variable (see 'shared_learning_rate')
+        can be changed by schedules in both modes ('find_shared_var'
+        finds it). In 'average' mode each worker's step uses its current
+        value.
+    """
+    def __init__(self, replica_fn, network, sample_shape, target_dtype, num_workers=None,
+                 max_batchsize=16, mode='allreduce', sync_every=10, learning_rate=.001):
+        if mode not in ('allreduce', 'average'):
+            raise ValueError("mode must be 'allreduce' or 'average'")
+        self.num_workers = num_workers or physical_cores()
+        self.mode = mode
+        self.sync_every = sync_every
+        self.steps = 0
+        self.params = lasagne.layers.get_all_params(network)
+        self.trainable = lasagne.layers.get_all_params(network, trainable=True)
+        self.layout = _ParamLayout(self.params)
+
+        ctx = _context()
+        specs = [((max_batchsize,) + tuple(sample_shape), np.float32),
+                 ((max_batchsize,), target_dtype),
+                 ((self.layout.size,), np.float32),
+                 ((self.num_workers, self.layout.size), np.float32)]
+        raws, views = [], []
+        for shape, dtype in specs:
+            raw, view = _shared_array(ctx, shape, dtype)
+            raws.append((raw, np.dtype(dtype), shape))
+            views.append(view)
+        self.inputs, self.targets, self.shared_params, self.slots = views
+        self.layout.write(self.params, self.shared_params)
+
+        floatX = theano.config.floatX
+        if not isinstance(learning_rate, theano.compile.SharedVariable):
+            learning_rate = theano.shared(np.asarray(learning_rate, dtype=floatX), name='learning_rate')
+        self.learning_rate = learning_rate
+        if mode == 'allreduce':
+            grad_vars = [theano.tensor.TensorType(p.dtype, p.broadcastable)() for p in self.trainable]
+            self.apply_fn = theano.function(grad_vars, [], updates=adam(grad_vars, self.trainable,
+                                                                        learning_rate=learning_rate))
+            self.functions = [self.apply_fn]
+        else:
+            # Updates nothing - only lets 'find_shared_var' see the learning rate
+            self.functions = [theano.function([], learning_rate)]
+
+        self.conns, self.workers = [], []
+        seeds = np.random.randint(2**31 - 1, size=self.num_workers)
+        for slot in range(self.num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            worker = ctx.Process(target=_worker, args=(child_conn, replica_fn, mode, float(learning_rate.get_value()),
+                                                       raws, slot, int(seeds[slot])))
+            worker.daemon = True
+            worker.start()
+            self.conns.append(parent_conn)
+            self.workers.append(worker)
+        self._gather() # Wait until every replica is compiled
+
+    def _gather(self):
+        results = []
+        for conn in self.conns:
+            status, result = conn.recv()
+            if status == 'error':
+                for worker in self.workers:
+                    worker.terminate()
+                self.conns, self.workers = [], []
+                raise RuntimeError('Worker failed:\n' + result)
+            results.append(result)
+        return results
+
+    def _broadcast(self, name, bounds=None, value=None):
+        for i, conn in enumerate(self.conns):
+            if bounds is None:
+                conn.send((name, 0, 0, value))
+            else:
+                conn.send((name, bounds[i], bounds[i + 1], value))
+        return self._gather()
+
+    def __call__(self, inputs, targets):
+        num_samps = len(inputs)
+        self.inputs[:num_samps] = inputs
+        self.targets[:num_samps] = targets
+        bounds = np.linspace(0, num_samps, self.num_workers + 1).astype(int)
+        counts = np.diff(bounds)
+
+        if self.mode == 'allreduce':
+            losses = self._broadcast('grad', bounds)
+            # Shard gradients (and statistics) are means, weight them by shard size
+            mean = np.tensordot(counts / num_samps, self.slots, axes=1).astype(np.float32)
+            values = dict(zip(self.params, self.layout.split(mean)))
+            self.apply_fn(*[values[p].astype(p.dtype) for p in self.trainable])
+            for param in self.params:
+                if param not in self.trainable:
+                    param.set_value(values[param].astype(param.dtype))
+            self.layout.write(self.params, self.shared_params)
+        else:
+            losses = self._broadcast('train', bounds, float(self.learning_rate.get_value()))
+            self.steps += 1
+            if self.steps % self.sync_every == 0:
+                self.synchronize()
+        return np.dot(counts, losses) / num_samps
+
+    def finish_epoch(self):
+        """
+        Called by 'Trainer' after every training pass: averages the
+        replicas ('average' mode) so the main network is current for
+        validation and saving
+        """
+        if self.mode == 'average' and self.steps % self.sync_every != 0:
+            self.synchronize()
+
+    def synchronize(self):
+        """
+        Averages the replicas' parameters into the main network and the
+        replicas ('average' mode)
+        """
+        self._broadcast('push')
+        self.shared_params[...] = self.slots.mean(axis=0)
+        self.layout.read(self.params, self.shared_params)
+        self._broadcast('pull')
+
+    @property
+    def resumable(self):
+        # 'average' mode keeps the optimizer state in the worker processes
+        return self.mode == 'allreduce'
+
+    def close(self, *args):
+        """
+        Stops the workers. Takes (and ignores) the callback arguments so
+        it can be used as an on_training_finished callback.
+        """
+        if self.mode == 'average' and self.workers and all(w.is_alive() for w in self.workers):
+            self.synchronize()
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.conns, self.workers = [], []
@@ -0,0 +1,114 @@
+# Caches the outputs of frozen layers (e.g. the pretrained VGG16 convolutions
+# in 2d_transfer_learning.py). Their output for an image never changes, so
+# they are run once over the whole dataset and only the trainable head is
+# trained on the cached, memory-mapped float16 features.
+
+# Augmentation happens before the frozen layers, so it is baked into the
+# cache: copy 0 holds the plain images and copies 1, 2, ... randomly
+# flipped/rotated ones that training cycles through epoch by epoch.
+
+from __future__ import division
+
+import os
+import numpy as np
+
+def build_feature_cache(feature_fn, images, cache_path, batchsize=64, num_copies=1, augment=None):
+    """
+    Overview:
+        Runs 'feature_fn' over every image and writes the features to
+        'cache_path' as a float16 .npy file of shape
+        (num_copies, num_samps) + feature_shape.
+    ----------
+    feature_fn: Theano function
+        feature_fn(batch) -> outputs of the frozen layers, e.g. compiled
+        from get_output(net['pool2'], deterministic=True)
+
+    images: numpy array
+        The inputs of shape (num_samps, ...) in dataset order. A memmap
+        (or a view of one) is fine, it is read one batch at a time.
+
+    cache_path: string
+        Where the features are written
+
+    batchsize: int
+        Images per 'feature_fn' call
+
+    num_copies: int
+        Defaults to 1. Copies after the first are augmented w/ 'augment'
+
+    augment: function
+        augment(batch) -> distorted batch, e.g. preaugment_epochs.distort_batch
+
+    Returns
+    -------
+    features: numpy memmap
+        The cache opened read-only
+    """
+    num_samps = images.shape[0]
+    features = None
+    tmp_path = cache_path + '.tmp'
+    for copy in range(num_copies):
+        for i in range(0, num_samps, batchsize):
+            batch = np.asarray(images[i:(i + batchsize)], dtype=np.float32)
+            if copy > 0 and augment is not None:
+                batch = augment(batch)
+            batch_features = feature_fn(batch)
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                                     shape=(num_copies, num_samps) + batch_features.shape[1:])
+            features[copy, i:(i + batchsize)] = batch_features
+        print('Cached features of copy ' + str(copy))
+    features.flush()
+    del features
+    os.rename(tmp_path, cache_path) # Never leave a half written cache behind
+    return load_feature_cache(cache_path)
+
+def load_feature_cache(cache_path):
+    """
+    Returns the cache at 'cache_path' memory-mapped read-only
+    """
+    return np.load(cache_path, mmap_mode='r')
+
+def iterate_cached_features(features, sample_indcs, targets, batchsize, shuffle=False, copy=0):
+    """
+    Overview:
+        An iterator over minibatches of cached features, cast to float32.
+    ----------
+    features: numpy memmap
+        See 'load_feature_cache'
+
+    sample_indcs: numpy array
+        Rows to iterate over (i.e. the training or validation indices)
+
+    targets: numpy array
+        Labels where targets[j] belongs to row sample_indcs[j]
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    shuffle:
+        Defaults to false. If true, the samples are shuffled.
+
+    copy: int
+        Which copy to read (taken modulo the number of copies), e.g.
+        the epoch for training and 0 for validation
+
+    Returns
+    -------
+    batch_features: numpy array
+        The minibatch of features
+
+    batch_sample_target: numpy array
+        The corresponding labels for the batch_features
+    """
+    copy_features = features[copy % features.shape[0]]
+    num_samps = len(sample_indcs)
+    positions = np.arange(num_samps)
+    if shuffle:
+        np.random.shuffle(positions)
+    for i in range(0, num_samps - batchsize + 1, batchsize):
+        batch_positions = positions[i:(i + batchsize)]
+        rows = sample_indcs[batch_positions]
+        order = np.argsort(rows) # Sequential reads from the memmap
+        rows, batch_positions = rows[order], batch_positions[order]
+        yield copy_features[rows].astype(np.float32), targets[batch_positions]
@@ -0,0 +1,198 @@
+# Class-balanced minibatches w/ hard example mining for the texting clips.
+# The labels are collapsed from four classes (0 nothing, 1 only driver, 2
+# both, 3 only passenger texting) to +/-1 for the hinge loss, so the
+# passenger-texting negatives - the clips that look most like positives -
+# are a small part of a uniform epoch. 'HardExampleSampler' draws every
+# batch w/ the same number of clips from each original class and, within
+# a class, moves the draw probability from uniform towards each clip's
+# recent training loss over the first epochs.
+
+# The losses cost nothing extra: 'MiningTrainFn' runs a training function
+# that also returns the per-sample losses of the step (see
+# 'build_objectives(..., sample_losses=True)') and hands them to the
+# sampler.
+
+from __future__ import division
+
+import numpy as np
+import theano
+
+class HardExampleSampler(object):
+    """
+    Overview:
+        Draws the clip order of each epoch, to pass as 'indcs' to
+        'iterate_minibatches'. Consecutive runs of 'batchsize' clips hold
+        the same number of clips of every class (up to rounding).
+    ----------
+    classes: numpy array
+        The original class of each training clip, e.g. the raw
+        '../data/train/labels.npy' values of the training indices
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    hard_fraction: float
+        Defaults to .5. Share of each class's draw probability that
+        follows the losses once ramped up. The rest stays uniform so that
+        easy clips are still revisited (must be < 1)
+
+    ramp_epochs: int
+        Defaults to 10. 'hard_fraction' grows linearly from 0 over this
+        many epochs (the first epoch is uniform)
+
+    momentum: float
+        Defaults to .9. A clip's loss is a moving average over the steps
+        it was trained in (dropout and augmentation make one step noisy)
+
+    class_weights: dict
+        Defaults to None (every class equally often). Relative share of a
+        class in each batch by class, e.g. {3: 2} for twice as many
+        passenger-texting clips as each other class
+    """
+    def __init__(self, classes, batchsize, hard_fraction=.5, ramp_epochs=10, momentum=.9,
+                 class_weights=None):
+        if not 0 <= hard_fraction < 1:
+            raise ValueError('hard_fraction must be in [0, 1)')
+        classes = np.asarray(classes)
+        self.batchsize = batchsize
+        self.hard_fraction = hard_fraction
+        self.ramp_epochs = ramp_epochs
+        self.momentum = momentum
+        self.classes = np.unique(classes)
+        self.members = [np.flatnonzero(classes == c) for c in self.classes]
+        shares = np.array([(class_weights or {}).get(c, 1.) for c in self.classes], dtype=np.float64)
+        self.shares = shares / shares.sum()
+        self.losses = np.full(len(classes), np.nan) # Not trained on yet
+
+    def record(self, indcs, losses):
+        """
+        Folds the per-sample training losses of the clips 'indcs' into
+        their moving averages
+        """
+        old = self.losses[indcs]
+        self.losses[indcs] = np.where(np.isnan(old), losses,
+                                      self.momentum * old + (1 - self.momentum) * losses)
+
+    def current_hard_fraction(self, epoch):
+        return self.hard_fraction * min(1., epoch / max(self.ramp_epochs, 1))
+
+    def class_probabilities(self, epoch):
+        """
+        Returns the draw probabilities of the members of each class
+        (one array per class, in the order of 'self.members')
+        """
+        hard = self.current_hard_fraction(epoch)
+        probs = []
+        for members in self.members:
+            uniform = np.full(len(members), 1 / len(members))
+            losses = self.losses[members]
+            seen = ~np.isnan(losses)
+            if hard == 0 or not seen.any() or losses[seen].sum() <= 0:
+                probs.append(uniform)
+                continue
+            losses = np.where(seen, losses, losses[seen].max()) # Unseen clips count as hard
+            probs.append((1 - hard) * uniform + hard * losses / losses.sum())
+        return probs
+
+    def epoch_order(self, epoch):
+        """
+        Overview:
+            Draws one epoch (as many batches as a uniform pass over the
+            training clips). Clips are drawn w/ replacement - w/o it a
+            class that fills its share w/ all its clips would get each
+            one once, whatever the losses.
+        ----------
+        epoch: int
+            The current epoch (sets the hard fraction)
+
+        Returns
+        -------
+        indcs: numpy array
+            Training clip positions, one batch after the other
+        """
+        num_batches = sum(len(m) for m in self.members) // self.batchsize
+        expected = self.batchsize * self.shares
+        counts = np.tile(np.floor(expected).astype(int), (num_batches, 1))
+        remainder = self.batchsize - counts[0].sum()
+        if remainder:
+            # Hand out the leftover slots of each batch by the fractional shares
+            fractions = (expected - counts[0]) / (expected - counts[0]).sum()
+            for row in counts:
+                row[np.random.choice(len(row), remainder, replace=False, p=fractions)] += 1
+
+        draws = []
+        for members, p, total in zip(self.members, self.class_probabilities(epoch), counts.sum(axis=0)):
+            drawn = np.random.choice(members, total, replace=True, p=p)
+            np.random.shuffle(drawn)
+            draws.append(list(drawn))
+        order = []
+        for row in counts:
+            batch = []
+            for drawn, count in zip(draws, row):
+                batch += drawn[:count]
+                del drawn[:count]
+            np.random.shuffle(batch)
+            order += batch
+        return np.asarray(order, dtype=np.int64)
+
+    def __call__(self, trainer, history):
+        """
+        Adds the hard fraction and the mean loss of each class to the
+        epoch's history record (and so to the telemetry)
+        """
+        epoch = history[-1]['epoch']
+        history[-1]['hard_fraction'] = self.current_hard_fraction(epoch)
+        for c, members in zip(self.classes, self.members):
+            losses = self.losses[members]
+            if (~np.isnan(losses)).any():
+                history[-1]['class{}_loss'.format(c)] = float(np.nanmean(losses))
+
+    def get_state(self):
+        return {'losses': self.losses.copy()}
+
+    def set_state(self, state):
+        self.losses = state['losses']
+
+def attach_indcs(batches, indcs, batchsize):
+    """
+    Appends the clip positions to every (inputs, targets) batch of an
+    iterator that takes its samples in the order 'indcs'
+    """
+    for i, batch in enumerate(batches):
+        yield tuple(batch) + (indcs[(i * batchsize):((i + 1) * batchsize)],)
+
+class MiningTrainFn(object):
+    """
+    Overview:
+        A drop-in replacement for 'train_fn' that takes the batches of
+        'attach_indcs': called as train_fn(inputs, targets, indcs), it
+        runs one training step, records the per-sample losses in the
+        sampler and returns the mean loss.
+    ----------
+    fn: Theano function
+        fn(inputs, targets) -> [loss, sample_losses] (see
+        'compile_mining_fns')
+
+    sampler: HardExampleSampler
+    """
+    def __init__(self, fn, sampler):
+        self.fn = fn
+        self.sampler = sampler
+
+    @property
+    def functions(self):
+        return [self.fn]
+
+    def __call__(self, inputs, targets, indcs):
+        loss, sample_losses = self.fn(inputs, targets)
+        self.sampler.record(indcs, sample_losses)
+        return loss
+
+def compile_mining_fns(input_var, target_var, loss, sample_losses, updates, val_outputs):
+    """
+    Like 'compile_fns' but train_fn(inputs, targets) returns [loss,
+    sample_losses] (wrap it in a 'MiningTrainFn')
+    """
+    train_fn = theano.function([input_var, target_var], [loss, sample_losses], updates=updates)
+    val_fn = theano.function([input_var, target_var], val_outputs)
+    return train_fn, val_fn
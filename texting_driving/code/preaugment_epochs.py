@@ -0,0 +1,158 @@
+# Materializes several randomly flipped/rotated epochs of the training clips
+# into memory-mapped uint8 shards so that training runs can replay them at
+# I/O speed instead of paying the augmentation cost every epoch
+
+# Usage (from the code folder): $python preaugment_epochs.py NUM_EPOCHS
+
+from __future__ import division
+
+import os
+import sys
+import glob
+import numpy as np
+
+from random_image_generator import *
+from telemetry import timed
+
+def distort_batch(batch_sample_input):
+    """
+    Overview:
+        Randomly flips or rotates 3/4 of the samples in the minibatch
+        (the same policy as 'iterate_minibatches'). The remaining 1/4
+        of the samples are left the same.
+    ----------
+    batch_sample_input: numpy array
+        Minibatch of shape (batchsize, 1, num_frames, length, width).
+        This is modified in place.
+
+    Returns
+    -------
+    batch_sample_input: numpy array
+        The distorted minibatch
+    """
+    batchsize = batch_sample_input.shape[0]
+    num_changes = int(batchsize * .75) # Prop of samples we distort
+    distorts_per_cat = int(num_changes / 2) # Of those we distort, flip half, rotate other half
+
+    swap_indcs = np.random.choice(batchsize, num_changes, replace=False)
+    flip_indcs = swap_indcs[0:distorts_per_cat]
+    rotate_indcs = swap_indcs[distorts_per_cat:(2 * distorts_per_cat)]
+    batch_sample_input[flip_indcs] = batch_sample_input[flip_indcs, ..., ::-1]
+    batch_sample_input[rotate_indcs] = random_clip_generator(batch_sample_input[rotate_indcs], batched=True)
+    return batch_sample_input
+
+def materialize_epochs(path_to_images, shard_dir, num_epochs, batchsize=16,
+                       clip_shape=(1, 10, 81, 144)):
+    """
+    Overview:
+        Writes 'num_epochs' augmented copies of every clip to
+        'shard_dir/epochK.npy'. Each shard is a uint8 .npy file that can
+        be opened w/ np.load(path, mmap_mode='r').
+    ----------
+    path_to_images: string
+        Path to 'images_by_time_mat.npy' (values in 0-255)
+
+    shard_dir: string
+        Folder where the shards are written
+
+    num_epochs: int
+        The number of augmented epochs to materialize
+
+    batchsize: int
+        Clips are distorted in groups of this size so the proportion of
+        flipped/rotated samples matches training
+
+    clip_shape: tuple
+        The shape of one sample as fed to the network
+
+    Returns
+    -------
+    shard_paths: list
+        Paths of the written shards
+    """
+    X = np.load(path_to_images, mmap_mode='r')
+    num_samps = X.shape[0]
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shard_paths = []
+    for epoch in range(num_epochs):
+        shard_path = os.path.join(shard_dir, 'epoch' + str(epoch) + '.npy')
+        tmp_path = shard_path + '.tmp'
+        shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                          shape=(num_samps,) + tuple(clip_shape))
+        for i in range(0, num_samps, batchsize):
+            batch = np.asarray(X[i:(i + batchsize)], dtype=np.float32)
+            batch = distort_batch(batch.reshape((-1,) + tuple(clip_shape)))
+            shard[i:(i + batchsize)] = np.clip(np.rint(batch), 0, 255)
+        shard.flush()
+        del shard
+        os.rename(tmp_path, shard_path) # Never leave a half written shard behind
+        shard_paths.append(shard_path)
+        print('Finished Materializing Epoch ' + str(epoch))
+    return shard_paths
+
+def load_epoch_shards(shard_dir):
+    """
+    Returns the memory-mapped shards in 'shard_dir' ordered by epoch
+    """
+    paths = glob.glob(os.path.join(shard_dir, 'epoch*.npy'))
+    paths.sort(key=lambda path: int(os.path.basename(path)[5:-4]))
+    return [np.load(path, mmap_mode='r') for path in paths]
+
+def iterate_preaugmented(shard, sample_indcs, targets, batchsize, shuffle=False, frame=None):
+    """
+    Overview:
+        Replays one pre-augmented epoch. Batches are read from the
+        memory-mapped shard and scaled to float32 in [0, 1], so no
+        augmentation happens on the training thread.
+    ----------
+    shard: numpy memmap
+        One of the shards returned by 'load_epoch_shards'
+
+    sample_indcs: numpy array
+        Rows of the shard to train on (i.e. the training indices)
+
+    targets: numpy array
+        Labels where targets[j] belongs to row sample_indcs[j]
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    shuffle:
+        Defaults to false. If true, the samples are shuffled.
+
+    frame: int
+        Defaults to None. If set, only this frame of each clip is
+        returned (shape (batchsize, 1, length, width)) for the 2D models
+
+    Returns
+    -------
+    batch_sample_input: numpy array
+        The (already augmented) minibatch
+
+    batch_sample_target: numpy array
+        The corresponding labels for the batch_sample_input
+    """
+    num_samps = len(sample_indcs)
+    positions = np.arange(num_samps)
+    if shuffle:
+        np.random.shuffle(positions)
+    for i in range(0, num_samps - batchsize + 1, batchsize):
+        batch_positions = positions[i:(i + batchsize)]
+        rows = sample_indcs[batch_positions]
+        order = np.argsort(rows) # Sequential reads from the memmap
+        rows, batch_positions = rows[order], batch_positions[order]
+        with timed('index'):
+            if frame is None:
+                batch_sample_input = shard[rows]
+            else:
+                batch_sample_input = shard[rows, :, frame]
+            batch_sample_input = batch_sample_input.astype(np.float32)
+            batch_sample_input /= 255
+        yield batch_sample_input, targets[batch_positions]
+
+if __name__ == '__main__':
+
+    num_epochs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    materialize_epochs('../data/train/images_by_time_mat.npy',
+                       '../data/train/augmented', num_epochs)
@@ -0,0 +1,134 @@
+# Keeps a whole (unaugmented or pre-augmented) dataset in theano.shared
+# storage so that 'train_fn'/'val_fn' only receive a batch index instead of
+# a freshly copied numpy minibatch on every call
+
+from __future__ import division
+
+import numpy as np
+import theano
+import theano.tensor as T
+
+class SharedDataset(object):
+    """
+    Overview:
+        Inputs, targets and a per-epoch sample order stored as
+        theano.shared variables. Minibatch 'index' is the slice
+        order[index * batchsize:(index + 1) * batchsize].
+    ----------
+    inputs: numpy array
+        Data of shape (num_samps, ...). uint8 data can be kept as is
+        (4x less memory) and scaled inside the graph w/ 'scale'
+
+    targets: numpy array
+        The corresponding labels of shape (num_samps, ), already in the
+        dtype of the target variable (e.g. int32 or float32)
+
+    batchsize: int
+        The number of samples in each minibatch
+
+    scale: float
+        Defaults to 1. Inputs are divided by this inside the graph
+        (use 255 for raw uint8 images)
+    """
+    def __init__(self, inputs, targets, batchsize, scale=1):
+        self.batchsize = batchsize
+        self.scale = scale
+        self.inputs = theano.shared(np.asarray(inputs), name='shared_inputs', borrow=True)
+        self.targets = theano.shared(np.asarray(targets), name='shared_targets', borrow=True)
+        self.order = theano.shared(np.arange(len(targets), dtype=np.int32), name='order', borrow=True)
+
+    @property
+    def num_samps(self):
+        return self.order.get_value(borrow=True).shape[0]
+
+    @property
+    def num_batches(self):
+        return self.num_samps // self.batchsize
+
+    def set_data(self, inputs, targets=None):
+        """
+        Replaces the stored data (e.g. w/ the next pre-augmented epoch
+        or the next drive). The dtypes must stay the same.
+        """
+        self.inputs.set_value(np.asarray(inputs, dtype=self.inputs.dtype), borrow=True)
+        if targets is not None:
+            self.targets.set_value(np.asarray(targets, dtype=self.targets.dtype), borrow=True)
+        self.order.set_value(np.arange(len(inputs), dtype=np.int32), borrow=True)
+
+    def shuffle(self):
+        """
+        Draws a new random sample order for the next epoch
+        """
+        self.order.set_value(np.random.permutation(self.num_samps).astype(np.int32), borrow=True)
+
+    def givens(self, input_var, target_var, index):
+        """
+        Returns the 'givens' dict that substitutes minibatch 'index'
+        for 'input_var' and 'target_var'
+        """
+        batch_indcs = self.order[index * self.batchsize:(index + 1) * self.batchsize]
+        batch_input = self.inputs[batch_indcs]
+        if self.inputs.dtype != theano.config.floatX:
+            batch_input = T.cast(batch_input, theano.config.floatX)
+        if self.scale != 1:
+            batch_input = batch_input / np.asarray(self.scale, dtype=theano.config.floatX)
+        return {input_var: batch_input, target_var: self.targets[batch_indcs]}
+
+def compile_indexed_fns(input_var, target_var, loss, updates, val_outputs, train_data, val_data):
+    """
+    Overview:
+        Compiles 'train_fn' and 'val_fn' so they take a single batch
+        index and read the minibatch from shared storage.
+    ----------
+    input_var: Theano Tensor
+        The network's input variable
+
+    target_var: Theano Tensor
+        The labels variable used in 'loss' and 'val_outputs'
+
+    loss: Theano expression
+        Training loss
+
+    updates: OrderedDict
+        Parameter updates (e.g. from 'adam')
+
+    val_outputs: list
+        Validation expressions, e.g. [test_loss, test_acc]
+
+    train_data: SharedDataset
+        Training set
+
+    val_data: SharedDataset
+        Validation set
+
+    Returns
+    -------
+    train_fn: Theano function
+        train_fn(index) -> training loss of that minibatch
+
+    val_fn: Theano function
+        val_fn(index) -> 'val_outputs' for that minibatch
+    """
+    index = T.iscalar('index')
+    train_fn = theano.function([index], loss, updates=updates,
+                               givens=train_data.givens(input_var, target_var, index))
+    val_fn = theano.function([index], val_outputs,
+                             givens=val_data.givens(input_var, target_var, index))
+    return train_fn, val_fn
+
+def iterate_shared_batches(dataset, shuffle=False):
+    """
+    Overview:
+        Yields the arguments for an indexed 'train_fn'/'val_fn', i.e.
+        (index,) for every full minibatch of 'dataset'.
+    ----------
+    dataset: SharedDataset
+        The dataset the function was compiled against
+
+    shuffle:
+        Defaults to false. If true, a new sample order is drawn first.
+    """
+    if shuffle:
+        dataset.shuffle()
+    for index in range(dataset.num_batches):
+        yield (index,)
@@ -0,0 +1,287 @@
+# Random hyperparameter sweeps w/ early termination. Trials (one config
+# sampled from a search space each) run concurrently in a process pool and
+# asynchronous successive halving (ASHA) stops the bad ones early: at every
+# rung (min_epochs, min_epochs * 3, min_epochs * 9, ... epochs) a trial
+# only goes on if its best validation value so far is among the top 1/3 of
+# all the values reported at that rung.
+
+# Every rung value and every finished trial is appended to a JSONL results
+# file. The trials decide against it (under a lock), it survives crashes
+# and a sweep that is started again continues w/ the next trial id.
+
+# The pool is forked: use num_parallel > 1 on CPU (w/ OMP_NUM_THREADS=1)
+# and num_parallel=1 on a GPU, which runs the trials in this process.
+
+# Usage: $python sweep.py RESULTS.jsonl [N] [--maximize] prints the N best trials
+
+from __future__ import division
+
+import sys
+import json
+import timeit
+import traceback
+import multiprocessing
+import numpy as np
+
+from data_parallel import physical_cores
+
+def uniform(low, high):
+    """
+    A search space entry sampled uniformly from [low, high)
+    """
+    def sample(rng):
+        return float(rng.uniform(low, high))
+    return sample
+
+def log_uniform(low, high):
+    """
+    A search space entry sampled uniformly on a log scale, e.g. for
+    learning rates
+    """
+    def sample(rng):
+        return float(np.exp(rng.uniform(np.log(low), np.log(high))))
+    return sample
+
+def sample_config(space, rng):
+    """
+    Overview:
+        Draws one configuration from 'space'.
+    ----------
+    space: dict
+        Maps a name to a list of choices or to a sampler such as
+        'log_uniform(1e-4, 1e-2)'
+
+    rng: numpy RandomState
+
+    Returns
+    -------
+    config: dict
+    """
+    config = {}
+    for name in sorted(space):
+        dist = space[name]
+        config[name] = dist(rng) if callable(dist) else dist[rng.randint(len(dist))]
+    return config
+
+class ResultStore(object):
+    """
+    Overview:
+        A JSONL file of sweep records. 'rung' records hold the value a
+        trial reported at a rung and 'trial' records a finished trial
+        (config, status, epochs, best value and time).
+    ----------
+    path: string
+        E.g. '../data/train/sweep_3d_cnn.jsonl'
+
+    lock: multiprocessing Lock
+        Shared by all processes that write to 'path'
+    """
+    def __init__(self, path, lock=None):
+        self.path = path
+        self.lock = lock or multiprocessing.Lock()
+
+    def records(self, kind=None):
+        try:
+            with open(self.path) as f:
+                records = [json.loads(line) for line in f if line.strip()]
+        except IOError:
+            return []
+        return [r for r in records if kind is None or r['kind'] == kind]
+
+    def _append(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def append(self, record):
+        with self.lock:
+            self._append(record)
+
+    def report_rung(self, trial, rung, epoch, value):
+        """
+        Appends a rung value and returns all values reported at 'rung'
+        so far (including this one)
+        """
+        with self.lock:
+            values = [r['value'] for r in self.records('rung') if r['rung'] == rung]
+            self._append({'kind': 'rung', 'trial': trial, 'rung': rung,
+                          'epoch': epoch, 'value': value})
+        return values + [value]
+
+    def best_trials(self, n=5, maximize=False):
+        """
+        Returns the 'n' finished trials w/ the best value
+        """
+        trials = [r for r in self.records('trial') if r['best_value'] is not None]
+        return sorted(trials, key=lambda r: r['best_value'], reverse=maximize)[:n]
+
+class SuccessiveHalving(object):
+    """
+    Overview:
+        The ASHA decision for one trial, as a Trainer callback. Raises
+        StopIteration once the trial falls out of the top
+        1 / reduction_factor at a rung. Only full validation passes are
+        considered.
+    ----------
+    store: ResultStore
+        Where the rung values of all trials are kept
+
+    trial: int
+        The trial id
+
+    monitor: string
+        History key to watch, defaults to 'valid_loss'
+
+    maximize: boolean
+        Defaults to false. Set to true for accuracies
+
+    min_epochs: int
+        Defaults to 10. Epochs before the first rung
+
+    max_epochs: int
+        Defaults to 500. No rungs at or past this
+
+    reduction_factor: int
+        Defaults to 3. Only the top 1 / reduction_factor go on at each rung
+    """
+    def __init__(self, store, trial, monitor='valid_loss', maximize=False, min_epochs=10,
+                 max_epochs=500, reduction_factor=3):
+        self.store = store
+        self.trial = trial
+        self.monitor = monitor
+        self.maximize = maximize
+        self.reduction_factor = reduction_factor
+        self.rungs = []
+        rung = min_epochs
+        while rung < max_epochs:
+            self.rungs.append(rung)
+            rung *= reduction_factor
+        self.next_rung = 0
+        self.best_value = None
+        self.stopped = False
+
+    def __call__(self, trainer, history):
+        record = history[-1]
+        if self.monitor not in record or not record.get('valid_full', True):
+            return
+        current = record[self.monitor]
+        if not np.isfinite(current):
+            self.stopped = True # A diverged trial is never promoted
+            raise StopIteration
+        if (self.best_value is None or
+                (current > self.best_value if self.maximize else current < self.best_value)):
+            self.best_value = current
+        if self.next_rung >= len(self.rungs) or record['epoch'] + 1 < self.rungs[self.next_rung]:
+            return
+        rung = self.rungs[self.next_rung]
+        self.next_rung += 1
+        values = sorted(self.store.report_rung(self.trial, rung, record['epoch'], self.best_value),
+                        reverse=self.maximize)
+        num_promoted = len(values) // self.reduction_factor
+        if num_promoted == 0:
+            return # Too few trials at this rung to judge yet
+        cutoff = values[num_promoted - 1]
+        if self.best_value > cutoff if not self.maximize else self.best_value < cutoff:
+            print('Trial {} stopped at rung {} ({} = {:.4f})'.format(self.trial, rung, self.monitor,
+                                                                     self.best_value))
+            self.stopped = True
+            raise StopIteration
+
+# Set in every pool process by '_init_worker' (forked, so nothing is pickled)
+_trial_fn, _store, _halving_kwargs = None, None, None
+
+def _init_worker(trial_fn, store, halving_kwargs):
+    global _trial_fn, _store, _halving_kwargs
+    _trial_fn, _store, _halving_kwargs = trial_fn, store, halving_kwargs
+
+def _run_trial(task):
+    trial, config = task
+    halving = SuccessiveHalving(_store, trial, **_halving_kwargs)
+    start = timeit.default_timer()
+    error = None
+    try:
+        history = _trial_fn(config, halving)
+        status = 'stopped' if halving.stopped else 'completed'
+        epochs = len(history or [])
+    except Exception:
+        status, epochs, error = 'failed', None, traceback.format_exc()
+        print('Trial {} failed:\n{}'.format(trial, error))
+    record = {'kind': 'trial', 'trial': trial, 'config': config, 'status': status,
+              'epochs': epochs, 'best_value': halving.best_value,
+              'seconds': timeit.default_timer() - start, 'error': error}
+    _store.append(record)
+    return record
+
+def run_sweep(trial_fn, space, num_trials, results_path, num_parallel=None, monitor='valid_loss',
+              maximize=False, min_epochs=10, max_epochs=500, reduction_factor=3, seed=0):
+    """
+    Overview:
+        Runs 'num_trials' random configurations from 'space' w/ ASHA
+        early termination and returns the best finished trials.
+    ----------
+    trial_fn: function
+        trial_fn(config, callback) trains one configuration for up to
+        'max_epochs' epochs w/ 'callback' among its on_epoch_finished
+        callbacks and returns the Trainer history
+
+    space: dict
+        The search space, see 'sample_config'
+
+    num_trials: int
+        Total trials of the sweep. Trials already in 'results_path' are
+        skipped, the missing ids (e.g. ones interrupted) are run
+
+    results_path: string
+        The JSONL results file, see 'ResultStore'
+
+    num_parallel: int
+        Concurrent trials, defaults to the number of physical cores.
+        1 runs the trials one after another in this process (GPU).
+
+    monitor, maximize, min_epochs, max_epochs, reduction_factor:
+        See 'SuccessiveHalving'
+
+    seed: int
+        Trial 'i' samples its config w/ RandomState(seed + i)
+
+    Returns
+    -------
+    best_trials: list
+        The 5 best finished trials (see 'ResultStore.best_trials')
+    """
+    store = ResultStore(results_path)
+    # Trials finish out of order - resume every id w/o a record, not just the ones after the last
+    done = set(r['trial'] for r in store.records('trial'))
+    tasks = [(trial, sample_config(space, np.random.RandomState(seed + trial)))
+             for trial in range(num_trials) if trial not in done]
+    halving_kwargs = {'monitor': monitor, 'maximize': maximize, 'min_epochs': min_epochs,
+                      'max_epochs': max_epochs, 'reduction_factor': reduction_factor}
+    num_parallel = min(num_parallel or physical_cores(), max(len(tasks), 1))
+
+    if num_parallel == 1:
+        _init_worker(trial_fn, store, halving_kwargs)
+        for task in tasks:
+            _run_trial(task)
+    else:
+        # One trial per process, so every trial starts w/ a fresh Theano state
+        pool = multiprocessing.Pool(num_parallel, _init_worker, (trial_fn, store, halving_kwargs),
+                                    maxtasksperchild=1)
+        try:
+            for record in pool.imap_unordered(_run_trial, tasks):
+                print('Trial {} {} after {} epochs (best {} = {})'.format(
+                    record['trial'], record['status'], record['epochs'], monitor, record['best_value']))
+        finally:
+            pool.terminate()
+            pool.join()
+    return store.best_trials(maximize=maximize)
+
+if __name__ == '__main__':
+
+    args = [arg for arg in sys.argv[1:] if arg != '--maximize']
+    store = ResultStore(args[0])
+    num_best = int(args[1]) if len(args) > 1 else 5
+    for record in store.best_trials(num_best, maximize='--maximize' in sys.argv):
+        print('trial {trial}:\t{best_value:.4f}\t{status} after {epochs} epochs\t{config}'.format(**record))
+    trials = store.records('trial')
+    print('{} trials, {} stopped early, {} failed'.format(
+        len(trials), sum(r['status'] == 'stopped' for r in trials),
+        sum(r['status'] == 'failed' for r in trials)))
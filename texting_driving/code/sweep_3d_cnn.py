@@ -0,0 +1,78 @@
+# Sweeps the filter counts, dropout, dense units and learning rate of the 3D
+# CNN (see 'build_cnn' in 3d_cnn_lasagne.py) w/ 'sweep.py'. Trials are
+# stopped early on the validation loss, results go to
+# '../data/train/sweep_3d_cnn.jsonl' (re-running continues the sweep).
+
+# Usage (from the code folder): $OMP_NUM_THREADS=1 python sweep_3d_cnn.py [NUM_PARALLEL]
+# and then $python sweep.py ../data/train/sweep_3d_cnn.jsonl
+
+from __future__ import division
+
+import sys
+import importlib
+import numpy as np
+import theano.tensor as T
+
+from theano.tensor import TensorType
+from lasagne.objectives import binary_hinge_loss
+from trainer import Trainer, build_objectives, compile_fns, binary_accuracy
+from varying_learning_rates import shared_learning_rate
+from sweep import run_sweep, uniform, log_uniform
+
+# Module names can't start w/ a digit in an import statement
+cnn = importlib.import_module('3d_cnn_lasagne')
+
+SPACE = {'num_filters': [(8, 16, 32), (16, 32, 64), (32, 64, 128)],
+         'conv_dropout': uniform(.1, .4),
+         'dense_dropout': uniform(.3, .6),
+         'num_units': [250, 500, 1000],
+         'learning_rate': log_uniform(1e-4, 3e-3)}
+
+NUM_TRIALS = 60
+MAX_EPOCHS = 270 # Rungs at 10, 30 and 90 epochs
+
+def run_trial(config, callback):
+    """
+    Overview:
+        Trains the 3D CNN w/ one configuration of 'SPACE' on the module
+        level train/validation split.
+    ----------
+    config: dict
+        Sampled from 'SPACE'
+
+    callback: Trainer callback
+        The trial's 'SuccessiveHalving'
+
+    Returns
+    -------
+    history: list
+        The Trainer history
+    """
+    input_var = TensorType('float32', (False,)*5)('inputs')
+    target_var = T.ivector('targets')
+    network = cnn.build_cnn(input_var, num_filters=tuple(config['num_filters']),
+                            dropout=(config['conv_dropout'], config['dense_dropout'], config['dense_dropout']),
+                            num_units=config['num_units'])['output']
+    loss, updates, val_outputs = build_objectives(network, target_var, binary_hinge_loss, binary_accuracy,
+                                                  learning_rate=shared_learning_rate(config['learning_rate']))
+    train_fn, val_fn = compile_fns(input_var, target_var, loss, updates, val_outputs)
+    trainer = Trainer(train_fn, val_fn, on_epoch_finished=[callback], verbose=False)
+    return trainer.fit(lambda epoch: cnn.iterate_minibatches(X_train, y_train, 16, shuffle=True),
+                       lambda epoch: cnn.iterate_minibatches(X_val, y_val, 16, augment=False),
+                       num_epochs=MAX_EPOCHS)
+
+if __name__ == '__main__':
+
+    # Same 85% / 15% split for every trial (the forked trials share these arrays)
+    X, Y = cnn.load_data()
+    indcs = np.random.RandomState(0).permutation(len(Y))
+    X_train, y_train = X[indcs[:2604]], Y[indcs[:2604]]
+    X_val, y_val = X[indcs[2604:]], Y[indcs[2604:]]
+    X, Y = None, None
+
+    num_parallel = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    best = run_sweep(run_trial, SPACE, NUM_TRIALS, '../data/train/sweep_3d_cnn.jsonl',
+                     num_parallel=num_parallel, monitor='valid_loss', min_epochs=10,
+                     max_epochs=MAX_EPOCHS)
+    for record in best:
+        print('trial {trial}:\t{best_value:.4f}\t{config}'.format(**record))
@@ -0,0 +1,75 @@
+# Converts the Lasagne Model Zoo's 'vgg16.pkl' (~500 MB, one pickle) into an
+# indexed per-layer weight store (see 'weight_format.py'), so transfer
+# learning runs read only the tensors of the layers they reuse instead of
+# unpickling everything and building the whole VGG16 graph.
+
+# Usage (from the code folder, once): $python vgg16_store.py vgg16.pkl vgg16.lw
+
+from __future__ import division
+
+import sys
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from weight_format import write_weight_file, map_weight_file
+
+# Layers of vgg16.build_model() w/ parameters, in 'param values' order
+VGG16_PARAM_LAYERS = ['conv1_1', 'conv1_2',
+                      'conv2_1', 'conv2_2',
+                      'conv3_1', 'conv3_2', 'conv3_3',
+                      'conv4_1', 'conv4_2', 'conv4_3',
+                      'conv5_1', 'conv5_2', 'conv5_3',
+                      'fc6', 'fc7', 'fc8']
+
+def convert_vgg16(path_to_pkl, store_path):
+    """
+    Overview:
+        Writes the parameters of 'vgg16.pkl' as 'LAYER.W'/'LAYER.b' arrays
+        plus the 'mean_value' array to 'store_path'.
+    ----------
+    path_to_pkl: string
+        The Model Zoo pickle
+
+    store_path: string
+        Destination, e.g. 'vgg16.lw'
+    """
+    with open(path_to_pkl, 'rb') as f:
+        params = pickle.load(f)
+    values = params['param values']
+    if len(values) != 2 * len(VGG16_PARAM_LAYERS):
+        raise ValueError('expected {} arrays, got {}'.format(2 * len(VGG16_PARAM_LAYERS), len(values)))
+    names = [layer + suffix for layer in VGG16_PARAM_LAYERS for suffix in ('.W', '.b')]
+    write_weight_file(store_path, list(values) + [params['mean value']], names + ['mean_value'])
+
+def load_vgg16_layers(store_path, layers):
+    """
+    Overview:
+        Reads only the requested layers' tensors from the store.
+    ----------
+    store_path: string
+        A store written by 'convert_vgg16'
+
+    layers: list
+        Layer names, e.g. ['conv1_1', 'conv1_2', 'conv2_1']
+
+    Returns
+    -------
+    layer_params: list
+        [W, b] (numpy arrays) for each requested layer
+
+    mean_value: numpy array
+        The ImageNet mean used to train VGG16
+    """
+    names = [layer + suffix for layer in layers for suffix in ('.W', '.b')]
+    arrays, array_names = map_weight_file(store_path, names=names + ['mean_value'])
+    by_name = dict(zip(array_names, arrays))
+    layer_params = [[by_name[layer + '.W'], by_name[layer + '.b']] for layer in layers]
+    return layer_params, by_name['mean_value']
+
+if __name__ == '__main__':
+
+    convert_vgg16(sys.argv[1], sys.argv[2])
+    print('Wrote ' + sys.argv[2])